@@ -0,0 +1,129 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Resumable training checkpoints, written by a background thread
+# -----------------------------------------------------------
+
+import os, re, glob, random, threading, queue, torch
+import numpy as np
+
+
+def cpu_copy(obj):
+    # detached cpu copy of (nested) tensors, taken before training goes on
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        out = type(obj)((k, cpu_copy(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # versions of the state_dict of modules, used by load_state_dict
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+def get_rng_state():
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager(object):
+    """Writes checkpoints in a background thread so training does not wait for the disk.
+    Files of save_path:
+        save_path + '.ckpt_<epc>': full state of the last keep_last epochs (model, optimizer, rng, schedules, ...)
+        save_path + '.ckpt_best' : full state of the best epoch
+        save_path                : model state_dict of the best epoch, as read by the evaluation scripts
+    Each file is written to a temporary name and renamed, so a crash never leaves a partial checkpoint."""
+    def __init__(self, save_path, keep_last=3):
+        self.save_path = save_path
+        self.keep_last = keep_last
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, obj, path):
+        tmp = path + '.tmp'
+        torch.save(obj, tmp)
+        os.replace(tmp, path)
+
+    def ckpt_path(self, epc):
+        return self.save_path + '.ckpt_' + str(epc)
+
+    def epochs(self):
+        # epochs with a full checkpoint on disk, in order
+        pattern = re.compile(re.escape(os.path.basename(self.save_path)) + r'\.ckpt_(\d+)$')
+        matches = [pattern.match(os.path.basename(f)) for f in glob.glob(glob.escape(self.save_path) + '.ckpt_*')]
+        return sorted(int(m.group(1)) for m in matches if m is not None)
+
+    def _save_best(self, state):
+        self._write(state, self.save_path + '.ckpt_best')
+        self._write(state['model'], self.save_path)
+
+    def _save(self, state, epc, is_best):
+        self._write(state, self.ckpt_path(epc))
+        if is_best:
+            self._save_best(state)
+        for old in self.epochs()[:-self.keep_last]:
+            os.remove(self.ckpt_path(old))
+
+    def save(self, state, epc, is_best=False):
+        # state: dict with at least 'model' (a state_dict); copied now, written later
+        self.check()
+        state = cpu_copy(state)
+        self.queue.put(lambda: self._save(state, epc, is_best))
+
+    def save_best(self, state):
+        # full state of an earlier epoch found to be the best, e.g. by asynchronous validation
+        self.check()
+        state = cpu_copy(state)
+        self.queue.put(lambda: self._save_best(state))
+
+    def save_model(self, state_dict, path):
+        # model-only snapshot, e.g. save_path+'_'+str(epc)
+        self.check()
+        state_dict = cpu_copy(state_dict)
+        self.queue.put(lambda: self._write(state_dict, path))
+
+    def latest(self):
+        # path of the last full checkpoint, None if there is none
+        epochs = self.epochs()
+        return self.ckpt_path(epochs[-1]) if len(epochs) > 0 else None
+
+    def load(self, path=None, map_location='cpu'):
+        path = self.latest() if path is None else path
+        # rng states are plain python/numpy objects
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def check(self):
+        # raise the error of a failed write in the training thread
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wait(self):
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,98 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Words grouped by their dictionary codes, for the periodic cluster dumps of the trainers
+# -----------------------------------------------------------
+
+import json
+import numpy as np
+
+
+class ClusterStore(object):
+    """Words of each code, for one or more codings of the same words, e.g. {'0': code of dict 0, ..., 'suffix': suffix code}.
+    Words and codes are interned to ids and every batch appends (code id, word id) pairs, so adding a batch
+    costs O(batch) and the distinct words of each code come from one np.unique per coding at dump time,
+    instead of list membership checks per word.
+    Snapshots are appended to JSONL files, one line per epoch and coding:
+        clusters: {"epoch": 10, "name": "suffix", "clusters": {"-3-0": ["<s>gel</s>", ...], ...}}
+        usage:    {"epoch": 10, "name": "suffix", "usage": {"-3-0": 12, ...}}   (distinct words of each code)
+    """
+    def __init__(self, vocab, names):
+        self.vocab = vocab
+        self.names = list(names)
+        self.word_ids = dict(); self.words = []
+        # decoded words of rows seen before, rows are id tuples
+        self.row_words = dict()
+        self.code_ids = {name: dict() for name in self.names}
+        self.codes = {name: [] for name in self.names}
+        self.pairs = {name: [] for name in self.names}
+
+    def _intern(self, ids, items, item):
+        i = ids.get(item)
+        if i is None:
+            i = ids[item] = len(items)
+            items.append(item)
+        return i
+
+    def _word_ids(self, x):
+        # x: (B,T) ---> word id of each row, each distinct row decoded once
+        wids = []
+        for row in map(tuple, x.tolist()):
+            wid = self.row_words.get(row)
+            if wid is None:
+                word = ''.join(self.vocab.decode_sentence_2(row))
+                wid = self.row_words[row] = self._intern(self.word_ids, self.words, word)
+            wids.append(wid)
+        return np.asarray(wids, dtype=np.int64)
+
+    def add(self, x, codes):
+        # x: (B,T) words, codes: {name: B codes (list of hashables, or a (B,) / (1,B) tensor)}
+        wids = self._word_ids(x)
+        for name, name_codes in codes.items():
+            if hasattr(name_codes, 'tolist'):
+                name_codes = name_codes.reshape(-1).tolist()
+            cids = np.asarray([self._intern(self.code_ids[name], self.codes[name], code) for code in name_codes], dtype=np.int64)
+            self.pairs[name].append(np.stack((cids, wids), axis=1))
+
+    def _groups(self, name):
+        # ---> code ids, start of each code in word ids, distinct words per code, word ids grouped by code
+        if len(self.pairs[name]) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, empty
+        # distinct (code, word) pairs, sorted by code then word
+        pairs = np.unique(np.concatenate(self.pairs[name]), axis=0)
+        cids, starts, counts = np.unique(pairs[:, 0], return_index=True, return_counts=True)
+        return cids, starts, counts, pairs[:, 1]
+
+    def clusters(self, name):
+        # code ---> distinct words, codes and words in the order of their first appearance in the data
+        cids, starts, counts, wids = self._groups(name)
+        return {self.codes[name][c]: [self.words[w] for w in wids[s:s+n]] for c, s, n in zip(cids.tolist(), starts.tolist(), counts.tolist())}
+
+    def usage(self, name):
+        # code ---> number of distinct words
+        cids, _, counts, _ = self._groups(name)
+        return {self.codes[name][c]: n for c, n in zip(cids.tolist(), counts.tolist())}
+
+    def dump(self, epc, fclusters, fusage):
+        # appends the snapshot of every coding to the two JSONL files, codes sorted as in the former json dumps
+        with open(fclusters, 'a') as writer_clusters, open(fusage, 'a') as writer_usage:
+            for name in self.names:
+                cids, starts, counts, wids = self._groups(name)
+                groups = sorted(zip([self.codes[name][c] for c in cids.tolist()], starts.tolist(), counts.tolist()))
+                clusters = {str(code): [self.words[w] for w in wids[s:s+n]] for code, s, n in groups}
+                usage = {str(code): n for code, _, n in groups}
+                writer_clusters.write(json.dumps({'epoch': epc, 'name': name, 'clusters': clusters}, ensure_ascii=False) + '\n')
+                writer_usage.write(json.dumps({'epoch': epc, 'name': name, 'usage': usage}) + '\n')
+
+
+def read_snapshot(fname, name, epoch=None):
+    # clusters (or usage) of one coding from a JSONL dump, of the given epoch or the last one
+    found = None
+    with open(fname, 'r') as reader:
+        for line in reader:
+            snapshot = json.loads(line)
+            if snapshot['name'] == name and (epoch is None or snapshot['epoch'] == epoch):
+                found = snapshot
+    if found is None:
+        return None
+    return found['clusters'] if 'clusters' in found else found['usage']
@@ -0,0 +1,52 @@
+"""
+Greedy decoding loop shared by the LSTM decoders
+"""
+import torch
+
+
+def source_length_cap(src_lengths, ratio=2, extra=2):
+    # maximum number of decoding steps of each row, derived from its source length (incl. </s>)
+    return src_lengths * ratio + extra
+
+def greedy_decode(step, hidden, input, eosid, max_lengths, padid=0, keep_logits=False, stop_at_eos=True):
+    """Greedy decoding where every row stops on its own </s> or on its length cap.
+    Finished rows are dropped from the active batch, so no step is run for them.
+    Args:
+        step: function (input (b,1), hidden, rows (b,)) ---> (logits (b,1,V), hidden),
+              rows are the original indices of the active rows, to select per-row context (z etc.)
+        hidden: LSTM state (h, c), each (1, B, H)
+        input: (B,1) first decoder inputs, e.g. <s>
+        max_lengths: (B,) maximum number of steps of each row
+        keep_logits: also return the logits of every step
+        stop_at_eos: if False rows only stop on their length cap and keep feeding their own predictions
+                     after </s>, as needed when the logits are scored against every target position
+    Returns:
+        preds: (B, max(max_lengths)) predicted ids, padded with padid after </s> or the length cap
+        logits: (B, max(max_lengths), V), zeros after a row stops; None if keep_logits is False
+    """
+    batch_size = input.size(0)
+    max_lengths = max_lengths.to(input.device)
+    T = int(max_lengths.max())
+    preds  = torch.full((batch_size, T), padid, dtype=torch.long, device=input.device)
+    logits = None
+    rows = torch.arange(batch_size, device=input.device)
+    for t in range(T):
+        # (b,1,V)
+        output_logits, hidden = step(input, hidden, rows)
+        if keep_logits:
+            if logits is None:
+                logits = output_logits.new_zeros(batch_size, T, output_logits.size(2))
+            logits[rows, t] = output_logits[:, 0]
+        # (b,1)
+        input = torch.argmax(output_logits, dim=2)
+        preds[rows, t] = input[:, 0]
+        active = max_lengths[rows] > t+1
+        if stop_at_eos:
+            active = active & (input[:, 0] != eosid)
+        if not active.all():
+            if not active.any():
+                break
+            keep = active.nonzero().squeeze(1)
+            rows = rows[keep]; input = input[keep]
+            hidden = tuple(h[:, keep] for h in hidden)
+    return preds, logits
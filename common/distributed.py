@@ -0,0 +1,108 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Data-parallel cpu training helpers (gloo), for trainers launched with torchrun
+# -----------------------------------------------------------
+
+import os, datetime, torch
+import torch.distributed as dist
+from collections import defaultdict
+
+
+def init_distributed(args):
+    # torchrun sets RANK, WORLD_SIZE, LOCAL_WORLD_SIZE, MASTER_ADDR and MASTER_PORT;
+    # a plain `python trainer.py` run stays single-process
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    if args.world_size > 1:
+        # ranks other than 0 wait at a barrier while rank 0 validates, so allow long waits
+        dist.init_process_group('gloo', timeout=datetime.timedelta(hours=3))
+        args.device = 'cpu'
+        # split the cores of the node between its processes
+        local_size = int(os.environ.get('LOCAL_WORLD_SIZE', args.world_size))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_size))
+    return args
+
+def is_distributed(args):
+    return getattr(args, 'world_size', 1) > 1
+
+def is_main(args):
+    # rank 0 logs, evaluates and saves checkpoints
+    return getattr(args, 'rank', 0) == 0
+
+def barrier(args):
+    if is_distributed(args):
+        dist.barrier()
+
+def broadcast_params(model, args):
+    # start every rank from the weights of rank 0
+    if is_distributed(args):
+        for prm in model.state_dict().values():
+            dist.broadcast(prm, 0)
+
+def shard(indices, args):
+    """Batches of this rank for an epoch: indices must be in the same order on all ranks (see broadcast_order).
+    Every rank gets the same number of batches so all ranks take part in every gradient all-reduce,
+    the remaining len(indices) % world_size batches are left out of the epoch"""
+    if not is_distributed(args):
+        return indices
+    n = len(indices) // args.world_size
+    return indices[args.rank::args.world_size][:n]
+
+def broadcast_order(indices, args):
+    # the batch order of rank 0 on every rank
+    if not is_distributed(args):
+        return indices
+    order = torch.tensor(indices, dtype=torch.long)
+    dist.broadcast(order, 0)
+    return order.tolist()
+
+def all_reduce_grads(model, args):
+    # average the gradients of the ranks with a single all-reduce over a flat buffer;
+    # a parameter gets a gradient if it got one on any rank, as with single-process training
+    if not is_distributed(args):
+        return
+    params = [prm for prm in model.parameters() if prm.requires_grad]
+    has_grad = torch.tensor([prm.grad is not None for prm in params], dtype=torch.int32)
+    flat = torch.cat([(prm.grad if prm.grad is not None else torch.zeros_like(prm)).reshape(-1) for prm in params])
+    dist.all_reduce(has_grad)
+    dist.all_reduce(flat)
+    flat /= args.world_size
+    offset = 0
+    for prm, got in zip(params, has_grad.tolist()):
+        n = prm.numel()
+        if got > 0:
+            grad = flat[offset:offset+n].view_as(prm)
+            if prm.grad is None:
+                prm.grad = grad.clone()
+            else:
+                prm.grad.copy_(grad)
+        offset += n
+
+def all_reduce_sums(values, args):
+    # list of python numbers summed over the ranks
+    if not is_distributed(args):
+        return values
+    sums = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    dist.all_reduce(sums)
+    return sums.tolist()
+
+def all_gather_counts(counts, args):
+    # {key: count} dicts of the ranks merged
+    if not is_distributed(args):
+        return counts
+    gathered = [None] * args.world_size
+    dist.all_gather_object(gathered, dict(counts))
+    merged = defaultdict(lambda: 0)
+    for rank_counts in gathered:
+        for key, count in rank_counts.items():
+            merged[key] += count
+    return merged
+
+
+class QuietLogger(object):
+    # Logger of the ranks other than 0
+    def write(self, message):
+        pass
+
+    def flush(self):
+        pass
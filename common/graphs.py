@@ -0,0 +1,143 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: TorchScript inference graphs of the encoder, quantizer and single-step decoder
+#              of the VQVAE, VAE and CharLM models, exported next to a checkpoint and loaded
+#              by the inference scripts (reinflection, segmentation, generation)
+# -----------------------------------------------------------
+
+import os, torch
+import torch.nn as nn
+from typing import Tuple
+
+## Inference modules, sharing the weights of an eval-mode model (dropout off, no losses).
+## They run eagerly as they are, or scripted by export_graphs.
+class VQVAEEncoderGraph(nn.Module):
+    # bidirectional VQVAE_Encoder: x (B,T) ---> fhs (B,1,2*enc_nh), mu, logvar (B,nz), fwd, bck (B,1,enc_nh)
+    def __init__(self, encoder):
+        super(VQVAEEncoderGraph, self).__init__()
+        self.embed = encoder.embed
+        self.lstm = encoder.lstm
+        self.linear = encoder.linear
+
+    def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        _, (last_state, _) = self.lstm(self.embed(x))
+        fwd = last_state[-1].unsqueeze(1)
+        bck = last_state[-2].unsqueeze(1)
+        mu, logvar = self.linear(last_state[-1]).chunk(2, -1)
+        fhs = torch.cat([last_state[-2], last_state[-1]], 1).unsqueeze(1)
+        return fhs, mu, logvar, fwd, bck
+
+class VAEEncoderGraph(nn.Module):
+    # VAE_Encoder: x (B,T) ---> mu, logvar (B,nz), last_state (B,1,*)
+    def __init__(self, encoder):
+        super(VAEEncoderGraph, self).__init__()
+        self.embed = encoder.embed
+        self.lstm = encoder.lstm
+        self.linear = encoder.linear
+        self.bidirectional = encoder.lstm.bidirectional
+
+    def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        _, (last_state, _) = self.lstm(self.embed(x))
+        if self.bidirectional:
+            last_state = torch.cat([last_state[-2], last_state[-1]], 1).unsqueeze(0)
+        mu, logvar = self.linear(last_state).chunk(2, -1)
+        return mu.squeeze(0), logvar.squeeze(0), last_state.permute(1, 0, 2)
+
+class QuantizerGraph(nn.Module):
+    """Nearest codes of all dicts of a VQVAE in one batched distance computation, as VectorQuantizer in eval
+    bck (B,1,num_dicts*D) ---> suffix_z (B,1,num_dicts*D) concatenated code vectors, codes (B,num_dicts)"""
+    def __init__(self, vq_layers):
+        super(QuantizerGraph, self).__init__()
+        # (num_dicts, K, D), a copy: graphs are for fixed weights
+        self.register_buffer('codebooks', torch.stack([vq_layer.embedding.weight.detach() for vq_layer in vq_layers]).clone())
+
+    def forward(self, bck) -> Tuple[torch.Tensor, torch.Tensor]:
+        num_dicts, K, D = self.codebooks.size()
+        # (B, num_dicts, D)
+        latents = bck[:, 0, :num_dicts*D].reshape(bck.size(0), num_dicts, D)
+        # (B, num_dicts, K)
+        dist = (latents ** 2).sum(-1, keepdim=True) + (self.codebooks ** 2).sum(-1).unsqueeze(0) - \
+               2 * torch.einsum('bnd,nkd->bnk', latents, self.codebooks)
+        codes = torch.argmin(dist, dim=-1)
+        # (B, num_dicts, D)
+        vectors = self.codebooks[torch.arange(num_dicts, device=codes.device).unsqueeze(0), codes]
+        return vectors.reshape(bck.size(0), 1, num_dicts*D), codes
+
+class DecoderStepGraph(nn.Module):
+    """LSTM decoder steps with a latent concatenated to every input: input (b,T), z (b,1,Z), h, c (1,b,H) ---> logits (b,T,V), h, c
+    T=1 in the greedy loops; Z=0 for the language model"""
+    def __init__(self, embed, lstm, pred_linear):
+        super(DecoderStepGraph, self).__init__()
+        self.embed = embed
+        self.lstm = lstm
+        self.pred_linear = pred_linear
+
+    def forward(self, input, z, h, c) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        word_embed = torch.cat((self.embed(input), z.expand(-1, input.size(1), -1)), -1)
+        output, (h, c) = self.lstm(word_embed, (h, c))
+        return self.pred_linear(output), h, c
+
+
+def model_graphs(model):
+    # name ---> inference module of the model, by model type
+    if hasattr(model, 'ord_vq_layers'):
+        graphs = {'decoder_step': DecoderStepGraph(model.decoder.embed, model.decoder.lstm, model.decoder.pred_linear)}
+        # kl_bi encoders: mu, logvar from the forward state (other variants read the concatenated states)
+        encoder = model.encoder
+        if hasattr(encoder, 'linear') and encoder.lstm.bidirectional and encoder.linear.in_features == encoder.lstm.hidden_size:
+            graphs['encoder'] = VQVAEEncoderGraph(encoder)
+        # dicts of equal size (tag-supervised variants size each dict by its tag values)
+        if len(model.ord_vq_layers) > 0 and len(set(vq_layer.embedding.weight.shape for vq_layer in model.ord_vq_layers)) == 1:
+            graphs['quantizer'] = QuantizerGraph(model.ord_vq_layers)
+        return graphs
+    if hasattr(model, 'encoder'):
+        return {'encoder': VAEEncoderGraph(model.encoder),
+                'decoder_step': DecoderStepGraph(model.decoder.embed, model.decoder.lstm, model.decoder.pred_linear)}
+    # CharLM
+    return {'decoder_step': DecoderStepGraph(model.embed, model.lstm, model.pred_linear)}
+
+def graph_path(model_path, name):
+    return model_path + '.' + name + '.ts'
+
+def export_graphs(model, model_path):
+    """Scripts the inference modules of a trained model and saves them next to its checkpoint,
+    e.g. model_path + '.decoder_step.ts'"""
+    model.eval()
+    paths = []
+    for name, graph in model_graphs(model).items():
+        scripted = torch.jit.script(graph.eval())
+        torch.jit.save(scripted, graph_path(model_path, name))
+        paths.append(graph_path(model_path, name))
+    return paths
+
+
+class Graphs(object):
+    """Inference modules of a model: the exported TorchScript graphs when they exist and are not older
+    than the checkpoint, the eager modules otherwise. Same call signatures either way:
+        encoder(x), quantizer(bck), decoder_step(input, z, h, c)
+    (encoder and quantizer only for the models model_graphs supports)
+    codes(x) runs both for the dictionary codes of words, when the model has them (quantizes)"""
+    def __init__(self, model, model_path=None, device=None):
+        device = next(model.parameters()).device if device is None else device
+        self.scripted = []
+        for name, graph in model_graphs(model).items():
+            path = None if model_path is None else graph_path(model_path, name)
+            if path is not None and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(model_path):
+                graph = torch.jit.load(path, map_location=device)
+                self.scripted.append(name)
+            setattr(self, name, graph.eval())
+        # kl_bi encoders quantize the backward state, as QuantizerGraph does
+        self.quantizes = hasattr(self, 'encoder') and hasattr(self, 'quantizer')
+
+    def codes(self, x):
+        # x (B,T) ---> mu (B,nz), suffix_z (B,1,num_dicts*D), codes (B,num_dicts); as model.vq_loss(x, 0, 'tst')
+        fhs, mu, logvar, fwd, bck = self.encoder(x)
+        suffix_z, codes = self.quantizer(bck)
+        return mu, suffix_z, codes
+
+    def step(self, z):
+        # step function of common.decoding.greedy_decode with z (B,1,Z) concatenated to every input
+        def step(input, hidden, rows):
+            logits, h, c = self.decoder_step(input, z[rows], hidden[0], hidden[1])
+            return logits, (h, c)
+        return step
@@ -0,0 +1,66 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Opt-in torch.profiler runs over a window of steps (--profile), Chrome traces and
+#              operator tables exported to the results directory of the run
+# -----------------------------------------------------------
+
+import os, torch
+from torch.profiler import profile, schedule, ProfilerActivity
+
+
+class StepProfiler(object):
+    """torch.profiler over one window of steps: steps = (wait, warmup, active), the first wait steps run
+    unprofiled, the warmup steps are traced and dropped, the active steps are recorded:
+        profiler.start()
+        for batch in batches: ...; profiler.step()
+        profiler.stop()
+    When the window ends, or at stop() if the run ends during the active steps, writes to outdir:
+        name.trace.json  Chrome trace with the python call stacks, open in chrome://tracing or ui.perfetto.dev
+        name.ops.txt     operator tables by self time: per operator, and per operator and input shapes
+    A run that stops before the active steps records nothing; stop() prints so, and no files are written.
+    Disabled (the default) every call returns at once."""
+    def __init__(self, enabled=False, outdir=None, name='profile', steps=(2, 2, 5), device='cpu'):
+        self.enabled = enabled
+        self.prof = None
+        if not enabled:
+            return
+        self.outdir = outdir
+        self.name = name
+        self.steps = 0; self.first_active = steps[0] + steps[1]
+        self.exported = False
+        os.makedirs(outdir, exist_ok=True)
+        self.cuda = torch.device(device).type == 'cuda' and torch.cuda.is_available()
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if self.cuda else [])
+        wait, warmup, active = steps
+        self.prof = profile(activities=activities, schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                            on_trace_ready=self.export, record_shapes=True, with_stack=True)
+
+    def start(self):
+        if self.prof is not None:
+            self.prof.start()
+
+    def step(self):
+        if self.prof is not None:
+            self.prof.step()
+            self.steps += 1
+
+    def stop(self):
+        if self.prof is not None:
+            self.prof.stop()
+            # the schedule only exports a window that ends or is stopped while recording
+            if not self.exported:
+                if self.steps > self.first_active:
+                    self.export(self.prof)
+                else:
+                    print('profile: stopped after %d steps, before the %d wait and warmup steps were over, nothing recorded' % (self.steps, self.first_active))
+            self.prof = None
+
+    def export(self, prof):
+        path = os.path.join(self.outdir, self.name)
+        prof.export_chrome_trace(path + '.trace.json')
+        sort_by = 'self_cuda_time_total' if self.cuda else 'self_cpu_time_total'
+        with open(path + '.ops.txt', 'w') as writer:
+            writer.write(prof.key_averages().table(sort_by=sort_by, row_limit=40) + '\n')
+            writer.write(prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=40) + '\n')
+        print('profile: ' + path + '.trace.json, ' + path + '.ops.txt')
+        self.exported = True
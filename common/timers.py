@@ -0,0 +1,100 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Per-phase wall-clock timers and throughput of the training loops (--time_phases)
+# -----------------------------------------------------------
+
+import time, torch
+from collections import OrderedDict
+from contextlib import nullcontext
+
+# returned for every phase of a disabled timer: no clock reads, no allocation
+NULL_PHASE = nullcontext()
+
+
+class _Phase(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.sync()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.sync()
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class PhaseTimer(object):
+    """Seconds spent in each phase of an epoch (data, forward, backward, optimizer, metrics, validation,
+    checkpoint, ...) and the words and tokens processed, logged once per epoch:
+        with timer.phase('forward'): ...
+        for batch in timer.iterate(batches):   # 'data': time to get each batch
+        timer.count(words, tokens)
+        timer.log(epc, writer, logger)
+    Disabled (the default) every call returns at once, the loops run as without timing.
+    On cuda the device is synchronized around each phase so kernels are charged to the phase that
+    launched them; this slows the run a little, so only enable it when measuring."""
+    def __init__(self, enabled=False, device=None):
+        self.enabled = enabled
+        self.cuda = enabled and device is not None and torch.device(device).type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.words = 0; self.tokens = 0
+        self.start = time.perf_counter()
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def add(self, name, secs):
+        self.times[name] = self.times.get(name, 0.0) + secs
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else NULL_PHASE
+
+    def iterate(self, iterable, name='data'):
+        if not self.enabled:
+            return iterable
+        return self._iterate(iterable, name)
+
+    def _iterate(self, iterable, name):
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, words, tokens):
+        # python numbers only (sizes of the batch), a tensor count would synchronize the device
+        if self.enabled:
+            self.words += words; self.tokens += tokens
+
+    def log(self, epc, writer=None, logger=None, prefix='time'):
+        # seconds per phase, the rest of the epoch as 'other', and words/sec, tokens/sec of the training phases
+        if not self.enabled:
+            return
+        total = time.perf_counter() - self.start
+        times = OrderedDict(self.times)
+        times['other'] = max(0.0, total - sum(self.times.values()))
+        # throughput over the time of the updates, validation and checkpoints left out
+        trn_secs = sum(secs for name, secs in self.times.items() if name not in ('validation', 'checkpoint')) or total
+        words_per_sec = self.words / trn_secs
+        tokens_per_sec = self.tokens / trn_secs
+        if writer is not None:
+            for name, secs in times.items():
+                writer.add_scalar(prefix+'/'+name, secs, epc)
+            writer.add_scalar(prefix+'/epoch', total, epc)
+            writer.add_scalar(prefix+'/words_per_sec', words_per_sec, epc)
+            writer.add_scalar(prefix+'/tokens_per_sec', tokens_per_sec, epc)
+        if logger is not None:
+            logger.write('\nTIME epoch: %.2fs, ' % total + ', '.join('%s: %.2fs (%.1f%%)' % (name, secs, 100 * secs / total) for name, secs in times.items()))
+            logger.write('\nwords/sec: %.1f, tokens/sec: %.1f\n' % (words_per_sec, tokens_per_sec))
+        self.reset()
@@ -196,9 +196,10 @@ def get_model_info(id, lang=None):
     return model_path, model_vocab
 
 class Logger(object):
-  def __init__(self, output_file):
+  def __init__(self, output_file, mode="w"):
+    # mode "a" keeps the log of a resumed run
     self.terminal = sys.stdout
-    self.log = open(output_file, "w")
+    self.log = open(output_file, mode)
 
   def write(self, message):
     print(message, end="", file=self.terminal, flush=True)
@@ -282,6 +283,60 @@ def log_sum_exp(value, dim=None, keepdim=False):
         return m + torch.log(sum_exp)
 
 
+def pad_candidates(vocab, candidates, device='cpu'):
+    """Encodes candidate words as one batch
+    Returns: Tensor
+        (num_candidates, max_len+2) <s> word </s> rows, padded with <pad> (0) at the end
+    """
+    data = [[vocab.word2id['<s>']] + vocab.encode_sentence(word) + [vocab.word2id['</s>']] for word in candidates]
+    max_len = max(len(d) for d in data)
+    return torch.tensor([d + [0] * (max_len - len(d)) for d in data], dtype=torch.long, device=device)
+
+def reduce_candidate_loss(loss, tgt, recon_type='sum'):
+    # loss, tgt: (num_candidates, T), padded targets (0) have zero loss ---> (num_candidates)
+    lengths = (tgt != 0).sum(-1)
+    if recon_type == 'avg':
+        # avg over tokens of each candidate
+        return loss.sum(-1) / lengths
+    elif recon_type == 'sum':
+        return loss.sum(-1)
+    elif recon_type == 'eos':
+        # only eos token of each candidate
+        return loss.gather(1, (lengths - 1).unsqueeze(1)).squeeze(1)
+
+def prefix_log_likelihoods(logits, x, eosid, recon_type='avg'):
+    """Log-likelihoods of all prefixes of the words in x, each closed with </s>,
+    read off the next-token logits of one causal pass over the full words
+    Args:
+        logits: (batch_size, T-1, vocab_size) next-token logits of x[:, :-1]
+        x: (batch_size, T) <s> word </s> rows, right padded
+    Returns: Tensor
+        (batch_size, T-2), column k-1: log p(<s> w_1..w_k </s>), valid up to each word's own length
+    """
+    log_probs = torch.log_softmax(logits, dim=-1)
+    # log p(w_{k} | <s> w_1..w_{k-1}), k = 1..T-2
+    char_lp = log_probs[:, :-1].gather(2, x[:, 1:-1].unsqueeze(2)).squeeze(2)
+    # log p(</s> | <s> w_1..w_k), k = 1..T-2
+    eos_lp = log_probs[:, 1:, eosid]
+    if recon_type == 'eos':
+        return eos_lp
+    prefix_lp = char_lp.cumsum(dim=1) + eos_lp
+    if recon_type == 'avg':
+        # avg over the k chars and </s>
+        num_tokens = torch.arange(2, x.size(1), device=x.device, dtype=prefix_lp.dtype)
+        prefix_lp = prefix_lp / num_tokens
+    return prefix_lp
+
+
+def generate_grid(zmin, zmax, dz, device='cpu', ndim=2):
+    """Grid points for posterior evaluation of small-nz models
+    Returns: Tensor
+        (k^ndim, ndim) points, k = (zmax - zmin)/dz
+    """
+    axis = torch.arange(zmin, zmax, dz, device=device)
+    return torch.cartesian_prod(*([axis] * ndim)).view(-1, ndim)
+
+
 '''lines = []
 with open('trn_4x10.txt', 'r') as reader:
     for line in reader:
@@ -7,9 +7,12 @@
 from common.vocab import VocabEntry
 from model.charlm.charlm import CharLM
 from common.utils import *
+from common.profiling import StepProfiler
 import sys, argparse, random, torch, json, matplotlib, os
 import numpy as np
 from data.data import build_data
+from score_cache import ScoreCache
+from parallel_scoring import ShardedScorer
 from collections import OrderedDict
 
 
@@ -62,22 +65,37 @@ def get_logps(args, word, data, from_file=False):
             logps = json.load(json_file)
             return logps[word]
     else:    
+        return get_logps_batched(args, [data[0][1:-1].tolist()])[0]
+
+# returns likelihoods of all subwords of many words, one forward pass per batch of padded words
+def get_logps_batched(args, words):
+    bosid = args.vocab.word2id['<s>']; eosid = args.vocab.word2id['</s>']
+    curves = []
+    for i in range(0, len(words), args.prefix_batchsize):
+        batch = words[i:i+args.prefix_batchsize]
+        max_len = max(len(ids) for ids in batch)
+        x = torch.tensor([[bosid] + ids + [eosid] + [0] * (max_len - len(ids)) for ids in batch], dtype=torch.long, device=args.device)
         with torch.no_grad():
-            logps = dict()
-            logps[word] = np.exp(args.model.log_probability(data, args.recon_type).item())
-            # loop through word's subwords 
-            for i in range(len(data[0])-2, 1, -1):
-                eos  = torch.tensor([2]).to(args.device)
-                subdata = torch.cat([data[0][:i], eos])
-                subword = ''.join(args.vocab.decode_sentence(subdata[1:-1]))
-                logps[subword] = np.exp(args.model.log_probability(subdata.unsqueeze(0),  args.recon_type).item())
-        logps = dict(reversed(list(logps.items())))
-        return logps
+            probs = np.exp(args.model.prefix_logprobs(x, args.recon_type).tolist())
+        for ids, word_probs in zip(batch, probs):
+            curves.append({''.join(args.vocab.decode_sentence_2(ids[:k])): word_probs[k-1] for k in range(1, len(ids)+1)})
+    return curves
+
+
+# get_logps_batched in chunks of args.profile_words words, one profiler step each
+def get_logps_in_steps(args, words):
+    logps = []
+    for i in range(0, len(words), args.profile_words):
+        logps += get_logps_batched(args, words[i:i+args.profile_words])
+        args.profiler.step()
+    return logps
 
 
 def config():
      # CONFIG
     parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+    parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
     args = parser.parse_args()
     args.device = 'cuda'
     model_id = 'charlm_segm'
@@ -91,6 +109,16 @@ def config():
     args.fseg   = args.logdir +'segments.txt'
     args.fprob  = args.logdir +'probs.json'
     args.load_probs_from_file = False; args.save_probs_to_file = not args.load_probs_from_file
+    # subword likelihoods are kept in a score cache keyed by checkpoint, scoring mode and word
+    args.model_path = model_path
+    args.fcache = 'evaluation/morph_segmentation/results/scores.db'
+    args.score_mode = 'charlm/'+args.recon_type
+    # words are scored by a pool of forked workers on cpu (one process on cuda)
+    args.num_workers = os.cpu_count()
+    # profiled runs score in this process, one step per args.profile_words words
+    args.profile_words = 64
+    if args.profile:
+        args.num_workers = 1
     try:
         os.makedirs(args.logdir)
         print("Directory " , args.logdir ,  " Created ") 
@@ -111,10 +139,13 @@ def config():
     args.model.load_state_dict(torch.load(model_path))
     args.model.to(args.device)
     args.model.eval()
+    args.profiler = StepProfiler(args.profile, args.logdir+'profile/', 'segment', args.profile_steps, args.device)
     # data
     args.tstdata = 'evaluation/morph_segmentation/data/goldstd_mc05-10aggregated.segments.tur'
     args.maxtstsize = 40000
     args.batch_size = 1
+    # number of words scored in one forward pass
+    args.prefix_batchsize = 512
     return args
 
 def main():
@@ -122,11 +153,23 @@ def main():
     data, batches = build_data(args)
     word_probs = dict()
     fseg = open(args.fseg, 'w')
+    words = [''.join(args.vocab.decode_sentence(data[0][1:-1])) for data in batches]
+    args.profiler.start()
+    if not args.load_probs_from_file:
+        # only the words missing from the score cache are run through the model
+        cache = ScoreCache(args.fcache, args.model_path, args.score_mode)
+        score_fn = get_logps_in_steps if args.profile else get_logps_batched
+        scorer = ShardedScorer(lambda seqs: score_fn(args, seqs), args.num_workers, args.device)
+        cache.fill(words, [data[0][1:-1].tolist() for data in batches], scorer)
+        scorer.close()
+    args.profiler.stop()
     # loop through each word 
-    for data in batches:
-        word = ''.join(args.vocab.decode_sentence(data[0][1:-1]))
+    for word, data in zip(words, batches):
         print(word)
-        logps = get_logps(args, word, data, from_file=args.load_probs_from_file)
+        if args.load_probs_from_file:
+            logps = get_logps(args, word, data, from_file=True)
+        else:
+            logps = cache.get(word)
         word_probs[word] = logps
         # call segmentation heuristic 
         if args.heur_type == 'prev_mid_next':
@@ -0,0 +1,180 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Sweeps the segmentation heuristics over a grid of eps values on cached
+#              prefix curves, scored in-process like evaluation.perl
+# -----------------------------------------------------------
+
+from common.utils import *
+import sys, argparse, json, os
+import numpy as np
+from score_cache import ScoreCache
+
+## Heuristics on padded curves: probs (W, L) likelihoods of the prefixes of each word, shortest first,
+## nan after the word. Boundary masks (E, W, L): [e,w,i] is a boundary after the first i+1 chars,
+## same conditions as heur_* of the segmentation scripts (a boundary needs > 2 chars and a next prefix)
+def _neighbours(probs):
+    prev = np.full_like(probs, np.nan); nex = np.full_like(probs, np.nan)
+    prev[:, 1:] = probs[:, :-1]; nex[:, :-1] = probs[:, 1:]
+    # a boundary needs a prefix of > 2 chars and a next prefix
+    valid = ~np.isnan(nex)
+    valid[:, :2] = False
+    return prev, nex, valid
+
+def mask_prev_mid_next(probs, eps_grid):
+    prev, nex, valid = _neighbours(probs)
+    eps = np.asarray(eps_grid, dtype=probs.dtype)[:, None, None]
+    with np.errstate(invalid='ignore'):
+        return (probs > prev + eps) & (probs > nex) & valid
+
+def mask_prev_mid_next_and_prevnext_exceed(probs, eps_grid):
+    prev, nex, valid = _neighbours(probs)
+    with np.errstate(invalid='ignore'):
+        exceed = (probs > (prev + nex) / 2) & valid
+    return mask_prev_mid_next(probs, eps_grid) | exceed
+
+def mask_reinflection(probs, eps_grid):
+    _, _, valid = _neighbours(probs)
+    return np.broadcast_to((probs == 1) & valid, (len(eps_grid),) + probs.shape)
+
+HEURISTICS = {'prev_mid_next': mask_prev_mid_next,
+              'prev_mid_next_and_prevnext_exceed': mask_prev_mid_next_and_prevnext_exceed,
+              'reinflection': mask_reinflection}
+
+def curve_arrays(curves):
+    # list of {subword: likelihood} (shortest first, full word last) ---> probs (W, L), nan padded
+    L = max(len(curve) for curve in curves)
+    probs = np.full((len(curves), L), np.nan)
+    for w, curve in enumerate(curves):
+        probs[w, :len(curve)] = list(curve.values())
+    return probs
+
+def segment(word, mask):
+    # mask (L,) of one word ---> morphemes
+    cuts = [0] + [i+1 for i in np.flatnonzero(mask)] + [len(word)]
+    return [word[s:e] for s, e in zip(cuts[:-1], cuts[1:])]
+
+
+## Gold standard
+def read_gold(fname):
+    # word ---> boundary positions of each alternative analysis, e.g. 'CIk amIyor um' ---> {3, 9}
+    gold = dict()
+    with open(fname, 'r') as reader:
+        for line in reader:
+            word, analyses = line.rstrip('\n').rstrip('\r').split('\t')
+            alternatives = []
+            for analysis in analyses.split(', '):
+                morphs = analysis.strip().split(' ')
+                alternatives.append(set(np.cumsum([len(m) for m in morphs[:-1]]).tolist()))
+            gold[word] = alternatives
+    return gold
+
+def gold_arrays(words, gold, L):
+    # ---> boundaries (A, W, L) of each alternative, and which alternatives exist (A, W)
+    A = max(len(gold[word]) for word in words)
+    boundaries = np.zeros((A, len(words), L), dtype=bool)
+    exists = np.zeros((A, len(words)), dtype=bool)
+    for w, word in enumerate(words):
+        for a, cuts in enumerate(gold[word]):
+            exists[a, w] = True
+            boundaries[a, w, [c-1 for c in cuts]] = True
+    return boundaries, exists
+
+def boundary_scores(masks, boundaries, exists):
+    """Boundary precision/recall/F1 of every eps, as evaluation.perl: each word counts
+    the hits/insertions/deletions of its best alternative (highest F, then precision)
+    Args:
+        masks: (E, W, L) suggested boundaries, boundaries: (A, W, L), exists: (A, W)
+    Returns:
+        precision, recall, f1: (E,)
+    """
+    E, W, _ = masks.shape
+    best = np.zeros((3, E, W)); best_f = np.zeros((E, W)); best_p = np.zeros((E, W))
+    n_sug = masks.sum(-1)
+    for a in range(boundaries.shape[0]):
+        hits = (masks & boundaries[a][None]).sum(-1)
+        ins  = n_sug - hits
+        dels = boundaries[a].sum(-1)[None] - hits
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p = np.where(hits + ins > 0, hits / (hits + ins), 1.0)
+            f = np.where(hits + ins + dels > 0, 2*hits / (2*hits + ins + dels), 1.0)
+        take = ((f > best_f) | ((f == best_f) & (p >= best_p))) & exists[a][None]
+        best_f = np.where(take, f, best_f); best_p = np.where(take, p, best_p)
+        best = np.where(take[None], np.stack((hits, ins, dels)), best)
+    hits, ins, dels = best.sum(-1)
+    precision = np.where(hits + ins > 0, hits / np.maximum(hits + ins, 1), 1.0)
+    recall = np.where(hits + dels > 0, hits / np.maximum(hits + dels, 1), 1.0)
+    f1 = np.where(hits + ins + dels > 0, 2*hits / np.maximum(2*hits + ins + dels, 1), 1.0)
+    return precision, recall, f1
+
+def sweep(words, curves, gold, eps_grid, heur_types=tuple(HEURISTICS)):
+    # every (heuristic, eps) of the grid on the words of the gold standard ---> list of result dicts
+    keep = [w for w, word in enumerate(words) if word in gold]
+    words = [words[w] for w in keep]
+    probs = curve_arrays([curves[w] for w in keep])
+    boundaries, exists = gold_arrays(words, gold, probs.shape[1])
+    results = []
+    for heur_type in heur_types:
+        masks = HEURISTICS[heur_type](probs, eps_grid)
+        precision, recall, f1 = boundary_scores(masks, boundaries, exists)
+        for e, eps in enumerate(eps_grid):
+            results.append({'heur_type': heur_type, 'eps': float(eps), 'precision': float(precision[e]),
+                            'recall': float(recall[e]), 'f1': float(f1[e])})
+    return results
+
+
+def config():
+     # CONFIG
+    parser = argparse.ArgumentParser(description='')
+    args = parser.parse_args()
+    # curves of a segmentation run: probs.json of the run, or the score cache of its checkpoint and scoring mode
+    model_id = 'charlm_segm'
+    model_path, model_vocab  = get_model_info(model_id)
+    args.model_path = model_path
+    args.fcache = 'evaluation/morph_segmentation/results/scores.db'
+    args.score_mode = 'charlm/avg'
+    args.fprob = None
+    # grid
+    args.heur_types = list(HEURISTICS)
+    args.eps_grid = np.round(np.linspace(0.0, 0.1, 101), 4)
+    # data
+    args.tstdata = 'evaluation/morph_segmentation/data/goldstd_mc05-10aggregated.segments.tur'
+    # logging
+    args.logdir = 'evaluation/morph_segmentation/results/sweep/'+model_id+'/'+args.score_mode+'/'
+    args.fsweep = args.logdir + 'sweep.tsv'
+    args.fseg   = args.logdir + 'best_segments.txt'
+    try:
+        os.makedirs(args.logdir)
+        print("Directory " , args.logdir ,  " Created ")
+    except FileExistsError:
+        print("Directory " , args.logdir ,  " already exists")
+    return args
+
+def main():
+    args = config()
+    gold = read_gold(args.tstdata)
+    if args.fprob is not None:
+        with open(args.fprob, 'r') as json_file:
+            word_curves = json.load(json_file)
+    else:
+        cache = ScoreCache(args.fcache, args.model_path, args.score_mode)
+        word_curves = {word: cache.get(word) for word in gold}
+        cache.close()
+    words = [word for word in gold if word_curves.get(word) is not None]
+    print('words with curves: %d/%d' % (len(words), len(gold)))
+    curves = [word_curves[word] for word in words]
+    results = sweep(words, curves, gold, args.eps_grid, args.heur_types)
+    results.sort(key=lambda r: -r['f1'])
+    with open(args.fsweep, 'w') as writer:
+        writer.write('heur_type\teps\tprecision\trecall\tf1\n')
+        for r in results:
+            writer.write('%s\t%.4f\t%.4f\t%.4f\t%.4f\n' % (r['heur_type'], r['eps'], r['precision'], r['recall'], r['f1']))
+    best = results[0]
+    print('best: %s eps=%.4f precision=%.4f recall=%.4f f1=%.4f' % (best['heur_type'], best['eps'], best['precision'], best['recall'], best['f1']))
+    # segments of the best configuration, in the format read by evaluation.perl
+    masks = HEURISTICS[best['heur_type']](curve_arrays(curves), [best['eps']])[0]
+    with open(args.fseg, 'w') as fseg:
+        for word, mask in zip(words, masks):
+            fseg.write(' '.join(segment(word, mask))+'\n')
+
+if __name__=="__main__":
+    main()
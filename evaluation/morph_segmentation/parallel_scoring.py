@@ -0,0 +1,47 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Process-pool scoring of word lists for the segmentation scripts
+# -----------------------------------------------------------
+
+import multiprocessing, torch
+
+# scoring function of the parent, inherited by the forked workers (never pickled)
+_score_fn = None
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+def _score_shard(shard):
+    return _score_fn(shard)
+
+
+class ShardedScorer(object):
+    """Splits a word list into contiguous shards scored by a pool of forked workers.
+    The model is loaded once in the parent; workers share its weights copy-on-write,
+    and pool.map returns the shards in order so the merged scores follow the input order.
+    Only used on cpu, cuda contexts can not be forked, so other devices score in process."""
+    def __init__(self, score_fn, num_workers, device='cpu', num_threads=None, shards_per_worker=4):
+        self.score_fn = score_fn
+        self.num_workers = num_workers if str(device) == 'cpu' else 1
+        # split the cores of the parent between the workers
+        self.num_threads = num_threads or max(1, torch.get_num_threads() // max(1, self.num_workers))
+        self.shards_per_worker = shards_per_worker
+        self.pool = None
+
+    def __call__(self, seqs):
+        # seqs: char ids of each word ---> list of scores, in the order of seqs
+        if self.num_workers <= 1 or len(seqs) <= 1:
+            return self.score_fn(seqs)
+        if self.pool is None:
+            global _score_fn
+            _score_fn = self.score_fn
+            self.pool = multiprocessing.get_context('fork').Pool(self.num_workers, initializer=_init_worker, initargs=(self.num_threads,))
+        num_shards = min(len(seqs), self.num_workers * self.shards_per_worker)
+        size = -(-len(seqs) // num_shards)
+        shards = [seqs[i:i+size] for i in range(0, len(seqs), size)]
+        return [score for shard_scores in self.pool.map(_score_shard, shards) for score in shard_scores]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close(); self.pool.join()
+            self.pool = None
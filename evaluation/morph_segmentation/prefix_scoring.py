@@ -0,0 +1,66 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Batched prefix scoring front-end for the latent-variable segmenters
+# -----------------------------------------------------------
+
+import torch
+from model.vqvae.vqvae_shared_task import length_batches
+
+
+def expand_prefixes(vocab, words):
+    # words: char ids of each word (without <s>, </s>)
+    # all prefixes (1..len chars) of each word, closed with </s>; the full word is the last prefix
+    # returns subwords, encoded rows and the index of the source word of each row
+    bosid = vocab.word2id['<s>']; eosid = vocab.word2id['</s>']
+    subwords = []; data = []; src = []
+    for w, ids in enumerate(words):
+        for i in range(1, len(ids)+1):
+            subwords.append(''.join(vocab.decode_sentence_2(ids[:i])))
+            data.append([bosid] + ids[:i] + [eosid])
+            src.append(w)
+    return subwords, data, src
+
+def length_tensor_batches(data, batchsize, device):
+    # equal-length rows only, the encoders read their last states so rows must not be padded
+    for inds in length_batches(data, batchsize):
+        yield inds, torch.tensor([data[i] for i in inds], dtype=torch.long, device=device)
+
+def encode_words(vocab, words, encode_fn, batchsize=512, device='cpu'):
+    """Encodes words in batches, e.g. for latents shared by all prefixes of a word (word_given)
+    Args:
+        words: char ids of each word (without <s>, </s>)
+        encode_fn: function x (B,T) ---> tuple of tensors with batch first
+    Returns:
+        tuple of tensors (num_words, ...), rows in the order of words
+    """
+    bosid = vocab.word2id['<s>']; eosid = vocab.word2id['</s>']
+    data = [[bosid] + ids + [eosid] for ids in words]
+    outs = None
+    with torch.no_grad():
+        for inds, x in length_tensor_batches(data, batchsize, device):
+            batch_outs = encode_fn(x)
+            if outs is None:
+                outs = tuple(out.new_zeros((len(data),) + out.shape[1:]) for out in batch_outs)
+            for out, batch_out in zip(outs, batch_outs):
+                out[inds] = batch_out
+    return outs
+
+def prefix_logps(vocab, words, score_fn, batchsize=512, device='cpu'):
+    """Scores all prefixes of many words in a few large batches
+    Args:
+        words: char ids of each word (without <s>, </s>)
+        score_fn: function (x (B,T), src (B,)) ---> (B,) scores, src: index of the source word
+                  of each row, to pick latents shared by the prefixes of a word (word_given)
+    Returns:
+        list of per-word {subword: score} dicts, shortest prefix first and the full word last
+    """
+    subwords, data, src = expand_prefixes(vocab, words)
+    src = torch.tensor(src, dtype=torch.long, device=device)
+    scores = torch.zeros(len(data))
+    with torch.no_grad():
+        for inds, x in length_tensor_batches(data, batchsize, device):
+            scores[inds] = score_fn(x, src[inds]).float().cpu()
+    curves = [dict() for _ in words]
+    for subword, w, score in zip(subwords, src.tolist(), scores.tolist()):
+        curves[w][subword] = score
+    return curves
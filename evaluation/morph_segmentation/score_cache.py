@@ -0,0 +1,64 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: On-disk store of subword likelihoods for the segmentation heuristics
+# -----------------------------------------------------------
+
+import hashlib, json, sqlite3
+
+
+def checkpoint_hash(model_path, chunksize=1<<20):
+    # content hash of a checkpoint file, so renamed/copied checkpoints share their scores
+    sha = hashlib.sha1()
+    with open(model_path, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(chunksize), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ScoreCache(object):
+    """SQLite store of per-word subword likelihoods, keyed by (checkpoint hash, scoring mode, word).
+    Runs only add the words that are missing, and heuristics read the words they need lazily."""
+    def __init__(self, fname, model_path, mode):
+        self.conn = sqlite3.connect(fname)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scores (model TEXT, mode TEXT, word TEXT, logps TEXT, PRIMARY KEY (model, mode, word))')
+        self.conn.commit()
+        self.model = checkpoint_hash(model_path)
+        self.mode = mode
+
+    def get(self, word):
+        # {subword: likelihood}, shortest subword first; None if the word is not scored yet
+        row = self.conn.execute('SELECT logps FROM scores WHERE model=? AND mode=? AND word=?', (self.model, self.mode, word)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def missing(self, words):
+        # words without scores, in their first-seen order
+        rows = self.conn.execute('SELECT word FROM scores WHERE model=? AND mode=?', (self.model, self.mode))
+        scored = set(row[0] for row in rows)
+        new_words = []
+        for word in words:
+            if word not in scored:
+                new_words.append(word)
+                scored.add(word)
+        return new_words
+
+    def put_many(self, items):
+        # items: (word, {subword: likelihood}) pairs
+        self.conn.executemany('INSERT OR REPLACE INTO scores VALUES (?,?,?,?)',
+                              [(self.model, self.mode, word, json.dumps(logps)) for word, logps in items])
+        self.conn.commit()
+
+    def fill(self, words, seqs, score_fn, chunksize=1000):
+        """Scores the missing words in chunks, committing after each, so interrupted runs keep their progress
+        Args:
+            seqs: char ids of each word (without <s>, </s>)
+            score_fn: function list of char ids ---> list of {subword: likelihood}
+        """
+        ids = dict(zip(words, seqs))
+        new_words = self.missing(words)
+        for i in range(0, len(new_words), chunksize):
+            chunk = new_words[i:i+chunksize]
+            self.put_many(zip(chunk, score_fn([ids[word] for word in chunk])))
+        return len(new_words)
+
+    def close(self):
+        self.conn.close()
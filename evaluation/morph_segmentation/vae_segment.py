@@ -7,9 +7,13 @@
 from common.vocab import VocabEntry
 from model.vae.vae import VAE
 from common.utils import *
+from common.profiling import StepProfiler
 import sys, argparse, random, torch, json, matplotlib, os
 import numpy as np
 from data.data import build_data
+from score_cache import ScoreCache
+from parallel_scoring import ShardedScorer
+from prefix_scoring import encode_words, prefix_logps
 from collections import OrderedDict
 
 # heur2: detects morpheme boundary if: 
@@ -62,32 +66,26 @@ def get_logps(args, word, data, from_file=False):
             logps = json.load(json_file)
             return logps[word]
     else:    
-        with torch.no_grad():
-            logps = dict()
-            mu, logvar, _ = args.model.encoder(data)
-            param = (mu,logvar,_)
-            z = args.model.reparameterize(mu, logvar, args.nsamples)
-            logpx = args.model.nll_iw(data, args.nsamples, z, param, args.recon_type)
-            logpx = torch.mean(logpx).item()
-            logps[word] = logpx
-            # loop through word's subwords 
-            for i in range(len(data[0])-2, 1, -1):
-                eos  = torch.tensor([2]).to(args.device)
-                subdata = torch.cat([data[0][:i], eos])
-                subword = ''.join(args.vocab.decode_sentence(subdata[1:-1]))
-                if args.sample_type == 'subword_given':# sample z from subword 
-                    mu, logvar, _ = args.model.encoder(subdata.unsqueeze(0))
-                    param = (mu,logvar,_)
-                    z = args.model.reparameterize(mu, logvar, args.nsamples)
-                    logpx = args.model.nll_iw(subdata.unsqueeze(0), args.nsamples, z, param, args.recon_type)
-                    logpx = torch.mean(logpx).item()
-                else:
-                    # sample z from full word (i.e. word_given)
-                    logpx = args.model.nll_iw(subdata.unsqueeze(0), args.nsamples, z, param, args.recon_type)
-                    logpx = torch.mean(logpx).item()
-                logps[subword] = logpx #"{:.3f}".format(logpx)
-        logps = dict(reversed(list(logps.items())))
-        return logps
+        return get_logps_batched(args, [data[0][1:-1].tolist()])[0]
+
+# returns log likelihoods of all subwords of many words, scored in a few large batches
+def get_logps_batched(args, words):
+    def encode(x):
+        mu, logvar, _ = args.model.encoder(x)
+        return mu, logvar, args.model.reparameterize(mu, logvar, args.nsamples)
+    if args.sample_type == 'word_given':
+        # z samples of each full word, shared by all its subwords
+        word_mu, word_logvar, word_z = encode_words(args.vocab, words, encode, args.prefix_batchsize, args.device)
+    def score(x, src):
+        if args.sample_type == 'subword_given':# sample z from subword, drawn in chunks by nll_iw
+            mu, logvar, _ = args.model.encoder(x)
+            z = None
+        else:
+            # sample z from full word (i.e. word_given)
+            mu, logvar, z = word_mu[src], word_logvar[src], word_z[src]
+        param = (mu, logvar, None)
+        return args.model.nll_iw(x, args.nsamples, z, param, args.recon_type)
+    return prefix_logps(args.vocab, words, score, args.prefix_batchsize, args.device)
 
 
 # returns log likelihood of given word subwords and all
@@ -125,9 +123,20 @@ def get_logps_matrix(args, word, data, from_file=False):
         return matrix
 
 
+# get_logps_batched in chunks of args.profile_words words, one profiler step each
+def get_logps_in_steps(args, words):
+    logps = []
+    for i in range(0, len(words), args.profile_words):
+        logps += get_logps_batched(args, words[i:i+args.profile_words])
+        args.profiler.step()
+    return logps
+
+
 def config():
      # CONFIG
     parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+    parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
     args = parser.parse_args()
     args.device = 'cuda'
     model_id = 'vae_segm'
@@ -144,6 +153,16 @@ def config():
     args.fseg   = args.logdir +'segments.txt'
     args.fprob  = args.logdir +'probs.json'
     args.load_probs_from_file = False; args.save_probs_to_file = not args.load_probs_from_file
+    # subword likelihoods are kept in a score cache keyed by checkpoint, scoring mode and word
+    args.model_path = model_path
+    args.fcache = 'evaluation/morph_segmentation/results/scores.db'
+    args.score_mode = 'vae/'+args.recon_type+'/'+args.sample_type+'/'+str(args.nsamples)
+    # words are scored by a pool of forked workers on cpu (one process on cuda)
+    args.num_workers = os.cpu_count()
+    # profiled runs score in this process, one step per args.profile_words words
+    args.profile_words = 64
+    if args.profile:
+        args.num_workers = 1
     try:
         os.makedirs(args.logdir)
         print("Directory " , args.logdir ,  " Created ") 
@@ -164,11 +183,14 @@ def config():
     args.model.load_state_dict(torch.load(model_path))
     args.model.to(args.device)
     args.model.eval()
+    args.profiler = StepProfiler(args.profile, args.logdir+'profile/', 'segment', args.profile_steps, args.device)
     # data
     #args.tstdata = 'evaluation/morph_segmentation/data/goldstdsample.tur'
     args.tstdata = 'evaluation/morph_segmentation/data/goldstd_mc05-10aggregated.segments.tur'
     args.maxtstsize = 100000
     args.batch_size = 1
+    # number of subwords scored in one forward pass
+    args.prefix_batchsize = 8
     return args
 
 def main():
@@ -176,11 +198,23 @@ def main():
     data, batches = build_data(args)
     word_probs = dict()
     fseg = open(args.fseg, 'w')
+    words = [''.join(args.vocab.decode_sentence(data[0][1:-1])) for data in batches]
+    args.profiler.start()
+    if not args.load_probs_from_file:
+        # only the words missing from the score cache are run through the model
+        cache = ScoreCache(args.fcache, args.model_path, args.score_mode)
+        score_fn = get_logps_in_steps if args.profile else get_logps_batched
+        scorer = ShardedScorer(lambda seqs: score_fn(args, seqs), args.num_workers, args.device)
+        cache.fill(words, [data[0][1:-1].tolist() for data in batches], scorer)
+        scorer.close()
+    args.profiler.stop()
     # loop through each word 
-    for data in batches:
-        word = ''.join(args.vocab.decode_sentence(data[0][1:-1]))
+    for word, data in zip(words, batches):
         print(word)
-        logps = get_logps(args, word, data, from_file=args.load_probs_from_file)
+        if args.load_probs_from_file:
+            logps = get_logps(args, word, data, from_file=True)
+        else:
+            logps = cache.get(word)
         word_probs[word] = logps
         # call segmentation heuristic 
         if args.heur_type == 'prev_mid_next_and_prevnext_exceed':
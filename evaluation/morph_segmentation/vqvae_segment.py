@@ -5,57 +5,79 @@
 # -----------------------------------------------------------
 
 from common.vocab import VocabEntry
-from model.vqvae.vqvae import VQVAE
+from model.vqvae.vqvae_kl_bi import VQVAE
 from common.utils import *
+from common.decoding import greedy_decode, source_length_cap
+from common.graphs import Graphs, export_graphs
+from common.profiling import StepProfiler
 import sys, argparse, random, torch, json, matplotlib, os
 import numpy as np
 from data.data import build_data
+from score_cache import ScoreCache
+from parallel_scoring import ShardedScorer
+from prefix_scoring import encode_words, expand_prefixes, length_tensor_batches, prefix_logps
 from collections import OrderedDict
 
 # heur3: detects morpheme boundary if: 
-#        (1) the model cannot copy the word correctly (indicating that the sub word is not valid)
+#        (1) the model copies the subword correctly (a subword that can not be copied is not valid)
+#        (2) the continuous root (z_to_dec(mu)) of the subword is within args.root_dist (L2) of the root of the full word,
+#            standing in for the original same-root-code check, which this continuous root does not have.
+#            --root_dist inf checks copying only, which is not the original heuristic and over-segments
 def heur_check_copying(args, word):
-    def copy(args, word):
-        x = torch.tensor([args.vocab.word2id['<s>']] + args.vocab.encode_sentence(word) + [args.vocab.word2id['</s>']]).unsqueeze(0)
-        bosid = args.vocab.word2id['<s>']
-        input = torch.tensor(bosid)
-        sft = nn.Softmax(dim=1)
-        quantized_inputs, vq_loss, quantized_inds, encoder_fhs = args.model.vq_loss(x, 0)
-        root_z, suffix_z = quantized_inputs
-        c_init = root_z
-        h_init = torch.tanh(c_init)
-        decoder_hidden = (c_init, h_init)
-        copied = []; i = 0
-        while True:
-            # (1,1,ni)
-            word_embed = args.model.decoder.embed(torch.tensor([input]).unsqueeze(0))
-            word_embed = torch.cat((word_embed, suffix_z), -1)
-            # output: (1,1,dec_nh)
-            output, decoder_hidden = args.model.decoder.lstm(word_embed, decoder_hidden)
-            # (1, vocab_size)
-            output_logits = args.model.decoder.pred_linear(output).squeeze(1)
-            input = torch.argmax(sft(output_logits)) 
-            char = args.vocab.id2word(input.item())
-            copied.append(char)
-            if char == '</s>':
-                #print(''.join(copied))
-                return ''.join(copied), quantized_inds
-            
-    morphemes = []
-    prev_word = ''
-    root_id = copy(args, word)[1][0][0][0].item()
-    for i in range(1,len(word)+1):
-        copied_word, subword_root_id = copy(args, word[:i])
-        subword_root_id = subword_root_id[0][0][0].item()
-        if subword_root_id == root_id and word[:i]+'</s>' == copied_word and len(word[:i]) >2:
-            morphemes.append(word[:i][len(prev_word):])
-            prev_word = word[:i]
+    return heur_check_copying_batched(args, [args.vocab.encode_sentence(word)])[0]
 
+def copy_check(args, data):
+    # data: encoded rows ([<s>] + chars + [</s>]) ---> whether each row is copied exactly (N,), its root z_to_dec(mu) (N,dec_nh)
+    bosid = args.vocab.word2id['<s>']; eosid = args.vocab.word2id['</s>']
+    copied = torch.zeros(len(data), dtype=torch.bool)
+    roots  = None
+    with torch.no_grad():
+        for inds, x in length_tensor_batches(data, args.prefix_batchsize, args.device):
+            if args.graphs.quantizes:
+                # scripted encoder and quantizer when exported
+                mu, suffix_z, _ = args.graphs.codes(x)
+                # (1,B,dec_nh)
+                root_z = args.model.z_to_dec(mu.unsqueeze(0))
+            else:
+                quantized_inputs, _, _, _, _, _, _, _ = args.model.vq_loss(x, 0, 'tst')
+                root_z, suffix_z = quantized_inputs
+                # (1,B,dec_nh)
+                root_z = root_z.permute((1,0,2))
+            # (b,1,ni+incat) inputs, scripted step when exported
+            step = args.graphs.step(suffix_z)
+            input = torch.full((x.size(0), 1), bosid, dtype=torch.long, device=x.device)
+            # all prefixes of a batch decode in lockstep, each stops at </s> or at a cap derived from its length
+            max_lengths = source_length_cap(torch.full((x.size(0),), x.size(1)-1, dtype=torch.long))
+            preds, _ = greedy_decode(step, (torch.tanh(root_z), root_z), input, eosid, max_lengths, padid=eosid)
+            # copied if the first predictions are the chars followed by </s>
+            copied[inds] = (preds[:, :x.size(1)-1] == x[:, 1:]).all(dim=1).cpu()
+            if roots is None:
+                roots = torch.zeros(len(data), root_z.size(-1))
+            roots[inds] = root_z[0].cpu()
+            args.profiler.step()
+    return copied, roots
+
+def heur_check_copying_batched(args, words):
+    # words: char ids of each word (without <s>, </s>) ---> morphemes of each word
+    subwords, data, src = expand_prefixes(args.vocab, words)
+    copied, roots = copy_check(args, data)
+    src = torch.tensor(src, dtype=torch.long)
+    # the full word is the last prefix of each word
+    last = torch.tensor(np.cumsum([len(ids) for ids in words]) - 1, dtype=torch.long)
+    lengths = torch.tensor([len(row)-2 for row in data], dtype=torch.long)
+    boundary = copied & (lengths > 2)
+    boundary &= (roots - roots[last][src]).norm(dim=1) <= args.root_dist
+    morphemes = [[] for _ in words]
+    prev_lengths = [0] * len(words)
+    for w, length in zip(src[boundary].tolist(), lengths[boundary].tolist()):
+        word = subwords[last[w]]
+        morphemes[w].append(word[prev_lengths[w]:length])
+        prev_lengths[w] = length
     # add full word if missing
-    last_morph = word[len(prev_word):]
-    if len(last_morph) != 0:
-        morphemes.append(last_morph)
-    #print(morphemes)
+    for w in range(len(words)):
+        word = subwords[last[w]]
+        if prev_lengths[w] != len(word):
+            morphemes[w].append(word[prev_lengths[w]:])
     return morphemes
 
 
@@ -151,22 +173,24 @@ def get_logps_2(args, word, data, from_file=False):
             logps = json.load(json_file)
             return logps[word]
     else:    
-        with torch.no_grad():
-            root_fhs, fcs, z = args.model.encoder(data)
-            #quantized_input_root, vq_loss, quantized_inds = args.model.vq_layer_root(root_fhs,0)
-            logps = dict()
-            logps[word] = np.exp(args.model.log_probability_w_recon(data, root_fhs, args.recon_type))
-            # loop through word's subwords 
-            for i in range(len(data[0])-2, 1, -1):
-                eos  = torch.tensor([2]).to(args.device)
-                subdata = torch.cat([data[0][:i], eos])
-                subword = ''.join(args.vocab.decode_sentence(subdata[1:-1]))
-                if args.sample_type == 'subword_given':# sample z from subword 
-                    logps[subword] = np.exp(args.model.log_probability_w_recon(subdata.unsqueeze(0), None, args.recon_type))
-                else:
-                    logps[subword] = np.exp(args.model.log_probability_w_recon(subdata.unsqueeze(0), root_fhs, args.recon_type))
-        logps = dict(reversed(list(logps.items())))
-        return logps
+        return get_logps_2_batched(args, [data[0][1:-1].tolist()])[0]
+
+# returns likelihoods of all subwords of many words, scored in a few large batches
+def get_logps_2_batched(args, words):
+    if args.sample_type == 'word_given':
+        # root latent of each full word, shared by all its subwords
+        word_root, = encode_words(args.vocab, words, lambda x: (args.model.vq_loss(x, 0, 'tst')[0][0],), args.prefix_batchsize, args.device)
+    def score(x, src):
+        # suffix codes are always read from the subword
+        root_z, suffix_z = args.model.vq_loss(x, 0, 'tst')[0]
+        if args.sample_type == 'word_given':
+            root_z = word_root[src]
+        c_init = root_z.permute((1,0,2)).contiguous()
+        h_init = torch.tanh(c_init)
+        recon_loss, _, _ = args.model.recon_loss(x, (h_init, c_init), (root_z, suffix_z), recon_type=args.recon_type)
+        return -recon_loss.squeeze(1)
+    curves = prefix_logps(args.vocab, words, score, args.prefix_batchsize, args.device)
+    return [{subword: np.exp(logpx) for subword, logpx in logps.items()} for logps in curves]
 
 # returns log likelihood of given word and its subwords
 def get_logps(args, word, data, from_file=False):
@@ -236,16 +260,40 @@ def reinflect(args, root_ind, reinflected_words):
     return reinflected_words
 
 
+# likelihoods of all subwords of many words, for the configured ll_type
+def score_words(args, words):
+    if args.ll_type == 'recon':
+        return get_logps_2_batched(args, words)
+    bosid = args.vocab.word2id['<s>']; eosid = args.vocab.word2id['</s>']
+    return [get_logps(args, ''.join(args.vocab.decode_sentence_2(ids)), torch.tensor([[bosid] + ids + [eosid]], device=args.device)) for ids in words]
+
+# score_words in chunks of args.profile_words words, one profiler step each
+def score_words_in_steps(args, words):
+    scores = []
+    for i in range(0, len(words), args.profile_words):
+        scores += score_words(args, words[i:i+args.profile_words])
+        args.profiler.step()
+    return scores
+
+
 def config():
      # CONFIG
     parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--export_graphs', action='store_true', help='script the inference graphs of the model and save them next to its checkpoint')
+    parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+    parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
+    parser.add_argument('--root_dist', type=float, default=None, help='max L2 distance between the roots of a subword and its word, required by the check_copying heuristic (inf: copying only)')
     args = parser.parse_args()
     args.device = 'cuda'
     model_id = 'vqvae_1x10000_8x6'
     model_path, model_vocab  = get_model_info(model_id)
     # heuristic
     args.heur_type = 'prev_mid_next'; args.eps = 0.0
+    # copy heuristic: no calibrated root distance for this model, it has to be given
+    if args.heur_type == 'check_copying' and args.root_dist is None:
+        parser.error('--root_dist is required by the check_copying heuristic')
     args.ll_type = 'reinflect';
+    # (a) reinflect: subword is a reinflection of the word, (b) recon: reconstruction likelihood of the subword (get_logps_2)
     args.sample_type = 'word_given'
     # (a) avg: averages ll over word tokens, (b) sum: adds ll over word tokens
     args.recon_type = 'avg' 
@@ -254,6 +302,16 @@ def config():
     args.fseg   = args.logdir +'segments.txt'
     args.fprob  = args.logdir +'probs.json'
     args.load_probs_from_file = False; args.save_probs_to_file = not args.load_probs_from_file
+    # subword likelihoods are kept in a score cache keyed by checkpoint, scoring mode and word
+    args.model_path = model_path
+    args.fcache = 'evaluation/morph_segmentation/results/scores.db'
+    args.score_mode = 'vqvae/'+args.ll_type+'/'+args.recon_type+'/'+args.sample_type
+    # words are scored by a pool of forked workers on cpu (one process on cuda)
+    args.num_workers = os.cpu_count()
+    # profiled runs score in this process, one step per args.profile_words words (and per copy-check batch)
+    args.profile_words = 64
+    if args.profile:
+        args.num_workers = 1
     try:
         os.makedirs(args.logdir)
         print("Directory " , args.logdir ,  " Created ") 
@@ -279,12 +337,19 @@ def config():
     args.model.load_state_dict(torch.load(model_path))
     args.model.to(args.device)
     args.model.eval()
+    # scripted inference graphs next to the checkpoint, used when present
+    if args.export_graphs:
+        export_graphs(args.model, model_path)
+    args.graphs = Graphs(args.model, model_path)
+    args.profiler = StepProfiler(args.profile, args.logdir+'profile/', 'segment', args.profile_steps, args.device)
     # data
     #args.tstdata = 'evaluation/morph_segmentation/data/test.tur'
     #args.tstdata = 'evaluation/morph_segmentation/data/goldstdsample.tur'
     args.tstdata = 'evaluation/morph_segmentation/data/goldstd_mc05-10aggregated.segments.tur'
     args.maxtstsize = 3000
     args.batch_size = 1
+    # number of subwords scored in one forward pass
+    args.prefix_batchsize = 512
     return args
 
 def main():
@@ -292,11 +357,26 @@ def main():
     data, batches = build_data(args)
     word_probs = dict()
     fseg = open(args.fseg, 'w')
+    words = [''.join(args.vocab.decode_sentence(data[0][1:-1])) for data in batches]
+    args.profiler.start()
+    if not args.load_probs_from_file:
+        # only the words missing from the score cache are run through the model
+        cache = ScoreCache(args.fcache, args.model_path, args.score_mode)
+        score_fn = score_words_in_steps if args.profile else score_words
+        scorer = ShardedScorer(lambda seqs: score_fn(args, seqs), args.num_workers, args.device)
+        cache.fill(words, [data[0][1:-1].tolist() for data in batches], scorer)
+        scorer.close()
+    if args.heur_type == 'check_copying':
+        # copy checks of all prefixes of all words, in length batches
+        copy_morphemes = dict(zip(words, heur_check_copying_batched(args, [data[0][1:-1].tolist() for data in batches])))
+    args.profiler.stop()
     # loop through each word 
-    for data in batches:
-        word = ''.join(args.vocab.decode_sentence(data[0][1:-1]))
+    for word, data in zip(words, batches):
         print(word)
-        logps = get_logps(args, word, data, from_file=args.load_probs_from_file)
+        if args.load_probs_from_file:
+            logps = get_logps(args, word, data, from_file=True)
+        else:
+            logps = cache.get(word)
         word_probs[word] = logps
         
         # call segmentation heuristic 
@@ -306,6 +386,8 @@ def main():
             morphemes = heur_prev_mid_next_and_prevnext_exceed(logps, args.eps)
         elif args.heur_type == 'reinflection':
             morphemes = heur_reinflection(logps, args.eps)
+        elif args.heur_type == 'check_copying':
+            morphemes = copy_morphemes[word]
 
         # write morphemes to file
         fseg.write(str(' '.join(morphemes)+'\n'))
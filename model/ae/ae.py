@@ -8,6 +8,7 @@ import math
 import torch
 import torch.nn as nn
 import numpy as np
+from common.utils import pad_candidates, reduce_candidate_loss
 
 class AE_Encoder(nn.Module):
     """ LSTM Encoder with constant-length batching"""
@@ -166,6 +167,25 @@ class AE(nn.Module):
     def log_probability(self, x, z, recon_type='avg'):
         return -self.recon_loss(x, z, recon_type)[0]
 
+    def score_candidates(self, encoding, candidates, recon_type='sum'):
+        """Teacher-forced log p(candidate|z) of many candidates against one latent, in one pass
+        Args:
+            encoding: z, (1, 1, nz)
+            candidates: list of words
+        Returns: Tensor
+            log_p: (num_candidates)
+        """
+        x = pad_candidates(self.decoder.vocab, candidates, device=encoding.device)
+        src = x[:, :-1]
+        tgt = x[:, 1:]
+        # (num_candidates, 1, nz)
+        z = encoding.expand(x.size(0), 1, self.decoder.nz).contiguous()
+        # (num_candidates, seq_len, vocab_size)
+        output_logits = self.decoder(src, z)
+        # (num_candidates, seq_len)
+        loss = self.decoder.loss(output_logits.reshape(-1, output_logits.size(2)), tgt.reshape(-1)).view(tgt.size())
+        return -reduce_candidate_loss(loss, tgt, recon_type)
+
     def accuracy(self, output_logits, tgt):
         # calculate correct number of predictions 
         batch_size, T = tgt.size()
@@ -9,6 +9,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 from ae import AE, AE_Encoder, AE_Decoder
 from common.utils import *
+from common.timers import PhaseTimer
+from common.profiling import StepProfiler
 from torch import optim
 from data.data import build_data, log_data
 matplotlib.use('Agg')
@@ -45,8 +47,12 @@ def train(data, args):
     indices = list(range(len(trnbatches)))
     numwords = args.trnsize
     best_loss = 1e4; trn_loss_values = []; val_loss_values = []
+    timer = PhaseTimer(args.time_phases, args.device)
+    profiler = StepProfiler(args.profile, args.modelname+'profile/', 'train', args.profile_steps, args.device)
+    profiler.start()
     #random.seed(0)
     for epc in range(args.epochs):
+        timer.reset()
         epoch_loss = 0; epoch_num_tokens = 0; epoch_acc = 0
         epoch_encoder_fhs = []
         random.shuffle(indices) # this breaks continuity if there is any
@@ -55,14 +61,20 @@ def train(data, args):
             # (batchsize, t)
             surf = trnbatches[idx] 
             # (batchsize)
-            loss, acc, encoder_fhs = args.model.loss(surf)
+            with timer.phase('forward'):
+                loss, acc, encoder_fhs = args.model.loss(surf)
             epoch_encoder_fhs.append(encoder_fhs)
-            batch_loss = loss.mean()
-            batch_loss.backward()
-            opt.step()
-            epoch_num_tokens += surf.size(0) * (surf.size(1)-1)
-            epoch_loss       += loss.sum().item()
-            epoch_acc        += acc
+            with timer.phase('backward'):
+                batch_loss = loss.mean()
+                batch_loss.backward()
+            with timer.phase('optimizer'):
+                opt.step()
+            with timer.phase('metrics'):
+                epoch_num_tokens += surf.size(0) * (surf.size(1)-1)
+                epoch_loss       += loss.sum().item()
+                epoch_acc        += acc
+            timer.count(surf.size(0), surf.size(0) * (surf.size(1)-1))
+            profiler.step()
         nll = epoch_loss / numwords
         ppl = np.exp(epoch_loss / epoch_num_tokens)
         acc = epoch_acc / epoch_num_tokens
@@ -74,19 +86,25 @@ def train(data, args):
 
         # VAL
         args.model.eval()
-        with torch.no_grad():
+        with timer.phase('validation'), torch.no_grad():
             loss = test(valbatches, "val", args)
         val_loss_values.append(loss)
         if loss < best_loss:
             args.logger.write('update best loss \n')
             best_loss = loss
-            torch.save(args.model.state_dict(), args.save_path)
+            with timer.phase('checkpoint'):
+                torch.save(args.model.state_dict(), args.save_path)
+        timer.log(epc, logger=args.logger)
         args.model.train()
+    profiler.stop()
     plot_curves(args.task, args.mname, args.fig, args.axs, trn_loss_values, val_loss_values, args.plt_style, 'loss')
  
 
 # CONFIG
 parser = argparse.ArgumentParser(description='')
+parser.add_argument('--time_phases', action='store_true', help='log the time of each training phase and the words/tokens per second of every epoch')
+parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
 args = parser.parse_args()
 args.device = 'cuda'
 
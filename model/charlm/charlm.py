@@ -6,6 +6,7 @@
 import math
 import torch
 import torch.nn as nn
+from common.utils import pad_candidates, reduce_candidate_loss, prefix_log_likelihoods
 
 class CharLM(nn.Module):
     """docstring for CharLM"""
@@ -92,3 +93,32 @@ class CharLM(nn.Module):
     def log_probability(self, x, recon_type='avg'):
         return -self.charlm_loss(x, recon_type)
 
+    def score_candidates(self, encoding, candidates, recon_type='sum'):
+        """log p(candidate) of many candidates in one pass
+        Args:
+            encoding: unused, the language model has no latent (kept for the common interface)
+            candidates: list of words
+        Returns: Tensor
+            log_p: (num_candidates)
+        """
+        x = pad_candidates(self.vocab, candidates, device=self.embed.weight.device)
+        src = self.charlm_input(x)
+        tgt = self.charlm_output(x)
+        _, output_logits = self(src)
+        # (num_candidates, seq_len)
+        loss = self.loss(output_logits, tgt.reshape(-1)).view(tgt.size())
+        return -reduce_candidate_loss(loss, tgt, recon_type)
+
+    def prefix_logprobs(self, x, recon_type='avg'):
+        """log p(<s> w_1..w_k </s>) of every prefix of a batch of words, from one forward pass
+        Args:
+            x: (batch_size, seq_len) <s> word </s> rows, right padded
+        Returns: Tensor
+            (batch_size, seq_len-2), column k-1 for the prefix of k chars
+        """
+        src = self.charlm_input(x)
+        _, output_logits = self(src)
+        # (batch_size, seq_len-1, vocab_size)
+        output_logits = output_logits.view(src.size(0), src.size(1), -1)
+        return prefix_log_likelihoods(output_logits, x, self.vocab.word2id['</s>'], recon_type)
+
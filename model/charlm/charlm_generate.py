@@ -7,6 +7,7 @@
 from common.vocab import VocabEntry
 from charlm import CharLM
 from common.utils import *
+from common.graphs import Graphs, export_graphs
 import sys, argparse, random, torch, json, matplotlib, os
 
 
@@ -21,12 +22,13 @@ def generate(args):
     word = []
     sft = nn.Softmax(dim=1)
     i = 0; max_length = 30
-    decoder_hidden = init_hidden(args.model,1)
+    h, c = init_hidden(args.model,1)
+    # the language model has no latent
+    z = h.new_zeros(1, 1, 0)
     while i < max_length:
         i +=1
-        word_embed = args.model.embed(input)
-        output, decoder_hidden = args.model.lstm(word_embed, decoder_hidden)
-        output_logits = args.model.pred_linear(output).squeeze(1)
+        output_logits, h, c = args.graphs.decoder_step(input, z, h, c)
+        output_logits = output_logits.squeeze(1)
         input = torch.multinomial(sft(output_logits), num_samples=1) # sample
         char = args.vocab.id2word(input.item())
         word.append(char)
@@ -38,6 +40,7 @@ def generate(args):
 def config():
     # CONFIG
     parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--export_graphs', action='store_true', help='script the inference graphs of the model and save them next to its checkpoint')
     args = parser.parse_args()
     args.device = 'cuda'
     model_id = 'charlm_segm'
@@ -64,6 +67,10 @@ def config():
     # load model weights
     args.model.load_state_dict(torch.load(model_path))
     args.model.eval()
+    # scripted inference graphs next to the checkpoint, used when present
+    if args.export_graphs:
+        export_graphs(args.model, model_path)
+    args.graphs = Graphs(args.model, model_path)
     return args
 
 def main():
@@ -46,6 +46,7 @@ import torch.nn as nn
 from model.miniGPT.multihead_attention import MultiHead_Masked_SelfAttention
 import torch.nn.functional as F
 import math
+from common.utils import prefix_log_likelihoods
 
 class Decoder(nn.Module):
     def __init__(self, embed_dim=512, num_heads=8, block_size=128, attention_dropout_rate=0.1, residual_dropout_rate=0.1, expand_ratio=4):
@@ -60,12 +61,15 @@ class Decoder(nn.Module):
         )
         self.layer_norm2 = nn.LayerNorm(embed_dim)
 
-    def forward(self, x):
+    def forward(self, x, layer_past=None, use_cache=False):
         res1 = x
         #print(f"6) Decoder Input: {x.shape}")
         x = self.layer_norm1(x)
         #print(f"7) Decoder Layer Norm1: {x.shape}")
-        x = self.MH_attention(x)
+        if use_cache:
+            x, present = self.MH_attention(x, layer_past=layer_past, use_cache=True)
+        else:
+            x = self.MH_attention(x, layer_past=layer_past)
         #print(f"18) Multi-Head Layer Output: {x.shape}")
         x = x + res1
 
@@ -76,6 +80,8 @@ class Decoder(nn.Module):
         #print(f"20) Decoder Layer Output: {x.shape}")
         x = x + res2
 
+        if use_cache:
+            return x, present
         return x
 
 class PositionalEncoding(nn.Module):
@@ -162,6 +168,71 @@ class GPT3(nn.Module):
     def log_probability(self, x):
         return -self.forward(x)[0]
 
+    def prefix_logprobs(self, x, recon_type='sum'):
+        """log p(<s> w_1..w_k </s>) of every prefix of a batch of words, from one forward pass
+        Args:
+            x: (batchsize, seq_len) <s> word </s> rows, right padded
+        Returns: Tensor
+            (batchsize, seq_len-2), column k-1 for the prefix of k chars
+        """
+        logits, _ = self.forward_step(x[:, :-1])
+        return prefix_log_likelihoods(logits, x, self.vocab.word2id['</s>'], recon_type)
+
+    def decoders(self):
+        return [self.decoder1, self.decoder2, self.decoder3]
+
+    def forward_step(self, idx, past=None):
+        """Runs only the new tokens through the model, attending over the cached prefix.
+        Args:
+            idx: (batchsize, t) new token ids
+            past: list of per-layer (k, v) returned by the previous call, or None
+        Returns:
+            logits: (batchsize, t, vocab_size), presents: per-layer (k, v) covering prefix + idx
+        """
+        batchsize, seq_len = idx.size()
+        past_len = 0 if past is None else past[0][0].size(-2)
+        token_embeddings = self.token_embedding(idx)
+        position_embeddings = self.position_embedding[:, past_len:past_len+seq_len, :]
+        x = self.embedding_dropout(position_embeddings+token_embeddings)
+        presents = []
+        for i, decoder in enumerate(self.decoders()):
+            layer_past = None if past is None else past[i]
+            x, present = decoder(x, layer_past=layer_past, use_cache=True)
+            presents.append(present)
+        x = self.layer_norm(x)
+        logits = self.head(x)
+        return logits, presents
+
+    def generate(self, x, max_new_tokens=30, sample=False, temperature=1.0):
+        """Batched incremental decoding with per-layer key/value cache.
+        Args:
+            x: (batchsize, t) prompt ids, starting with <s>
+        Returns:
+            (batchsize, t + generated) token ids; rows that emitted </s> are padded afterwards
+        """
+        eosid = self.vocab.word2id['</s>']
+        padid = self.vocab.word2id['<pad>']
+        block_size = self.position_embedding.size(1)
+        max_new_tokens = min(max_new_tokens, block_size - x.size(1))
+        # prompt is processed once, afterwards only the last token goes through the model
+        logits, past = self.forward_step(x)
+        finished = torch.zeros(x.size(0), dtype=torch.bool, device=x.device)
+        generated = [x]
+        for _ in range(max_new_tokens):
+            # (batchsize, vocab_size)
+            next_logits = logits[:, -1, :] / temperature
+            if sample:
+                next_token = torch.multinomial(F.softmax(next_logits, dim=-1), num_samples=1)
+            else:
+                next_token = torch.argmax(next_logits, dim=-1, keepdim=True)
+            next_token = next_token.masked_fill(finished.unsqueeze(1), padid)
+            generated.append(next_token)
+            finished = finished | (next_token.squeeze(1) == eosid)
+            if finished.all():
+                break
+            logits, past = self.forward_step(next_token, past)
+        return torch.cat(generated, dim=1)
+
     def accuracy(self, output_logits, targets):
         # output_logits: (B, T, vocab_size), targets: (B,T)
         surface_vocab = self.vocab
@@ -51,7 +51,8 @@ class MultiHead_Masked_SelfAttention(nn.Module):
         self.register_buffer("mask", torch.tril(torch.ones(block_size, block_size)).view(1, 1, block_size, block_size))
         self.num_heads = num_heads
 
-    def forward(self, x, layer_past=None):
+    def forward(self, x, layer_past=None, use_cache=False):
+        # layer_past: (k, v) of the already processed prefix, each (B, num_heads, T_past, C//num_heads)
         B, T, C = x.shape
         #print(f"8) Multi-Head Attention Input: {x.shape}")
 
@@ -60,11 +61,20 @@ class MultiHead_Masked_SelfAttention(nn.Module):
         q = self.query(x).view(B, T, self.num_heads, C//self.num_heads).transpose(1, 2) # (B, num_heads, T, C//num_heads)
         v = self.value(x).view(B, T, self.num_heads, C//self.num_heads).transpose(1, 2) # (B, num_heads, T, C//num_heads)
         #print(f"9) K: {k.shape}, Q: {q.shape}, V: {v.shape}")
+        T_past = 0
+        if layer_past is not None:
+            past_k, past_v = layer_past
+            T_past = past_k.size(-2)
+            # (B, num_heads, T_past+T, C//num_heads)
+            k = torch.cat((past_k, k), dim=-2)
+            v = torch.cat((past_v, v), dim=-2)
+        present = (k, v) if use_cache else None
 
-        # self-attention: (B, num_heads, T, C//num_heads) x (B, num_heads, C//num_heads, T) ===> (B, num_heads, T, T)
+        # self-attention: (B, num_heads, T, C//num_heads) x (B, num_heads, C//num_heads, T_past+T) ===> (B, num_heads, T, T_past+T)
         attention = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
         #print(f"10) Attention: {attention.shape}")
-        attention = attention.masked_fill(self.mask[:,:,:T,:T] == 0, float('-inf'))
+        # new queries sit at positions T_past..T_past+T-1 and see every key up to themselves
+        attention = attention.masked_fill(self.mask[:,:,T_past:T_past+T,:T_past+T] == 0, float('-inf'))
         #print(attention[0][0])
         #print(f"11) Attention: {attention.shape}")
         normalized_attention = F.softmax(attention, dim=-1)
@@ -73,7 +83,7 @@ class MultiHead_Masked_SelfAttention(nn.Module):
         attention = self.attention_dropout(normalized_attention)
         #print(f"13) Attention: {attention.shape}")
 
-        y = attention @ v # (B, num_heads, T, T) x (B, num_heads, T, C//num_heads) ===> (B, num_heads, T, C//num_heads)
+        y = attention @ v # (B, num_heads, T, T_past+T) x (B, num_heads, T_past+T, C//num_heads) ===> (B, num_heads, T, C//num_heads)
         #print(f"14) Attention Output: {y.shape}")
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side (concat)
         #print(f"15) Multi-Head Attention Output: {y.shape}")
@@ -83,4 +93,6 @@ class MultiHead_Masked_SelfAttention(nn.Module):
         #print(f"16) Full Connected: {y.shape}")
         y = self.residual_dropout(y)
         #print(f"17) Dropout: {y.shape}")
-        return y
\ No newline at end of file
+        if use_cache:
+            return y, present
+        return y
@@ -137,6 +137,7 @@ class MSVED(nn.Module):
         self.decoder = MSVED_Decoder(args, self.embed, surf_vocab, model_init, emb_init)
 
         self.args = args
+        self.device = args.device
         self.nz = args.nz
         self.tag_embed_dim = 200
         self.dec_nh = 256
@@ -163,7 +164,7 @@ class MSVED(nn.Module):
             print(key, len(keydict))
             self.tag_embeddings.append(nn.Embedding(len(keydict), self.tag_embed_dim))
             self.priors.append(torch.zeros(1,len(keydict)))
-            self.tag_embeddings_biases.append(nn.Parameter(torch.ones(1,self.tag_embed_dim)).to('cuda'))
+            self.tag_embeddings_biases.append(nn.Parameter(torch.ones(1,self.tag_embed_dim)).to(args.device))
 
     def classifier_loss(self, enc_nh, tmp, case=None,polar=None,mood=None,evid=None,pos=None,per=None,num=None,tense=None,aspect=None,inter=None,poss=None):
         sft = nn.Softmax(dim=2)
@@ -172,7 +173,7 @@ class MSVED(nn.Module):
         tags = [case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss]
             
         preds =[]
-        xloss = torch.tensor(0.0).to('cuda')
+        xloss = torch.tensor(0.0).to(self.device)
         gumbel_tag_embeddings = []
         for i in range(len(self.classifiers)):
             # (batchsize,1,tagvocabsize)
@@ -207,12 +208,12 @@ class MSVED(nn.Module):
         tags = [case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss]
         sft = nn.Softmax(dim=1)
         loss = nn.CrossEntropyLoss(reduce=False,ignore_index=0)
-        logpy = torch.tensor(0.0).to('cuda')
+        logpy = torch.tensor(0.0).to(self.device)
         for i in range(len(tags)):
             prior = self.priors[i]
             # (batchsize, vocabsize of that tag)
             prior = sft(prior.repeat(batch_size,1))
-            logpy+=loss(prior.to('cuda'),tags[i].squeeze(1)).mean()
+            logpy+=loss(prior.to(self.device),tags[i].squeeze(1)).mean()
         return -logpy
 
     def labeled_msved_loss(self, x, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, reinflect_surf, kl_weight, tmp, mode='train'):
@@ -426,7 +427,7 @@ class MSVED(nn.Module):
         # decoding goes sentence by sentence
         for idx in range(1):
             # Start with the start of the sentence token
-            decoder_input = torch.tensor([[self.decoder.vocab["<s>"]]], dtype=torch.long, device='cuda')
+            decoder_input = torch.tensor([[self.decoder.vocab["<s>"]]], dtype=torch.long, device=self.device)
             decoder_hidden = decoder_hidden[:,idx,:].unsqueeze(1)
 
             node = BeamSearchNode(decoder_hidden, None, decoder_input, 0., 1)
@@ -451,7 +452,7 @@ class MSVED(nn.Module):
                 output_logits, decoder_hidden, _ = self.decoder(decoder_input, expanded_z, decoder_hidden, expanded_tag_embeddings, expanded_tag_attention_masks)
                 decoder_output = F.log_softmax(output_logits, dim=-1)
 
-                prev_logp = torch.tensor([node.logp for node in live_hypotheses], dtype=torch.float, device='cuda')
+                prev_logp = torch.tensor([node.logp for node in live_hypotheses], dtype=torch.float, device=self.device)
                 decoder_output = decoder_output + prev_logp.view(len(live_hypotheses), 1, 1)
 
                 # (len(live) * vocab_size)
@@ -10,6 +10,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 from msved import MSVED
 from common.utils import *
+from common.timers import PhaseTimer
+from common.profiling import StepProfiler
+from common.distributed import init_distributed, is_main, barrier, broadcast_params, broadcast_order, shard, all_reduce_grads, all_reduce_sums, QuietLogger
 from torch import optim
 from data.data_2 import build_data
 matplotlib.use('Agg')
@@ -53,6 +56,7 @@ def train_2(data, args):
     lxsrc_ordered_batches, lxtgt_ordered_batches, valbatches, tstbatches, ubatches = data
     # initialize optimizer
     opt = optim.Adam(filter(lambda p: p.requires_grad, args.model.parameters()), lr=args.lr)
+    broadcast_params(args.model, args)
     # Log trainable model parameters
     for name, prm in args.model.named_parameters():
         args.logger.write('\n'+name+', '+str(prm.shape) + ': '+ str(prm.requires_grad))
@@ -70,8 +74,12 @@ def train_2(data, args):
     best_loss = 1e4
     tmp=1.0
     update_ind =0
+    timer = PhaseTimer(args.time_phases, args.device)
+    profiler = StepProfiler(args.profile, args.modelname+'profile/', 'train_rank%d' % getattr(args, 'rank', 0), args.profile_steps, args.device)
+    profiler.start()
 
     for epc in range(args.epochs):
+        timer.reset()
         epoch_ux_msvae_loss = 0 
         epoch_ux_msvae_num_tokens = 0
         epoch_ux_msvae_recon_acc = 0
@@ -111,10 +119,11 @@ def train_2(data, args):
         random.shuffle(lsrcindices) # this breaks continuity if there is any
         random.shuffle(ltgtindices) # this breaks continuity if there is any
         random.shuffle(uindices) # this breaks continuity if there is any
+        # unlabeled batches of this rank (all of them if not distributed), labeled ones are drawn per rank
+        uindices = broadcast_order(uindices, args)
 
-
-        for i, uidx in enumerate(uindices):
-            loss = torch.tensor(0.0).to('cuda')
+        for i, uidx in enumerate(shard(uindices, args)):
+            loss = torch.tensor(0.0).to(args.device)
             if update_ind % args.update_temp == 0:
                 tmp = get_temp(update_ind)
             kl_weight = get_kl_weight(update_ind, 0.2, 150000.0)
@@ -122,123 +131,140 @@ def train_2(data, args):
             
             ux = ubatches[uidx] 
             update_ind +=1
-            batch_loss = torch.tensor(0.0).to('cuda')
-
-            if i < len(lxsrc_ordered_batches):
-                lidx= lsrcindices[i]
-                lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt  = lxsrc_ordered_batches[lidx] 
-                # MSVAE with lxsrc
-                loss_lxsrc_msvae, lxsrc_msvae_recon_loss, lxsrc_msvae_kl_loss, lxsrc_msvae_recon_acc, _ = args.model.loss_lxsrc_msvae(lxsrc, kl_weight, tmp)
-                lxsrc_msvae_batch_loss = loss_lxsrc_msvae.mean()
-                batch_loss += lxsrc_msvae_batch_loss
-                epoch_lxsrc_msvae_loss += loss_lxsrc_msvae.sum().item()
-                epoch_lxsrc_msvae_num_tokens +=  torch.sum(lxsrc[:,1:] !=0).item()
-                epoch_lxsrc_msvae_recon_acc += lxsrc_msvae_recon_acc
-                epoch_lxsrc_msvae_recon_loss += lxsrc_msvae_recon_loss.sum().item()
-                epoch_lxsrc_msvae_kl_loss += lxsrc_msvae_kl_loss.sum().item()
-                # Labeled MSVED 
-                loss_labeled_msved, labeled_msved_tag_pred_loss, labeled_msved_tag_correct, labeled_msved_tag_total, labeled_msved_recon_loss, labeled_msved_kl_loss, labeled_msved_recon_acc = args.model.loss_labeled_msved(lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt, kl_weight, tmp)
-                labeled_msved_batch_loss = loss_labeled_msved.mean()
-                batch_loss += labeled_msved_batch_loss
-                epoch_labeled_msved_loss += loss_labeled_msved.sum().item()
-                epoch_labeled_msved_num_tokens +=  torch.sum(lxtgt[:,1:] !=0).item()
-                epoch_labeled_msved_recon_acc += labeled_msved_recon_acc
-                epoch_labeled_msved_recon_loss += labeled_msved_recon_loss.sum().item()
-                epoch_labeled_msved_kl_loss += labeled_msved_kl_loss.sum().item()
-                epoch_labeled_msved_num_tags +=  labeled_msved_tag_total
-                epoch_labeled_msved_tag_pred_loss += labeled_msved_tag_pred_loss.sum().item()
-                epoch_labeled_msved_tag_acc += labeled_msved_tag_correct
-            else:
-                random.shuffle(lsrcindices) # this breaks continuity if there is any
-                lidx= lsrcindices[0]
-                lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt  = lxsrc_ordered_batches[lidx] 
-                # MSVAE with lxsrc
-                loss_lxsrc_msvae, lxsrc_msvae_recon_loss, lxsrc_msvae_kl_loss, lxsrc_msvae_recon_acc, _ = args.model.loss_lxsrc_msvae(lxsrc, kl_weight, tmp)
-                lxsrc_msvae_batch_loss = loss_lxsrc_msvae.mean()
-                batch_loss += lxsrc_msvae_batch_loss
-                epoch_lxsrc_msvae_loss += loss_lxsrc_msvae.sum().item()
-                epoch_lxsrc_msvae_num_tokens +=  torch.sum(lxsrc[:,1:] !=0).item()
-                epoch_lxsrc_msvae_recon_acc += lxsrc_msvae_recon_acc
-                epoch_lxsrc_msvae_recon_loss += lxsrc_msvae_recon_loss.sum().item()
-                epoch_lxsrc_msvae_kl_loss += lxsrc_msvae_kl_loss.sum().item()
-                # Labeled MSVED 
-                loss_labeled_msved, labeled_msved_tag_pred_loss, labeled_msved_tag_correct, labeled_msved_tag_total, labeled_msved_recon_loss, labeled_msved_kl_loss, labeled_msved_recon_acc = args.model.loss_labeled_msved(lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt, kl_weight, tmp)
-                labeled_msved_batch_loss = loss_labeled_msved.mean()
-                batch_loss += labeled_msved_batch_loss
-                epoch_labeled_msved_loss += loss_labeled_msved.sum().item()
-                epoch_labeled_msved_num_tokens +=  torch.sum(lxtgt[:,1:] !=0).item()
-                epoch_labeled_msved_recon_acc += labeled_msved_recon_acc
-                epoch_labeled_msved_recon_loss += labeled_msved_recon_loss.sum().item()
-                epoch_labeled_msved_kl_loss += labeled_msved_kl_loss.sum().item()
-                epoch_labeled_msved_num_tags +=  labeled_msved_tag_total
-                epoch_labeled_msved_tag_pred_loss += labeled_msved_tag_pred_loss.sum().item()
-                epoch_labeled_msved_tag_acc += labeled_msved_tag_correct
+            # losses of the streams, with their bookkeeping
+            with timer.phase('forward'):
+                batch_loss = torch.tensor(0.0).to(args.device)
+
+                if i < len(lxsrc_ordered_batches):
+                    lidx= lsrcindices[i]
+                    lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt  = lxsrc_ordered_batches[lidx] 
+                    # MSVAE with lxsrc
+                    loss_lxsrc_msvae, lxsrc_msvae_recon_loss, lxsrc_msvae_kl_loss, lxsrc_msvae_recon_acc, _ = args.model.loss_lxsrc_msvae(lxsrc, kl_weight, tmp)
+                    lxsrc_msvae_batch_loss = loss_lxsrc_msvae.mean()
+                    batch_loss += lxsrc_msvae_batch_loss
+                    epoch_lxsrc_msvae_loss += loss_lxsrc_msvae.sum().item()
+                    epoch_lxsrc_msvae_num_tokens +=  torch.sum(lxsrc[:,1:] !=0).item()
+                    epoch_lxsrc_msvae_recon_acc += lxsrc_msvae_recon_acc
+                    epoch_lxsrc_msvae_recon_loss += lxsrc_msvae_recon_loss.sum().item()
+                    epoch_lxsrc_msvae_kl_loss += lxsrc_msvae_kl_loss.sum().item()
+                    # Labeled MSVED 
+                    loss_labeled_msved, labeled_msved_tag_pred_loss, labeled_msved_tag_correct, labeled_msved_tag_total, labeled_msved_recon_loss, labeled_msved_kl_loss, labeled_msved_recon_acc = args.model.loss_labeled_msved(lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt, kl_weight, tmp)
+                    labeled_msved_batch_loss = loss_labeled_msved.mean()
+                    batch_loss += labeled_msved_batch_loss
+                    epoch_labeled_msved_loss += loss_labeled_msved.sum().item()
+                    epoch_labeled_msved_num_tokens +=  torch.sum(lxtgt[:,1:] !=0).item()
+                    epoch_labeled_msved_recon_acc += labeled_msved_recon_acc
+                    epoch_labeled_msved_recon_loss += labeled_msved_recon_loss.sum().item()
+                    epoch_labeled_msved_kl_loss += labeled_msved_kl_loss.sum().item()
+                    epoch_labeled_msved_num_tags +=  labeled_msved_tag_total
+                    epoch_labeled_msved_tag_pred_loss += labeled_msved_tag_pred_loss.sum().item()
+                    epoch_labeled_msved_tag_acc += labeled_msved_tag_correct
+                else:
+                    random.shuffle(lsrcindices) # this breaks continuity if there is any
+                    lidx= lsrcindices[0]
+                    lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt  = lxsrc_ordered_batches[lidx] 
+                    # MSVAE with lxsrc
+                    loss_lxsrc_msvae, lxsrc_msvae_recon_loss, lxsrc_msvae_kl_loss, lxsrc_msvae_recon_acc, _ = args.model.loss_lxsrc_msvae(lxsrc, kl_weight, tmp)
+                    lxsrc_msvae_batch_loss = loss_lxsrc_msvae.mean()
+                    batch_loss += lxsrc_msvae_batch_loss
+                    epoch_lxsrc_msvae_loss += loss_lxsrc_msvae.sum().item()
+                    epoch_lxsrc_msvae_num_tokens +=  torch.sum(lxsrc[:,1:] !=0).item()
+                    epoch_lxsrc_msvae_recon_acc += lxsrc_msvae_recon_acc
+                    epoch_lxsrc_msvae_recon_loss += lxsrc_msvae_recon_loss.sum().item()
+                    epoch_lxsrc_msvae_kl_loss += lxsrc_msvae_kl_loss.sum().item()
+                    # Labeled MSVED 
+                    loss_labeled_msved, labeled_msved_tag_pred_loss, labeled_msved_tag_correct, labeled_msved_tag_total, labeled_msved_recon_loss, labeled_msved_kl_loss, labeled_msved_recon_acc = args.model.loss_labeled_msved(lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt, kl_weight, tmp)
+                    labeled_msved_batch_loss = loss_labeled_msved.mean()
+                    batch_loss += labeled_msved_batch_loss
+                    epoch_labeled_msved_loss += loss_labeled_msved.sum().item()
+                    epoch_labeled_msved_num_tokens +=  torch.sum(lxtgt[:,1:] !=0).item()
+                    epoch_labeled_msved_recon_acc += labeled_msved_recon_acc
+                    epoch_labeled_msved_recon_loss += labeled_msved_recon_loss.sum().item()
+                    epoch_labeled_msved_kl_loss += labeled_msved_kl_loss.sum().item()
+                    epoch_labeled_msved_num_tags +=  labeled_msved_tag_total
+                    epoch_labeled_msved_tag_pred_loss += labeled_msved_tag_pred_loss.sum().item()
+                    epoch_labeled_msved_tag_acc += labeled_msved_tag_correct
             
-            if i < len(lxtgt_ordered_batches):
-                lidx= ltgtindices[i]
-                lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt  = lxtgt_ordered_batches[lidx] 
-                # Labeled MSVAE with lxtgt
-                loss_lxtgt_labeled_msvae, lxtgt_labeled_msvae_tag_pred_loss, lxtgt_labeled_msvae_tag_correct, lxtgt_labeled_msvae_tag_total, lxtgt_labeled_msvae_recon_loss, lxtgt_labeled_msvae_kl_loss, lxtgt_labeled_msvae_recon_acc = args.model.loss_lxtgt_labeled_msvae(lxtgt, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, kl_weight, tmp)
-                lxtgt_labeled_msvae_batch_loss = loss_lxtgt_labeled_msvae.mean()
-                batch_loss += lxtgt_labeled_msvae_batch_loss
-                epoch_lxtgt_labeled_msvae_loss += loss_lxtgt_labeled_msvae.sum().item()
-                epoch_lxtgt_labeled_msvae_num_tokens +=  torch.sum(lxtgt[:,1:] !=0).item()
-                epoch_lxtgt_labeled_msvae_recon_acc += lxtgt_labeled_msvae_recon_acc
-                epoch_lxtgt_labeled_msvae_recon_loss += lxtgt_labeled_msvae_recon_loss.sum().item()
-                epoch_lxtgt_labeled_msvae_kl_loss += lxtgt_labeled_msvae_kl_loss.sum().item()
-                epoch_lxtgt_labeled_msvae_num_tags +=  lxtgt_labeled_msvae_tag_total
-                epoch_lxtgt_labeled_msvae_tag_pred_loss += lxtgt_labeled_msvae_tag_pred_loss.sum().item()
-                epoch_lxtgt_labeled_msvae_tag_acc += lxtgt_labeled_msvae_tag_correct
-                # MSVED from lxtgt to lxsrc
-                loss_lxtgt_to_lxsrc_msved, lxtgt_to_lxsrc_msved_recon_loss, lxtgt_to_lxsrc_msved_kl_loss, lxtgt_to_lxsrc_msved_recon_acc = args.model.loss_lxtgt_to_lxsrc_msved(lxsrc, lxtgt, kl_weight, tmp)
-                lxtgt_to_lxsrc_msved_batch_loss = loss_lxtgt_to_lxsrc_msved.mean()
-                batch_loss += lxtgt_to_lxsrc_msved_batch_loss
-                epoch_lxtgt_to_lxsrc_msved_loss += loss_lxtgt_to_lxsrc_msved.sum().item()
-                epoch_lxtgt_to_lxsrc_msved_num_tokens +=  torch.sum(lxsrc[:,1:] !=0).item()
-                epoch_lxtgt_to_lxsrc_msved_recon_acc += lxtgt_to_lxsrc_msved_recon_acc
-                epoch_lxtgt_to_lxsrc_msved_recon_loss += lxtgt_to_lxsrc_msved_recon_loss.sum().item()
-                epoch_lxtgt_to_lxsrc_msved_kl_loss += lxtgt_to_lxsrc_msved_kl_loss.sum().item()
-
-            else:
-                random.shuffle(ltgtindices) # this breaks continuity if there is any
-                lidx= ltgtindices[0]
-                lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt  = lxtgt_ordered_batches[lidx] 
-                # Labeled MSVAE with lxtgt
-                loss_lxtgt_labeled_msvae, lxtgt_labeled_msvae_tag_pred_loss, lxtgt_labeled_msvae_tag_correct, lxtgt_labeled_msvae_tag_total, lxtgt_labeled_msvae_recon_loss, lxtgt_labeled_msvae_kl_loss, lxtgt_labeled_msvae_recon_acc = args.model.loss_lxtgt_labeled_msvae(lxtgt, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, kl_weight, tmp)
-                lxtgt_labeled_msvae_batch_loss = loss_lxtgt_labeled_msvae.mean()
-                batch_loss += lxtgt_labeled_msvae_batch_loss
-                epoch_lxtgt_labeled_msvae_loss += loss_lxtgt_labeled_msvae.sum().item()
-                epoch_lxtgt_labeled_msvae_num_tokens +=  torch.sum(lxtgt[:,1:] !=0).item()
-                epoch_lxtgt_labeled_msvae_recon_acc += lxtgt_labeled_msvae_recon_acc
-                epoch_lxtgt_labeled_msvae_recon_loss += lxtgt_labeled_msvae_recon_loss.sum().item()
-                epoch_lxtgt_labeled_msvae_kl_loss += lxtgt_labeled_msvae_kl_loss.sum().item()
-                epoch_lxtgt_labeled_msvae_num_tags +=  lxtgt_labeled_msvae_tag_total
-                epoch_lxtgt_labeled_msvae_tag_pred_loss += lxtgt_labeled_msvae_tag_pred_loss.sum().item()
-                epoch_lxtgt_labeled_msvae_tag_acc += lxtgt_labeled_msvae_tag_correct
-                # MSVED from lxtgt to lxsrc
-                loss_lxtgt_to_lxsrc_msved, lxtgt_to_lxsrc_msved_recon_loss, lxtgt_to_lxsrc_msved_kl_loss, lxtgt_to_lxsrc_msved_recon_acc = args.model.loss_lxtgt_to_lxsrc_msved(lxsrc, lxtgt, kl_weight, tmp)
-                lxtgt_to_lxsrc_msved_batch_loss = loss_lxtgt_to_lxsrc_msved.mean()
-                batch_loss += lxtgt_to_lxsrc_msved_batch_loss
-                epoch_lxtgt_to_lxsrc_msved_loss += loss_lxtgt_to_lxsrc_msved.sum().item()
-                epoch_lxtgt_to_lxsrc_msved_num_tokens +=  torch.sum(lxsrc[:,1:] !=0).item()
-                epoch_lxtgt_to_lxsrc_msved_recon_acc += lxtgt_to_lxsrc_msved_recon_acc
-                epoch_lxtgt_to_lxsrc_msved_recon_loss += lxtgt_to_lxsrc_msved_recon_loss.sum().item()
-                epoch_lxtgt_to_lxsrc_msved_kl_loss += lxtgt_to_lxsrc_msved_kl_loss.sum().item()
+                if i < len(lxtgt_ordered_batches):
+                    lidx= ltgtindices[i]
+                    lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt  = lxtgt_ordered_batches[lidx] 
+                    # Labeled MSVAE with lxtgt
+                    loss_lxtgt_labeled_msvae, lxtgt_labeled_msvae_tag_pred_loss, lxtgt_labeled_msvae_tag_correct, lxtgt_labeled_msvae_tag_total, lxtgt_labeled_msvae_recon_loss, lxtgt_labeled_msvae_kl_loss, lxtgt_labeled_msvae_recon_acc = args.model.loss_lxtgt_labeled_msvae(lxtgt, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, kl_weight, tmp)
+                    lxtgt_labeled_msvae_batch_loss = loss_lxtgt_labeled_msvae.mean()
+                    batch_loss += lxtgt_labeled_msvae_batch_loss
+                    epoch_lxtgt_labeled_msvae_loss += loss_lxtgt_labeled_msvae.sum().item()
+                    epoch_lxtgt_labeled_msvae_num_tokens +=  torch.sum(lxtgt[:,1:] !=0).item()
+                    epoch_lxtgt_labeled_msvae_recon_acc += lxtgt_labeled_msvae_recon_acc
+                    epoch_lxtgt_labeled_msvae_recon_loss += lxtgt_labeled_msvae_recon_loss.sum().item()
+                    epoch_lxtgt_labeled_msvae_kl_loss += lxtgt_labeled_msvae_kl_loss.sum().item()
+                    epoch_lxtgt_labeled_msvae_num_tags +=  lxtgt_labeled_msvae_tag_total
+                    epoch_lxtgt_labeled_msvae_tag_pred_loss += lxtgt_labeled_msvae_tag_pred_loss.sum().item()
+                    epoch_lxtgt_labeled_msvae_tag_acc += lxtgt_labeled_msvae_tag_correct
+                    # MSVED from lxtgt to lxsrc
+                    loss_lxtgt_to_lxsrc_msved, lxtgt_to_lxsrc_msved_recon_loss, lxtgt_to_lxsrc_msved_kl_loss, lxtgt_to_lxsrc_msved_recon_acc = args.model.loss_lxtgt_to_lxsrc_msved(lxsrc, lxtgt, kl_weight, tmp)
+                    lxtgt_to_lxsrc_msved_batch_loss = loss_lxtgt_to_lxsrc_msved.mean()
+                    batch_loss += lxtgt_to_lxsrc_msved_batch_loss
+                    epoch_lxtgt_to_lxsrc_msved_loss += loss_lxtgt_to_lxsrc_msved.sum().item()
+                    epoch_lxtgt_to_lxsrc_msved_num_tokens +=  torch.sum(lxsrc[:,1:] !=0).item()
+                    epoch_lxtgt_to_lxsrc_msved_recon_acc += lxtgt_to_lxsrc_msved_recon_acc
+                    epoch_lxtgt_to_lxsrc_msved_recon_loss += lxtgt_to_lxsrc_msved_recon_loss.sum().item()
+                    epoch_lxtgt_to_lxsrc_msved_kl_loss += lxtgt_to_lxsrc_msved_kl_loss.sum().item()
+
+                else:
+                    random.shuffle(ltgtindices) # this breaks continuity if there is any
+                    lidx= ltgtindices[0]
+                    lxsrc, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lxtgt  = lxtgt_ordered_batches[lidx] 
+                    # Labeled MSVAE with lxtgt
+                    loss_lxtgt_labeled_msvae, lxtgt_labeled_msvae_tag_pred_loss, lxtgt_labeled_msvae_tag_correct, lxtgt_labeled_msvae_tag_total, lxtgt_labeled_msvae_recon_loss, lxtgt_labeled_msvae_kl_loss, lxtgt_labeled_msvae_recon_acc = args.model.loss_lxtgt_labeled_msvae(lxtgt, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, kl_weight, tmp)
+                    lxtgt_labeled_msvae_batch_loss = loss_lxtgt_labeled_msvae.mean()
+                    batch_loss += lxtgt_labeled_msvae_batch_loss
+                    epoch_lxtgt_labeled_msvae_loss += loss_lxtgt_labeled_msvae.sum().item()
+                    epoch_lxtgt_labeled_msvae_num_tokens +=  torch.sum(lxtgt[:,1:] !=0).item()
+                    epoch_lxtgt_labeled_msvae_recon_acc += lxtgt_labeled_msvae_recon_acc
+                    epoch_lxtgt_labeled_msvae_recon_loss += lxtgt_labeled_msvae_recon_loss.sum().item()
+                    epoch_lxtgt_labeled_msvae_kl_loss += lxtgt_labeled_msvae_kl_loss.sum().item()
+                    epoch_lxtgt_labeled_msvae_num_tags +=  lxtgt_labeled_msvae_tag_total
+                    epoch_lxtgt_labeled_msvae_tag_pred_loss += lxtgt_labeled_msvae_tag_pred_loss.sum().item()
+                    epoch_lxtgt_labeled_msvae_tag_acc += lxtgt_labeled_msvae_tag_correct
+                    # MSVED from lxtgt to lxsrc
+                    loss_lxtgt_to_lxsrc_msved, lxtgt_to_lxsrc_msved_recon_loss, lxtgt_to_lxsrc_msved_kl_loss, lxtgt_to_lxsrc_msved_recon_acc = args.model.loss_lxtgt_to_lxsrc_msved(lxsrc, lxtgt, kl_weight, tmp)
+                    lxtgt_to_lxsrc_msved_batch_loss = loss_lxtgt_to_lxsrc_msved.mean()
+                    batch_loss += lxtgt_to_lxsrc_msved_batch_loss
+                    epoch_lxtgt_to_lxsrc_msved_loss += loss_lxtgt_to_lxsrc_msved.sum().item()
+                    epoch_lxtgt_to_lxsrc_msved_num_tokens +=  torch.sum(lxsrc[:,1:] !=0).item()
+                    epoch_lxtgt_to_lxsrc_msved_recon_acc += lxtgt_to_lxsrc_msved_recon_acc
+                    epoch_lxtgt_to_lxsrc_msved_recon_loss += lxtgt_to_lxsrc_msved_recon_loss.sum().item()
+                    epoch_lxtgt_to_lxsrc_msved_kl_loss += lxtgt_to_lxsrc_msved_kl_loss.sum().item()
                 
             
-            # MSVAE with ux
-            loss_ux_msvae, ux_msvae_recon_loss, ux_msvae_kl_loss, ux_msvae_recon_acc, _ = args.model.loss_ux_msvae(ux, kl_weight, tmp)
-            ux_msvae_batch_loss = loss_ux_msvae.mean()
+                # MSVAE with ux
+                loss_ux_msvae, ux_msvae_recon_loss, ux_msvae_kl_loss, ux_msvae_recon_acc, _ = args.model.loss_ux_msvae(ux, kl_weight, tmp)
+                ux_msvae_batch_loss = loss_ux_msvae.mean()
           
-            epoch_ux_msvae_loss += loss_ux_msvae.sum().item()
-            epoch_ux_msvae_num_tokens +=  torch.sum(ux[:,1:] !=0).item()
-            epoch_ux_msvae_recon_acc += ux_msvae_recon_acc
-            epoch_ux_msvae_recon_loss += ux_msvae_recon_loss.sum().item()
-            epoch_ux_msvae_kl_loss += ux_msvae_kl_loss.sum().item()
-
-            batch_loss += 0.8 * ux_msvae_batch_loss
-            batch_loss.backward()
-            opt.step()
+                epoch_ux_msvae_loss += loss_ux_msvae.sum().item()
+                epoch_ux_msvae_num_tokens +=  torch.sum(ux[:,1:] !=0).item()
+                epoch_ux_msvae_recon_acc += ux_msvae_recon_acc
+                epoch_ux_msvae_recon_loss += ux_msvae_recon_loss.sum().item()
+                epoch_ux_msvae_kl_loss += ux_msvae_kl_loss.sum().item()
+
+                batch_loss += 0.8 * ux_msvae_batch_loss
+            with timer.phase('backward'):
+                batch_loss.backward()
+            with timer.phase('all_reduce'):
+                all_reduce_grads(args.model, args)
+            with timer.phase('optimizer'):
+                opt.step()
+            # throughput of the unlabeled stream, which drives the epoch
+            timer.count(ux.size(0), ux.size(0) * (ux.size(1)-1))
+            profiler.step()
+        # sums of the logged stream over all ranks
+        with timer.phase('metrics'):
+            epoch_labeled_msved_loss, epoch_labeled_msved_num_tokens, epoch_labeled_msved_num_tags, epoch_labeled_msved_recon_acc, epoch_labeled_msved_recon_loss, epoch_labeled_msved_kl_loss, epoch_labeled_msved_tag_pred_loss, epoch_labeled_msved_tag_acc = \
+                all_reduce_sums([epoch_labeled_msved_loss, epoch_labeled_msved_num_tokens, epoch_labeled_msved_num_tags, epoch_labeled_msved_recon_acc, epoch_labeled_msved_recon_loss, epoch_labeled_msved_kl_loss, epoch_labeled_msved_tag_pred_loss, epoch_labeled_msved_tag_acc], args)
+        if not is_main(args):
+            # rank 0 validates and saves meanwhile
+            barrier(args)
+            continue
      
         ux_msvae_loss = epoch_ux_msvae_loss / ux_msvae_numwords  
         ux_msvae_kl_loss = epoch_ux_msvae_kl_loss / ux_msvae_numwords
@@ -279,7 +305,7 @@ def train_2(data, args):
 
         # VAL
         args.model.eval()
-        with torch.no_grad():
+        with timer.phase('validation'), torch.no_grad():
             loss = test(valbatches, "val", args, kl_weight, tmp)
         if loss < best_loss:
             args.logger.write('\n update best loss \n')
@@ -287,11 +313,16 @@ def train_2(data, args):
 
         # SHARED TASK
         if epc %10==0 or epc>90:
-            shared_task_gen(tstbatches, args, epc)
-            oracle(args, epc, kl_weight, tmp)
-            torch.save(args.model.state_dict(), args.save_path+'_'+str(epc))
+            with timer.phase('validation'):
+                shared_task_gen(tstbatches, args, epc)
+                oracle(args, epc, kl_weight, tmp)
+            with timer.phase('checkpoint'):
+                torch.save(args.model.state_dict(), args.save_path+'_'+str(epc))
+        timer.log(epc, logger=args.logger)
 
         args.model.train()
+        barrier(args)
+    profiler.stop()
   
 
 def get_temp(update_ind):
@@ -339,8 +370,8 @@ def oracle(args, epc, kl_weight, tmp):
                 asked_tag  = split_line[1]
                 inflected_word = split_line[0]
                 reinflected_word = split_line[2].strip()
-                xsrc = torch.tensor([args.model.decoder.vocab.word2id['<s>']] + args.model.decoder.vocab.encode_sentence(inflected_word) + [args.model.decoder.vocab.word2id['</s>']]).unsqueeze(0).to('cuda')
-                xtgt = torch.tensor([args.model.decoder.vocab.word2id['<s>']] + args.model.decoder.vocab.encode_sentence(reinflected_word) + [args.model.decoder.vocab.word2id['</s>']]).unsqueeze(0).to('cuda')
+                xsrc = torch.tensor([args.model.decoder.vocab.word2id['<s>']] + args.model.decoder.vocab.encode_sentence(inflected_word) + [args.model.decoder.vocab.word2id['</s>']]).unsqueeze(0).to(args.device)
+                xtgt = torch.tensor([args.model.decoder.vocab.word2id['<s>']] + args.model.decoder.vocab.encode_sentence(reinflected_word) + [args.model.decoder.vocab.word2id['</s>']]).unsqueeze(0).to(args.device)
                 mu, logvar, encoder_fhs = args.model.encoder(xsrc)
                 z = mu.unsqueeze(0)
 
@@ -374,8 +405,13 @@ def oracle(args, epc, kl_weight, tmp):
 
 # CONFIG
 parser = argparse.ArgumentParser(description='')
+parser.add_argument('--time_phases', action='store_true', help='log the time of each training phase and the words/tokens per second of every epoch')
+parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
 args = parser.parse_args()
 args.device = 'cuda'
+# under torchrun: one cpu process per rank (gloo), see README
+init_distributed(args)
 # training
 args.batchsize = 128; args.epochs = 176
 args.opt= 'Adam'; args.lr = 0.001
@@ -415,7 +451,7 @@ except FileExistsError:
 args.save_path = args.modelname +  str(args.epochs)+'epochs.pt'
 args.log_path =  args.modelname +  str(args.epochs)+'epochs.log'
 args.fig_path =  args.modelname +  str(args.epochs)+'epochs.png'
-args.logger = Logger(args.log_path)
+args.logger = Logger(args.log_path) if is_main(args) else QuietLogger()
 with open(args.modelname+'/surf_vocab.json', 'w') as f:
     f.write(json.dumps(surf_vocab.word2id))
 args.logger.write('\nnumber of params: %d \n' % count_parameters(args.model))
@@ -9,6 +9,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 from model.msved.msved_sdsup import MSVED
 from common.utils import *
+from common.timers import PhaseTimer
+from common.profiling import StepProfiler
+from common.distributed import init_distributed, is_main, barrier, broadcast_params, broadcast_order, shard, all_reduce_grads, all_reduce_sums, QuietLogger
 from torch import optim
 from data.data import build_data
 matplotlib.use('Agg')
@@ -59,6 +62,7 @@ def train(data, args):
     trnbatches, valbatches, tstbatches = data
     # initialize optimizer
     opt = optim.Adam(filter(lambda p: p.requires_grad, args.model.parameters()), lr=args.lr)
+    broadcast_params(args.model, args)
     # Log trainable model parameters
     for name, prm in args.model.named_parameters():
         args.logger.write('\n'+name+', '+str(prm.shape) + ': '+ str(prm.requires_grad))
@@ -67,7 +71,11 @@ def train(data, args):
     best_loss = 1e4
     tmp=1.0
     update_ind =0
+    timer = PhaseTimer(args.time_phases, args.device)
+    profiler = StepProfiler(args.profile, args.modelname+'profile/', 'train_rank%d' % getattr(args, 'rank', 0), args.profile_steps, args.device)
+    profiler.start()
     for epc in range(args.epochs):
+        timer.reset()
         epoch_loss = 0; epoch_num_tokens = 0; 
         epoch_tag_total_tokens = 0; epoch_tag_correct= 0; 
         epoch_labeled_pred_loss = 0; epoch_labeled_recon_loss = 0; 
@@ -75,30 +83,48 @@ def train(data, args):
         epoch_labeled_num_tokens = 0
         epoch_labeled_reinflect_recon_acc = 0
         random.shuffle(indices) # this breaks continuity if there is any
+        # batches of this rank (all of them if not distributed)
+        indices = broadcast_order(indices, args); rank_indices = shard(indices, args)
 
-        for i, lidx in enumerate(indices):
-            loss = torch.tensor(0.0).to('cuda')
+        for i, lidx in enumerate(rank_indices):
+            loss = torch.tensor(0.0).to(args.device)
             if update_ind % args.update_temp == 0:
                 tmp = get_temp(update_ind)
             kl_weight = get_kl_weight(update_ind, 0.2, 150000.0)
             args.model.zero_grad()
             update_ind +=1
-            lidx= indices[i]
+            lidx= rank_indices[i]
             lx_src, case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lx_tgt  = trnbatches[lidx] 
             # (batchsize)
-            loss_l, labeled_pred_loss, tag_correct, tag_total, labeled_recon_loss,  labeled_kl_loss, labeled_reinflect_recon_acc = args.model.loss_l(lx_src,case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lx_tgt, kl_weight, tmp)
-            epoch_labeled_num_tokens +=  torch.sum(lx_tgt[:,1:] !=0).item()
-            epoch_tag_correct += tag_correct
-            epoch_tag_total_tokens += tag_total
-            epoch_labeled_pred_loss += labeled_pred_loss.item()
-            epoch_labeled_recon_loss += labeled_recon_loss.sum().item()
-            epoch_labeled_kl_loss += labeled_kl_loss.sum().item()
-            epoch_labeled_reinflect_recon_acc  += labeled_reinflect_recon_acc
-            batch_loss = loss_l.mean()
-            batch_loss.backward()
-            opt.step()
-            epoch_loss += loss_l.sum().item()
-         
+            with timer.phase('forward'):
+                loss_l, labeled_pred_loss, tag_correct, tag_total, labeled_recon_loss,  labeled_kl_loss, labeled_reinflect_recon_acc = args.model.loss_l(lx_src,case,polar,mood,evid,pos,per,num,tense,aspect,inter,poss, lx_tgt, kl_weight, tmp)
+            with timer.phase('metrics'):
+                epoch_labeled_num_tokens +=  torch.sum(lx_tgt[:,1:] !=0).item()
+                epoch_tag_correct += tag_correct
+                epoch_tag_total_tokens += tag_total
+                epoch_labeled_pred_loss += labeled_pred_loss.item()
+                epoch_labeled_recon_loss += labeled_recon_loss.sum().item()
+                epoch_labeled_kl_loss += labeled_kl_loss.sum().item()
+                epoch_labeled_reinflect_recon_acc  += labeled_reinflect_recon_acc
+            with timer.phase('backward'):
+                batch_loss = loss_l.mean()
+                batch_loss.backward()
+            with timer.phase('all_reduce'):
+                all_reduce_grads(args.model, args)
+            with timer.phase('optimizer'):
+                opt.step()
+            with timer.phase('metrics'):
+                epoch_loss += loss_l.sum().item()
+            timer.count(lx_tgt.size(0), lx_tgt.size(0) * (lx_tgt.size(1)-1))
+            profiler.step()
+        # sums over all ranks
+        with timer.phase('metrics'):
+            epoch_loss, epoch_tag_correct, epoch_tag_total_tokens, epoch_labeled_pred_loss, epoch_labeled_recon_loss, epoch_labeled_kl_loss, epoch_labeled_num_tokens, epoch_labeled_reinflect_recon_acc = \
+                all_reduce_sums([epoch_loss, epoch_tag_correct, epoch_tag_total_tokens, epoch_labeled_pred_loss, epoch_labeled_recon_loss, epoch_labeled_kl_loss, epoch_labeled_num_tokens, epoch_labeled_reinflect_recon_acc], args)
+        if not is_main(args):
+            # rank 0 validates and saves meanwhile
+            barrier(args)
+            continue
         loss = epoch_loss / numwords  
         labeled_pred_loss = epoch_labeled_pred_loss/ epoch_tag_total_tokens
         labeled_pred_acc  = epoch_tag_correct/ epoch_tag_total_tokens
@@ -110,16 +136,21 @@ def train(data, args):
         args.logger.write('\ntrn--- loss: %.4f, labeled_pred_loss: %.4f, labeled_pred_acc: %.4f, labeled_recon_loss: %.4f,  labeled_kl_loss: %.4f, labeled_reinflect_recon_acc: %.4f \n' % (loss, labeled_pred_loss, labeled_pred_acc, labeled_recon_loss,  labeled_kl_loss,  labeled_reinflect_recon_acc))
         # VAL
         args.model.eval()
-        with torch.no_grad():
+        with timer.phase('validation'), torch.no_grad():
             loss, recon = test(valbatches, "val", args, kl_weight, tmp)
         if loss < best_loss:
             args.logger.write('update best loss \n')
             best_loss = loss
-            torch.save(args.model.state_dict(), args.save_path)
+            with timer.phase('checkpoint'):
+                torch.save(args.model.state_dict(), args.save_path)
         # SHARED TASK
         if epc % 10 == 0:
-            shared_task_gen(tstbatches, args)
+            with timer.phase('validation'):
+                shared_task_gen(tstbatches, args)
+        timer.log(epc, logger=args.logger)
         args.model.train()
+        barrier(args)
+    profiler.stop()
 
 def get_temp(update_ind):
     return max(0.5, math.exp(-3 * 1e-5 * update_ind))
@@ -154,8 +185,13 @@ def shared_task_gen(batches, args):
 
 # CONFIG
 parser = argparse.ArgumentParser(description='')
+parser.add_argument('--time_phases', action='store_true', help='log the time of each training phase and the words/tokens per second of every epoch')
+parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
 args = parser.parse_args()
 args.device = 'cuda'
+# under torchrun: one cpu process per rank (gloo), see README
+init_distributed(args)
 # training
 args.batchsize = 128; args.epochs = 1
 args.opt= 'Adam'; args.lr = 0.001
@@ -198,7 +234,7 @@ except FileExistsError:
 args.save_path = args.modelname +  str(args.epochs)+'epochs.pt'
 args.log_path =  args.modelname +  str(args.epochs)+'epochs.log'
 args.fig_path =  args.modelname +  str(args.epochs)+'epochs.png'
-args.logger = Logger(args.log_path)
+args.logger = Logger(args.log_path) if is_main(args) else QuietLogger()
 with open(args.modelname+'/surf_vocab.json', 'w') as f:
     f.write(json.dumps(surf_vocab.word2id))
 args.logger.write('\nnumber of params: %d \n' % count_parameters(args.model))
@@ -8,7 +8,7 @@ import math
 import torch
 import torch.nn as nn
 import numpy as np
-from common.utils import log_sum_exp
+from common.utils import log_sum_exp, pad_candidates, reduce_candidate_loss
 
 class VAE_Encoder(nn.Module):
     """ LSTM Encoder with constant-length batching"""
@@ -226,7 +226,8 @@ class VAE(nn.Module):
             recon_loss = recon_loss[:,:,-1]
 
         # avg over batches and samples
-        recon_acc  = self.accuracy(output_logits, tgt)
+        # (batch_size * nsample, seq_len) targets, so batches of words can be scored with several samples
+        recon_acc  = self.accuracy(output_logits, _tgt.view(-1, seq_len))
         return recon_loss, recon_acc
 
     def log_probability(self, x, z, recon_type='avg'):
@@ -240,6 +241,25 @@ class VAE(nn.Module):
         """
         return -self.recon_loss(x, z, recon_type)[0]
 
+    def score_candidates(self, encoding, candidates, recon_type='sum'):
+        """Teacher-forced log p(candidate|z) of many candidates against one latent, in one pass
+        Args:
+            encoding: z, (1, 1, nz)
+            candidates: list of words
+        Returns: Tensor
+            log_p: (num_candidates)
+        """
+        x = pad_candidates(self.decoder.vocab, candidates, device=encoding.device)
+        src = x[:, :-1]
+        tgt = x[:, 1:]
+        # (num_candidates, 1, nz)
+        z = encoding.expand(x.size(0), 1, self.nz).contiguous()
+        # (num_candidates, seq_len, vocab_size)
+        output_logits = self.decoder(src, z)
+        # (num_candidates, seq_len)
+        loss = self.decoder.loss(output_logits.reshape(-1, output_logits.size(2)), tgt.reshape(-1)).view(tgt.size())
+        return -reduce_candidate_loss(loss, tgt, recon_type)
+
     def reparameterize(self, mu, logvar, nsamples=1):
         """sample from posterior Gaussian family
         Args:
@@ -312,6 +332,47 @@ class VAE(nn.Module):
         log_gen = self.eval_cond_ll(x, z, recon_type)
         return log_prior + log_gen
 
+    def eval_grid_posterior(self, x, zrange, dz=None, recon_type='sum', chunksize=1000):
+        """compute the true posterior moments and log p(x) by walking a grid in chunks,
+        with running normalizers, so memory is bounded by chunksize instead of the grid size
+        Args:
+            x: Tensor
+                input with shape [batch, seq_len]
+            zrange: Tensor
+                grid points with shape (k^nz, nz), e.g. from generate_grid
+            dz: grid spacing, gives the cell volume of log p(x); if None log p(x) is up to log(dz^nz)
+        Returns: Tensor1, Tensor2, Tensor3
+            Tensor1: posterior mean, shape [batch, nz]
+            Tensor2: posterior variance, shape [batch, nz]
+            Tensor3: log p(x) = log sum_z p(x,z) dz^nz, shape [batch]
+        """
+        batch_size = x.size(0)
+        # running max of log p(x,z), and sums of p(x,z), p(x,z) z, p(x,z) z^2 rescaled to it
+        log_max = None
+        for i in range(0, zrange.size(0), chunksize):
+            # (k, nz)
+            z = zrange[i:i+chunksize]
+            # (batch, k)
+            log_comp_ll = self.eval_complete_ll(x, z.unsqueeze(0).expand(batch_size, -1, -1).contiguous(), recon_type)
+            chunk_max = log_comp_ll.max(dim=-1, keepdim=True)[0]
+            if log_max is None:
+                log_max = chunk_max
+                s0 = torch.zeros_like(chunk_max); s1 = z.new_zeros(batch_size, z.size(1)); s2 = z.new_zeros(batch_size, z.size(1))
+            new_max = torch.max(log_max, chunk_max)
+            scale = torch.exp(log_max - new_max)
+            # (batch, k)
+            w = torch.exp(log_comp_ll - new_max)
+            s0 = s0 * scale + w.sum(-1, keepdim=True)
+            s1 = s1 * scale + w @ z
+            s2 = s2 * scale + w @ z.pow(2)
+            log_max = new_max
+        post_mean = s1 / s0
+        post_var = (s2 / s0 - post_mean.pow(2)).clamp(min=0)
+        log_px = (log_max + torch.log(s0)).squeeze(1)
+        if dz is not None:
+            log_px = log_px + zrange.size(1) * math.log(dz)
+        return post_mean, post_var, log_px
+
     def eval_inference_dist(self, x, z, param=None):
         """
         Returns: Tensor
@@ -321,7 +382,7 @@ class VAE(nn.Module):
         return self.encoder.eval_inference_dist(x, z, param)
 
 
-    def nll_iw(self, x, nsamples, z, param, recon_type='avg', ns=100):
+    def nll_iw(self, x, nsamples, z=None, param=None, recon_type='avg', ns=100):
         """compute the importance weighting estimate of the log-likelihood
         Args:
             x: if the data is constant-length, x is the data tensor with
@@ -329,18 +390,24 @@ class VAE(nn.Module):
                 the data tensor and length list
             nsamples: Int
                 the number of samples required to estimate marginal data likelihood
+            z: Tensor (batch, nsamples, nz), samples to evaluate; if None, samples are
+                drawn from q(z|x) (param) ns at a time, so memory does not grow with nsamples
+            ns: Int
+                the number of samples evaluated at once
         Returns: Tensor1
             Tensor1: the estimate of log p(x), shape [batch]
         """
-        # compute iw every ns samples to address the memory issue (?)
-        # nsamples = 500, ns = 100
-        # nsamples = 500, ns = 10
-        tmp = []
-        for _ in range(1):#range(int(nsamples / ns)):
-            # logp_xz + logpz
-            log_comp_ll = self.eval_complete_ll(x, z, recon_type)
-            # logqz, param is the parameters required to evaluate q(z|x)
-            log_infer_ll = self.eval_inference_dist(x, z, param) 
-            tmp.append(log_comp_ll - log_infer_ll)
-        ll_iw = log_sum_exp(torch.cat(tmp, dim=-1), dim=-1) - math.log(nsamples)
-        return ll_iw #-ll_iw
+        if param is None:
+            param = self.encoder(x)
+        mu, logvar, _ = param
+        # running log-sum-exp of the importance weights over chunks of ns samples
+        ll_iw = None
+        for i in range(0, nsamples, ns):
+            n = min(ns, nsamples - i)
+            # (batch, n, nz)
+            _z = self.reparameterize(mu, logvar, n) if z is None else z[:, i:i+n].contiguous()
+            # logp_xz + logpz - logqz, (batch, n)
+            log_ws = self.eval_complete_ll(x, _z, recon_type) - self.eval_inference_dist(x, _z, param)
+            chunk_ll = log_sum_exp(log_ws, dim=-1)
+            ll_iw = chunk_ll if ll_iw is None else torch.logaddexp(ll_iw, chunk_ll)
+        return ll_iw - math.log(nsamples)
@@ -7,6 +7,7 @@
 from common.vocab import VocabEntry
 from vae import VAE
 from common.utils import *
+from common.graphs import Graphs, export_graphs
 import sys, argparse, random, torch, json, matplotlib, os
 import numpy as np
 
@@ -19,18 +20,15 @@ def sample(args, z):
     # (1,1,dec_nh)
     c_init = args.model.decoder.trans_linear(z)
     h_init = torch.tanh(c_init)
-    decoder_hidden = (c_init, h_init)
+    h, c = c_init, h_init
     sampled = []; i = 0; max_length = 50
     word = ''
     while i < max_length:
         i +=1
-        # (1,1,ni)
-        word_embed = args.model.decoder.embed(torch.tensor([input]).unsqueeze(0))
-        word_embed = torch.cat((word_embed, z), -1)
-        # output: (1,1,dec_nh)
-        output, decoder_hidden = args.model.decoder.lstm(word_embed, decoder_hidden)
+        # (1,1,ni+nz) input, scripted step when exported
+        output_logits, h, c = args.graphs.decoder_step(torch.tensor([input]).unsqueeze(0), z, h, c)
         # (1, vocab_size)
-        output_logits = args.model.decoder.pred_linear(output).squeeze(1)
+        output_logits = output_logits.squeeze(1)
         input = torch.argmax(sft(output_logits)) 
         #input = torch.multinomial(sft(output_logits), num_samples=1) # sample
         char = args.vocab.id2word(input.item())
@@ -44,6 +42,7 @@ def sample(args, z):
 def config():
     # CONFIG
     parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--export_graphs', action='store_true', help='script the inference graphs of the model and save them next to its checkpoint')
     args = parser.parse_args()
     args.device = 'cuda'
     model_id = 'vae_segm'
@@ -70,6 +69,10 @@ def config():
     # load model weights
     args.model.load_state_dict(torch.load(model_path))
     args.model.eval()
+    # scripted inference graphs next to the checkpoint, used when present
+    if args.export_graphs:
+        export_graphs(args.model, model_path)
+    args.graphs = Graphs(args.model, model_path)
     return args
 
 def main():
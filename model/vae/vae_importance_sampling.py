@@ -7,30 +7,85 @@
 from common.vocab import VocabEntry
 from model.vae.vae import VAE
 from common.utils import *
-import sys, argparse, random, torch, json, matplotlib, os
+import sys, argparse, random, torch, json, matplotlib, os, math
 from evaluation.morph_segmentation.data.data import build_data
+from evaluation.morph_segmentation.prefix_scoring import encode_words, length_tensor_batches
 import numpy as np
 from scipy.stats import norm
 from scipy.special import logsumexp
 from statistics import stdev, mean
 
-# does the experiment nruns times 
-# and returns mean, std of logpx of runs
-def run(args, data, sample_from, nsamples, nruns=10, fw=None):
-    run_logpx_values =[]
-    for r in range(nruns):  
-        mu, logvar, _ = args.model.encoder(sample_from)
-        param = (mu,logvar,_)
-        z = args.model.reparameterize(mu, logvar, nsamples)
-        logpx = args.model.nll_iw(data, nsamples, z, param)
-        logpx = torch.mean(logpx).item()
-        '''mu, logvar, _ = args.model.encoder(sample_from)
-        cur = args.model.reparameterize(mu,logvar,nsamples)
-        logpx = args.model.eval_complete_ll(data, cur, args.recon_type)
-        logpx = torch.mean(logpx).item()'''
-        run_logpx_values.append(logpx)
+# log p(x) estimates of nruns runs for every sample count in one pass
+def iw_estimates(args, x, mu, logvar, nsamples_list, nruns=10, ns=100):
+    # x: (P, T) equal-length rows, mu, logvar: (P, nz) of their conditioning words ---> {nsamples: (P, nruns)}
+    # runs are an extra batch dimension: (P*nruns, T), (P*nruns, nz)
+    P = x.size(0)
+    x = x.repeat_interleave(nruns, dim=0)
+    mu, logvar = mu.repeat_interleave(nruns, dim=0), logvar.repeat_interleave(nruns, dim=0)
+    param = (mu, logvar, None)
+    # the first n samples of a run give its estimate with n samples,
+    # so larger counts reuse the samples drawn for the smaller ones
+    estimates = dict()
+    ll_iw = None; drawn = 0
+    for nsamples in sorted(set(nsamples_list)):
+        while drawn < nsamples:
+            n = min(ns, nsamples - drawn)
+            # (P*nruns, n, nz)
+            z = args.model.reparameterize(mu, logvar, n)
+            # (P*nruns, n)
+            log_ws = args.model.eval_complete_ll(x, z, args.recon_type) - args.model.eval_inference_dist(x, z, param)
+            chunk_ll = log_sum_exp(log_ws, dim=-1)
+            ll_iw = chunk_ll if ll_iw is None else torch.logaddexp(ll_iw, chunk_ll)
+            drawn += n
+        estimates[nsamples] = (ll_iw - math.log(nsamples)).view(P, nruns)
+    return estimates
+
+# does the experiment nruns times for every sample count in one pass
+# and returns mean, std and logpx of runs for each count
+def run(args, data, sample_from, nsamples_list, nruns=10, ns=100):
+    # encode once
+    mu, logvar, _ = args.model.encoder(sample_from)
+    estimates = iw_estimates(args, data, mu, logvar, nsamples_list, nruns, ns)
+    run_logpx_values = {nsamples: values[0].tolist() for nsamples, values in estimates.items()}
+    return [(mean(run_logpx_values[nsamples]), stdev(run_logpx_values[nsamples]), run_logpx_values[nsamples]) for nsamples in nsamples_list]
+
+def run_batched(args, pairs, nsamples_list, nruns=10, fout=None, batchsize=16, ns=100):
+    """Estimates many (word, subword) pairs together
+    Args:
+        pairs: (word, subword, sample_from) char ids (without <s>, </s>), log p(subword) is
+               estimated with samples from q(z|sample_from)
+    Returns:
+        one record per pair, also written to fout as a JSONL line
+    """
+    bosid = args.vocab.word2id['<s>']; eosid = args.vocab.word2id['</s>']
+    # encode each conditioning word once
+    sample_froms = sorted(set(tuple(p[2]) for p in pairs))
+    mu, logvar = encode_words(args.vocab, [list(w) for w in sample_froms], lambda x: args.model.encoder(x)[:2], batchsize, args.device)
+    cond = {w: i for i, w in enumerate(sample_froms)}
+    cond = torch.tensor([cond[tuple(p[2])] for p in pairs], dtype=torch.long, device=args.device)
+    data = [[bosid] + p[1] + [eosid] for p in pairs]
+    records = [None] * len(pairs)
+    for inds, x in length_tensor_batches(data, batchsize, args.device):
+        estimates = iw_estimates(args, x, mu[cond[inds]], logvar[cond[inds]], nsamples_list, nruns, ns)
+        estimates = {nsamples: values.tolist() for nsamples, values in estimates.items()}
+        for k, i in enumerate(inds):
+            word, subword, sample_from = pairs[i]
+            runs = [estimates[nsamples][k] for nsamples in nsamples_list]
+            records[i] = {'word': ''.join(args.vocab.decode_sentence_2(word)),
+                          'subword': ''.join(args.vocab.decode_sentence_2(subword)),
+                          'sample_from': ''.join(args.vocab.decode_sentence_2(sample_from)),
+                          'nruns': nruns, 'nsamples': list(nsamples_list),
+                          'mean': [mean(r) for r in runs], 'stdev': [stdev(r) for r in runs], 'runs': runs}
+    if fout is not None:
+        for record in records:
+            fout.write(json.dumps(record) + '\n')
+    return records
+
+def write_runs(fw, nsamples, nruns, mean_runs, stdev_runs, run_logpx_values):
+    fw.write("\n---\n")
+    for r, logpx in enumerate(run_logpx_values):
         fw.write("run %d: log p(x) = %.2f \n" % (r, logpx))
-    return mean(run_logpx_values), stdev(run_logpx_values)
+    fw.write("\nnumber of samples: %d, number of runs: %d, mean: %.4f, stddev: %.4f" % (nsamples, nruns, mean_runs, stdev_runs))
 
 
 def config():
@@ -47,6 +102,10 @@ def config():
     # logging
     args.logdir = 'model/vae/results/importance_sampling/'+model_id+'/'+args.recon_type+'/nsamples1-60000/'+args.sample_type+'/'
     args.logfile = args.logdir + 'importance_sampling.txt'
+    # batched: all (word, subword) pairs estimated together, results in one jsonl file
+    args.batched = True
+    args.fjsonl = args.logdir + 'importance_sampling.jsonl'
+    args.pair_batchsize = 16
     try:
         os.makedirs(args.logdir)
         print("Directory " , args.logdir ,  " Created ") 
@@ -87,17 +146,26 @@ def main():
                 word = ''.join(args.vocab.decode_sentence(data[0][1:-1]))
                 print(word)
                 f = open(args.logfile+'_'+word, "w")
-                # loop through each nsamples 
-                for nsamples in nsamples_list:
-                    f.write("\n---\n")
-                    # run same experiment multiple times
-                    mean_runs, stdev_runs = run(args, data, sample_from, nsamples, nruns, f)
+                # all sample counts in one pass, runs batched
+                for nsamples, (mean_runs, stdev_runs, run_logpx_values) in zip(nsamples_list, run(args, data, sample_from, nsamples_list, nruns)):
                     means.append(mean_runs)
-                    f.write("\nnumber of samples: %d, number of runs: %d, mean: %.4f, stddev: %.4f" % (nsamples, nruns, mean_runs, stdev_runs))
+                    write_runs(f, nsamples, nruns, mean_runs, stdev_runs, run_logpx_values)
                 f.close()
 
+        # all words' subwords in batches, enable if necessary
+        if args.batched:
+            pairs = []
+            for data in batches:
+                word = data[0][1:-1].tolist()
+                for i in range(len(word)-1, 0, -1):
+                    subword = word[:i]
+                    sample_from = word if args.sample_type == 'word_given' else subword
+                    pairs.append((word, subword, sample_from))
+            with open(args.fjsonl, 'w') as fout:
+                run_batched(args, pairs, nsamples_list, nruns, fout, args.pair_batchsize)
+
         # loop through each word's subwords, enable if necessary
-        if True: 
+        if not args.batched: 
             for data in batches:
                 for i in range(len(data[0])-2, 1, -1):
                     eos  = torch.tensor([2]).to(args.device)
@@ -110,11 +178,9 @@ def main():
                     word = ''.join(args.vocab.decode_sentence(subdata[1:-1]))
                     print(word)
                     f = open(args.logfile+'_'+word, "w")
-                    for nsamples in nsamples_list:
-                        f.write("\n---\n")
-                        mean_runs, stdev_runs = run(args, subdata.unsqueeze(0), sample_from, nsamples, nruns, f)
+                    for nsamples, (mean_runs, stdev_runs, run_logpx_values) in zip(nsamples_list, run(args, subdata.unsqueeze(0), sample_from, nsamples_list, nruns)):
                         means.append(mean_runs)
-                        f.write("\nnumber of samples: %d, number of runs: %d, mean: %.4f, stddev: %.4f" % (nsamples, nruns, mean_runs, stdev_runs))
+                        write_runs(f, nsamples, nruns, mean_runs, stdev_runs, run_logpx_values)
                     f.close()
 
 if __name__=="__main__":
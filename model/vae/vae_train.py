@@ -9,6 +9,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 from vae import VAE
 from common.utils import *
+from common.timers import PhaseTimer
+from common.profiling import StepProfiler
 from torch import optim
 from data.data import build_data, log_data
 matplotlib.use('Agg')
@@ -57,7 +59,11 @@ def train(data, args):
     #random.seed(0)
     kl_weight = args.kl_start
     anneal_rate = (1.0 - args.kl_start) / (args.warm_up * numbatches)
+    timer = PhaseTimer(args.time_phases, args.device)
+    profiler = StepProfiler(args.profile, args.modelname+'profile/', 'train', args.profile_steps, args.device)
+    profiler.start()
     for epc in range(args.epochs):
+        timer.reset()
         epoch_loss = 0; epoch_num_tokens = 0; epoch_acc = 0
         epoch_encoder_fhs = []
         epoch_kl_loss = 0; epoch_recon_loss = 0
@@ -69,17 +75,23 @@ def train(data, args):
             # (batchsize, t)
             surf = trnbatches[idx] 
             # (batchsize)
-            loss, recon_loss, kl_loss, acc, encoder_fhs = args.model.loss(surf, kl_weight)
+            with timer.phase('forward'):
+                loss, recon_loss, kl_loss, acc, encoder_fhs = args.model.loss(surf, kl_weight)
             epoch_encoder_fhs.append(encoder_fhs)
-            batch_loss = loss.mean()
-            batch_loss.backward()
+            with timer.phase('backward'):
+                batch_loss = loss.mean()
+                batch_loss.backward()
             #torch.nn.utils.clip_grad_norm_(args.model.parameters(),  5.0)
-            opt.step()
-            epoch_num_tokens += surf.size(0) * (surf.size(1)-1) # exclude start token prediction
-            epoch_loss       += loss.sum().item()
-            epoch_recon_loss += recon_loss.sum().item()
-            epoch_kl_loss    += kl_loss.sum().item()
-            epoch_acc        += acc
+            with timer.phase('optimizer'):
+                opt.step()
+            with timer.phase('metrics'):
+                epoch_num_tokens += surf.size(0) * (surf.size(1)-1) # exclude start token prediction
+                epoch_loss       += loss.sum().item()
+                epoch_recon_loss += recon_loss.sum().item()
+                epoch_kl_loss    += kl_loss.sum().item()
+                epoch_acc        += acc
+            timer.count(surf.size(0), surf.size(0) * (surf.size(1)-1))
+            profiler.step()
         loss = epoch_loss / numwords  
         recon = epoch_recon_loss / numwords
         kl = epoch_kl_loss / numwords
@@ -95,7 +107,7 @@ def train(data, args):
 
         # VAL
         args.model.eval()
-        with torch.no_grad():
+        with timer.phase('validation'), torch.no_grad():
             loss, recon, kl, acc = test(valbatches, "val", args, kl_weight)
         val_loss_values.append(loss)
         val_kl_values.append(kl)
@@ -103,8 +115,11 @@ def train(data, args):
         if loss < best_loss:
             args.logger.write('update best loss \n')
             best_loss = loss
-        torch.save(args.model.state_dict(), args.save_path+'_'+str(epc)) # do not save best model but last
+        with timer.phase('checkpoint'):
+            torch.save(args.model.state_dict(), args.save_path+'_'+str(epc)) # do not save best model but last
+        timer.log(epc, logger=args.logger)
         args.model.train()
+    profiler.stop()
     plot_curves(args.task, args.mname, args.fig, args.axs[0], trn_loss_values, val_loss_values, args.plt_style, 'loss')
     plot_curves(args.task, args.mname, args.fig, args.axs[1], trn_kl_values, val_kl_values, args.plt_style, 'kl_loss')
     plot_curves(args.task, args.mname, args.fig, args.axs[2], trn_recon_loss_values, val_recon_loss_values, args.plt_style, 'recon_loss')
@@ -112,6 +127,9 @@ def train(data, args):
 
 # CONFIG
 parser = argparse.ArgumentParser(description='')
+parser.add_argument('--time_phases', action='store_true', help='log the time of each training phase and the words/tokens per second of every epoch')
+parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
 args = parser.parse_args()
 args.device = 'cuda'
 # training
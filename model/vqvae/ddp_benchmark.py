@@ -0,0 +1,71 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Scaling benchmark of data-parallel cpu training (gloo) of the kl_bi VQVAE
+#              on synthetic batches, see README for the launch commands
+# -----------------------------------------------------------
+
+import sys, argparse, random, time, os, torch
+from vqvae_kl_bi import VQVAE
+from common.utils import *
+from common.vocab import VocabEntry
+from common.distributed import init_distributed, is_main, barrier, broadcast_params, broadcast_order, shard, all_reduce_grads
+from torch import optim
+
+# CONFIG
+parser = argparse.ArgumentParser(description='')
+parser.add_argument('--numbatches', type=int, default=64, help='batches of an epoch, split between the ranks')
+parser.add_argument('--batchsize', type=int, default=128)
+parser.add_argument('--wordlen', type=int, default=12, help='characters per word, batches are equal-length as in training')
+parser.add_argument('--epochs', type=int, default=2, help='timed epochs, after one warm-up epoch')
+parser.add_argument('--fout', type=str, default='model/vqvae/results/ddp_benchmark.tsv')
+args = parser.parse_args()
+args.device = 'cpu'
+init_distributed(args)
+# model, sizes of vqvae_train_kl_bi
+args.enc_dropout_in = 0.0; args.enc_dropout_out = 0.0
+args.dec_dropout_in = 0.5; args.dec_dropout_out = 0.0
+args.ni = 256; args.enc_nh = 300; args.dec_nh = 256
+args.embedding_dim = args.enc_nh
+args.beta = 0.2; args.nz = 128
+args.num_dicts = 2; args.outcat = 0; args.orddict_emb_num = 100; args.incat = args.enc_nh
+vocab = VocabEntry()
+for c in 'abcdefghijklmnopqrstuvwxyz':
+    vocab.word2id[c] = len(vocab.word2id)
+vocab.id2word_ = {i: w for w, i in vocab.word2id.items()}
+torch.manual_seed(0); random.seed(0)
+args.model = VQVAE(args, vocab, uniform_initializer(0.01), uniform_initializer(0.1), dict_assemble_type='sum_and_concat', bidirectional=True)
+args.model.to(args.device)
+batches = [torch.randint(4, len(vocab.word2id), (args.batchsize, args.wordlen)) for _ in range(args.numbatches)]
+
+# RUN
+opt = optim.Adam(filter(lambda p: p.requires_grad, args.model.parameters()), lr=0.001, weight_decay=1e-5)
+broadcast_params(args.model, args)
+indices = list(range(len(batches)))
+epoch_times = []
+for epc in range(args.epochs + 1):
+    random.shuffle(indices)
+    indices = broadcast_order(indices, args)
+    rank_indices = shard(indices, args)
+    barrier(args)
+    start = time.time()
+    for idx in rank_indices:
+        args.model.zero_grad()
+        loss = args.model.loss(batches[idx], 0.1, epc)[0]
+        loss.mean().backward()
+        all_reduce_grads(args.model, args)
+        opt.step()
+    barrier(args)
+    if epc > 0:
+        epoch_times.append(time.time() - start)
+
+if is_main(args):
+    world_size = getattr(args, 'world_size', 1)
+    words = len(rank_indices) * world_size * args.batchsize
+    secs = sum(epoch_times) / len(epoch_times)
+    print('ranks: %d, threads/rank: %d, words/epoch: %d, sec/epoch: %.2f, words/sec: %.1f' % (world_size, torch.get_num_threads(), words, secs, words/secs))
+    new_file = not os.path.exists(args.fout)
+    os.makedirs(os.path.dirname(args.fout), exist_ok=True)
+    with open(args.fout, 'a') as writer:
+        if new_file:
+            writer.write('ranks\tthreads_per_rank\tbatchsize\twordlen\twords_per_epoch\tsec_per_epoch\twords_per_sec\n')
+        writer.write('%d\t%d\t%d\t%d\t%d\t%.3f\t%.1f\n' % (world_size, torch.get_num_threads(), args.batchsize, args.wordlen, words, secs, words/secs))
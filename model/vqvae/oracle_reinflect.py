@@ -10,7 +10,11 @@ from common.vocab import VocabEntry
 
 
 from data.data import read_data
+from vqvae_shared_task import read_shared_task, batch_oracle, format_codes
 from common.utils import *
+from common.decoding import greedy_decode, source_length_cap
+from common.graphs import Graphs, export_graphs
+from common.profiling import StepProfiler
 import sys, argparse, random, torch, json, matplotlib, os
 
 def reinflect(args, inflected_word, reinflect_tag):
@@ -30,8 +34,11 @@ def reinflect(args, inflected_word, reinflect_tag):
         vq_vectors.append(_root_fhs)
 
     if args.model_type == 'bi_kl' or args.model_type == 'bi_kl_sum':
-        # kl version
-        fhs, _, _, mu, logvar, fwd,bck = args.model.encoder(x)
+        # kl version, scripted encoder when exported
+        if hasattr(args.graphs, 'encoder'):
+            fhs, mu, logvar, fwd, bck = args.graphs.encoder(x)
+        else:
+            fhs, _, _, mu, logvar, fwd,bck = args.model.encoder(x)
         _root_fhs = mu.unsqueeze(0)
         #_root_fhs = args.model.reparameterize(mu, logvar)
         _root_fhs = args.model.z_to_dec(_root_fhs)
@@ -94,23 +101,15 @@ def reinflect(args, inflected_word, reinflect_tag):
     c_init = root_z
     h_init = torch.tanh(c_init)
     decoder_hidden = (h_init, c_init)
-    copied = []; i = 0
-    MAX_LENGTH = 50
-    c=0
-    while c<MAX_LENGTH:
-        c+=1
-        # (1,1,ni)
-        word_embed = args.model.decoder.embed(torch.tensor([input]).unsqueeze(0))
-        word_embed = torch.cat((word_embed, z_), -1)
-        # output: (1,1,dec_nh)
-        output, decoder_hidden = args.model.decoder.lstm(word_embed, decoder_hidden)
-        # (1, vocab_size)
-        output_logits = args.model.decoder.pred_linear(output).squeeze(1)
-        input = torch.argmax(sft(output_logits))
-        char = args.vocab.id2word(input.item())
-        copied.append(char)
-        if char == '</s>':
-            return(''.join(copied), (reinflect_tag))
+    # (1,1,ni+incat) inputs, scripted step when exported
+    step = args.graphs.step(z_)
+    # stops at </s>, or at a length cap derived from the source word
+    eosid = args.vocab.word2id['</s>']
+    max_lengths = source_length_cap(torch.tensor([x.size(1)-1])).clamp(max=50)
+    preds, _ = greedy_decode(step, decoder_hidden, torch.tensor([[bosid]]), eosid, max_lengths, padid=eosid)
+    copied = args.vocab.decode_sentence_2(preds[0].tolist())
+    if '</s>' in copied:
+        copied = copied[:copied.index('</s>')+1]
     return(''.join(copied), (reinflect_tag))
 
 
@@ -129,6 +128,9 @@ def oracle(args, asked_tag, inflected_word, reinflected_word, itr=0):
 def config():
     # CONFIG
     parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--export_graphs', action='store_true', help='script the inference graphs of the model and save them next to its checkpoint')
+    parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+    parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='words decoded before profiling, warm-up words and profiled words')
     args = parser.parse_args()
     args.device = 'cuda'
     model_id = 'unilstm_4x10_dec100_suffixd512'
@@ -234,6 +236,10 @@ def config():
     # load model weights
     args.model.load_state_dict(torch.load(model_path))
     args.model.eval()
+    # scripted inference graphs next to the checkpoint, used when present
+    if args.export_graphs:
+        export_graphs(args.model, model_path)
+    args.graphs = Graphs(args.model, model_path)
     return args
 
 def main():
@@ -248,14 +254,12 @@ def main():
             
 
 
-        with open('data/sigmorphon2016/turkish-task3-test', 'r') as reader:
-            with open(args.logdir + 'oracle.txt', 'w') as writer:
-                for line in reader:
-                    split_line = line.split('\t')
-                    asked_tag  = split_line[1]
-                    inflected_word = split_line[0]
-                    reinflected_word = split_line[2].strip()
-                    writer.write(oracle(args, asked_tag, inflected_word, reinflected_word)+'\n')
+        entries = read_shared_task('data/sigmorphon2016/turkish-task3-test')
+        # oracle codes of all gold reinflections in one batched pass
+        codes = format_codes(batch_oracle(args.model, args.vocab, [reinflected_word for (_, _, reinflected_word) in entries], graphs=args.graphs))
+        with open(args.logdir + 'oracle.txt', 'w') as writer:
+            for (inflected_word, asked_tag, reinflected_word), mapped_inds in zip(entries, codes):
+                writer.write(''.join(inflected_word) +'\t'+ asked_tag +'\t'+ mapped_inds +'\t---> ' + reinflected_word+'\n')
 
         with open(args.logdir+args.model_id+'_turkish-task3-test_reinflected', 'w') as writer:
             with open(args.logdir+args.model_id+'_turkish-task3-test_reinflected_true', 'w') as writer_true:
@@ -265,6 +269,9 @@ def main():
                         for line in reader:
                             keys.append( line.split('\t')[2].strip().split('-'))
 
+                    # one profiler step per reinflected word
+                    profiler = StepProfiler(args.profile, args.logdir+'profile/', 'oracle_reinflect', args.profile_steps, args.device)
+                    profiler.start()
                     with open('data/sigmorphon2016/turkish-task3-test', 'r') as reader:
                         true=0; false = 0
                         for i,line in enumerate(reader):
@@ -284,6 +291,8 @@ def main():
                             else:
                                 false+=1
                                 writer_false.write(inflected_word +'\t'+gold_reinflection + '\t'+reinflected_word+'\t'+ '-'.join([str(s) for s in vq_code])+'\n')
+                            profiler.step()
+                    profiler.stop()
 
                     print('true %d, false %d, total %d, accuracy: %.2f' % (true,false, true+false, true/(true+false)))
                     writer_true.write('true %d, false %d, total %d, accuracy: %.2f' % (true,false, true+false, true/(true+false)))
@@ -3,6 +3,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from common.utils import *
+from common.decoding import greedy_decode
 from typing import TypeVar, List
 Tensor = TypeVar('torch.tensor')
 
@@ -227,15 +228,11 @@ class VQVAE_AE(nn.Module):
         batch_size, seq_len = src.size()
         
         decoder_input = src[:,0].unsqueeze(1)
-        output_logits = []
-        for di in range(seq_len):
-            decoder_output, decoder_hidden  = self.decoder(
-                decoder_input, decoder_hidden)
-            output_logits.append(decoder_output)
-            topv, topi = decoder_output.topk(1)
-            decoder_input = topi.squeeze(1).detach()  # detach from history as input
+        step = lambda input, hidden, rows: self.decoder(input, hidden)
+        # every row runs all seq_len steps on its own predictions, also after its </s>, so every tgt position is scored
         # (batchsize, seq_len, vocabsize)
-        output_logits = torch.cat(output_logits,dim=1)
+        _, output_logits = greedy_decode(step, decoder_hidden, decoder_input, self.decoder.vocab.word2id['</s>'],
+                                         torch.full((batch_size,), seq_len, dtype=torch.long), keep_logits=True, stop_at_eos=False)
         # (batch_size *  seq_len, vocab_size)
         _output_logits = output_logits.reshape(-1, output_logits.size(2))
         _tgt = tgt.contiguous().view(-1)
@@ -276,5 +273,6 @@ class VQVAE_AE(nn.Module):
         sft = nn.Softmax(dim=2)
         # (batchsize, T)
         pred_tokens = torch.argmax(sft(output_logits),2)
-        acc = ((pred_tokens == tgt) * (tgt!=0)).sum().item()
+        # kept on device, summed by the trainers and read once per epoch
+        acc = ((pred_tokens == tgt) * (tgt!=0)).sum()
         return (acc, pred_tokens)
\ No newline at end of file
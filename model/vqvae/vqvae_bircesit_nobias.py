@@ -4,6 +4,7 @@ import torch, json
 from torch import nn
 from torch.nn import functional as F
 from common.utils import *
+from common.decoding import greedy_decode
 from typing import TypeVar, List
 Tensor = TypeVar('torch.tensor')
 
@@ -217,31 +218,17 @@ class VQVAE_Decoder(nn.Module):
         c_init = root_z
         h_init = torch.tanh(c_init)
 
-        sft = nn.Softmax(dim=2)
-
-        i = 0
         decoder_hidden = (c_init, h_init)
-        copied = []
         bosid = self.vocab.word2id['<s>']
-        input = torch.tensor(bosid)
-        input = input.repeat(batch_size,1).to('cuda')
-        logitss = []
-        while True:
-            # (1,1,ni)
-            word_embed = self.embed(input)
-            word_embed = torch.cat((word_embed, suffix_z), -1)
-            # output: (1,1,dec_nh)
-            output, decoder_hidden = self.lstm(word_embed, decoder_hidden)
-            # (1, vocab_size)
-            output_logits = self.pred_linear(output)
-            input = torch.argmax(sft(output_logits),dim=2) 
-            logitss.append(output_logits)
-            #char = self.vocab.id2word(input.item())
-            #copied.append(char)
-            i+=1
-            if i == seq_len:
-               break
-        output_logits =  torch.cat(logitss,dim=1)
+        input = torch.full((batch_size,1), bosid, dtype=torch.long, device=root_z.device)
+        def step(input, hidden, rows):
+            # (b,1,ni+incat)
+            word_embed = torch.cat((self.embed(input), suffix_z[rows]), -1)
+            output, hidden = self.lstm(word_embed, hidden)
+            return self.pred_linear(output), hidden
+        # every row stops at its own </s>, at most seq_len steps
+        _, output_logits = greedy_decode(step, decoder_hidden, input, self.vocab.word2id['</s>'],
+                                         torch.full((batch_size,), seq_len, dtype=torch.long), keep_logits=True)
         return output_logits
 
 class VQVAE(nn.Module):
@@ -343,12 +330,9 @@ class VQVAE(nn.Module):
         # (batchsize,1)
         vq_loss = vq_loss.unsqueeze(1)
 
-        suffix_codes = []
-        for i in range(vq_loss.shape[0]):
-            suffix_code = "" 
-            for j in range(0, len(vq_inds)):
-                suffix_code += '-' + str((vq_inds[j][0][i]).item()) 
-            suffix_codes.append(suffix_code)
+        # codes of all words in one transfer, e.g. '-3-0-7'
+        codes = torch.stack([inds[0] for inds in vq_inds], dim=1).tolist()
+        suffix_codes = [''.join('-' + str(ind) for ind in row) for row in codes]
         
         return vq_vectors, vq_loss, vq_inds,  fhs, [], suffix_codes, kl_loss, torch.tensor(0.0)
 
@@ -393,15 +377,11 @@ class VQVAE(nn.Module):
         batch_size, seq_len = src.size()
         
         decoder_input = src[:,0].unsqueeze(1)
-        output_logits = []
-        for di in range(seq_len):
-            decoder_output, decoder_hidden  = self.decoder(
-                decoder_input, quantized_z, decoder_hidden)
-            output_logits.append(decoder_output)
-            topv, topi = decoder_output.topk(1)
-            decoder_input = topi.squeeze(1).detach()  # detach from history as input
+        step = lambda input, hidden, rows: self.decoder(input, tuple(z[rows] for z in quantized_z), hidden)
+        # every row runs all seq_len steps on its own predictions, also after its </s>, so every tgt position is scored
         # (batchsize, seq_len, vocabsize)
-        output_logits = torch.cat(output_logits,dim=1)
+        _, output_logits = greedy_decode(step, decoder_hidden, decoder_input, self.decoder.vocab.word2id['</s>'],
+                                         torch.full((batch_size,), seq_len, dtype=torch.long), keep_logits=True, stop_at_eos=False)
         # (batch_size *  seq_len, vocab_size)
         _output_logits = output_logits.reshape(-1, output_logits.size(2))
         _tgt = tgt.contiguous().view(-1)
@@ -427,6 +407,28 @@ class VQVAE(nn.Module):
         return recon_loss, recon_acc, recon_preds
 
 
+    def score_candidates(self, encoding, candidates, recon_type='sum'):
+        """Teacher-forced log p(candidate|z) of many candidates against one word's latents, in one pass
+        Args:
+            encoding: quantized_inputs of one word, as returned by vq_loss, each (1, 1, *)
+            candidates: list of words
+        Returns: Tensor
+            log_p: (num_candidates)
+        """
+        x = pad_candidates(self.decoder.vocab, candidates, device=encoding[0].device)
+        src = x[:, :-1]
+        tgt = x[:, 1:]
+        # broadcast latents to (num_candidates, 1, *)
+        quantized_z = tuple(z.expand(x.size(0), -1, -1) for z in encoding)
+        # (1, num_candidates, dec_nh)
+        c_init = (quantized_z[0] + self.tag_to_dec(quantized_z[1])).permute((1,0,2)).contiguous()
+        h_init = torch.tanh(c_init)
+        output_logits, _ = self.decoder(src, quantized_z, (h_init, c_init))
+        # (num_candidates, seq_len)
+        loss = self.decoder.loss(output_logits.reshape(-1, output_logits.size(2)), tgt.reshape(-1)).view(tgt.size())
+        return -reduce_candidate_loss(loss, tgt, recon_type)
+
+
     def loss(self, x: Tensor, tags, kl_weight, epc, mode='train', **kwargs) -> List[Tensor]:
         # x: (B,T)
         # quantized_inputs: (B, 1, hdim)
@@ -460,7 +462,8 @@ class VQVAE(nn.Module):
         sft = nn.Softmax(dim=2)
         # (batchsize, T)
         pred_tokens = torch.argmax(sft(output_logits),2)
-        acc = ((pred_tokens == tgt) * (tgt!=0)).sum().item()
+        # kept on device, summed by the trainers and read once per epoch
+        acc = ((pred_tokens == tgt) * (tgt!=0)).sum()
 
         correct_predictions = []; wrong_predictions = []
         '''for i in range(batch_size):
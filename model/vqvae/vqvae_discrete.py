@@ -3,6 +3,7 @@ import torch, json
 from torch import nn
 from torch.nn import functional as F
 from common.utils import *
+from common.decoding import greedy_decode
 from typing import TypeVar, List
 Tensor = TypeVar('torch.tensor')
 
@@ -202,31 +203,17 @@ class VQVAE_Decoder(nn.Module):
         #c_init = self.trans_linear(z).unsqueeze(0)
         h_init = torch.tanh(c_init)
 
-        sft = nn.Softmax(dim=2)
-
-        i = 0
         decoder_hidden = (c_init, h_init)
-        copied = []
         bosid = self.vocab.word2id['<s>']
-        input = torch.tensor(bosid)
-        input = input.repeat(batch_size,1).to('cuda')
-        logitss = []
-        while True:
-            # (1,1,ni)
-            word_embed = self.embed(input)
-            word_embed = torch.cat((word_embed, suffix_z), -1)
-            # output: (1,1,dec_nh)
-            output, decoder_hidden = self.lstm(word_embed, decoder_hidden)
-            # (1, vocab_size)
-            output_logits = self.pred_linear(output)
-            input = torch.argmax(sft(output_logits),dim=2) 
-            logitss.append(output_logits)
-            #char = self.vocab.id2word(input.item())
-            #copied.append(char)
-            i+=1
-            if i == seq_len:
-               break
-        output_logits =  torch.cat(logitss,dim=1)
+        input = torch.full((batch_size,1), bosid, dtype=torch.long, device=root_z.device)
+        def step(input, hidden, rows):
+            # (b,1,ni+incat)
+            word_embed = torch.cat((self.embed(input), suffix_z[rows]), -1)
+            output, hidden = self.lstm(word_embed, hidden)
+            return self.pred_linear(output), hidden
+        # every row stops at its own </s>, at most seq_len steps
+        _, output_logits = greedy_decode(step, decoder_hidden, input, self.vocab.word2id['</s>'],
+                                         torch.full((batch_size,), seq_len, dtype=torch.long), keep_logits=True)
         return output_logits
 
 class VQVAE(nn.Module):
@@ -309,15 +296,10 @@ class VQVAE(nn.Module):
         # (batchsize,1)
         vq_loss = vq_loss.unsqueeze(1)
 
-        dict_codes = []; suffix_codes = []
-        for i in range(vq_loss.shape[0]):
-            dict_code = str((vq_inds[0][0][i]).item())
-            suffix_code = "" #str((vq_inds[0][0][i]).item())
-            for j in range(1, len(vq_inds)):
-                dict_code   += '-' + str((vq_inds[j][0][i]).item())
-                suffix_code += '-' + str((vq_inds[j][0][i]).item()) 
-            dict_codes.append(dict_code)
-            suffix_codes.append(suffix_code)
+        # codes of all words in one transfer
+        codes = torch.stack([inds[0] for inds in vq_inds], dim=1).tolist()
+        dict_codes   = ['-'.join(str(ind) for ind in row) for row in codes]
+        suffix_codes = [''.join('-' + str(ind) for ind in row[1:]) for row in codes]
         
         return vq_vectors, vq_loss, vq_inds,  fhs, dict_codes, suffix_codes, 0
 
@@ -374,7 +356,8 @@ class VQVAE(nn.Module):
         sft = nn.Softmax(dim=2)
         # (batchsize, T)
         pred_tokens = torch.argmax(sft(output_logits),2)
-        acc = ((pred_tokens == tgt) * (tgt!=0)).sum().item()
+        # kept on device, summed by the trainers and read once per epoch
+        acc = ((pred_tokens == tgt) * (tgt!=0)).sum()
 
         correct_predictions = []; wrong_predictions = []
         '''for i in range(batch_size):
@@ -8,6 +8,8 @@ import sys, argparse, random, torch, json, matplotlib, os
 import matplotlib.pyplot as plt
 from vqvae_ae import VQVAE_AE
 from common.utils import *
+from common.timers import PhaseTimer
+from common.profiling import StepProfiler
 from common.vocab import VocabEntry
 from torch import optim
 from data.data_sigmorphon2018 import build_data
@@ -39,9 +41,11 @@ def test(batches, mode, args, epc):
         else:
             loss, recon_loss, (acc,pred_tokens),  encoder_fhs = args.model.loss(surf, epc)
         epoch_num_tokens += torch.sum(surf[:,1:]!=0)  # exclude start token prediction
-        epoch_loss       += loss.sum().item()
-        epoch_recon_loss += recon_loss.sum().item()
+        epoch_loss       += loss.sum().detach()
+        epoch_recon_loss += recon_loss.sum().detach()
         epoch_acc        += acc
+    # sums are kept on device, read once per pass
+    epoch_loss, epoch_recon_loss, epoch_acc, epoch_num_tokens = torch.stack([epoch_loss, epoch_recon_loss, epoch_acc.to(epoch_loss.dtype), epoch_num_tokens.to(epoch_loss.dtype)]).tolist()
     loss = epoch_loss / numwords 
     recon = epoch_recon_loss / numwords 
     acc = epoch_acc / epoch_num_tokens
@@ -65,7 +69,11 @@ def train(data, args):
     trn_vq_values = []; val_vq_values = []; 
     trn_vq_inds = []; val_vq_inds = []
     trn_recon_loss_values = []; val_recon_loss_values = []
+    timer = PhaseTimer(args.time_phases, args.device)
+    profiler = StepProfiler(args.profile, args.modelname+'profile/', 'train', args.profile_steps, args.device)
+    profiler.start()
     for epc in range(args.epochs):
+        timer.reset()
         epoch_encoder_fhs_fwd = []
         epoch_encoder_fhs_bck = []
         epoch_encoder_fhs = []
@@ -79,13 +87,15 @@ def train(data, args):
             # (batchsize, t)
             surf = trnbatches[idx] 
             # (batchsize)
-            if args.model.encoder.lstm.bidirectional:
-                loss, recon_loss, (acc,pred_tokens),  encoder_fhs, encoder_fhs_fwd, encoder_fhs_bck = args.model.loss(surf, epc)
-            else:
-                loss, recon_loss, (acc,pred_tokens),  encoder_fhs= args.model.loss(surf, epc)
+            with timer.phase('forward'):
+                if args.model.encoder.lstm.bidirectional:
+                    loss, recon_loss, (acc,pred_tokens),  encoder_fhs, encoder_fhs_fwd, encoder_fhs_bck = args.model.loss(surf, epc)
+                else:
+                    loss, recon_loss, (acc,pred_tokens),  encoder_fhs= args.model.loss(surf, epc)
             
-            batch_loss = loss.mean()
-            batch_loss.backward()
+            with timer.phase('backward'):
+                batch_loss = loss.mean()
+                batch_loss.backward()
             
             if args.model.encoder.lstm.bidirectional:
                 epoch_encoder_fhs.append(encoder_fhs)
@@ -94,11 +104,17 @@ def train(data, args):
             else:
                 epoch_encoder_fhs.append(encoder_fhs)
                 breakpoint()
-            opt.step()
-            epoch_num_tokens += torch.sum(surf[:,1:]!=0)#surf.size(0) * (surf.size(1)-1) # exclude start token prediction
-            epoch_loss       += loss.sum().item()
-            epoch_recon_loss += recon_loss.sum().item()
-            epoch_acc        += acc
+            with timer.phase('optimizer'):
+                opt.step()
+            with timer.phase('metrics'):
+                epoch_num_tokens += torch.sum(surf[:,1:]!=0)#surf.size(0) * (surf.size(1)-1) # exclude start token prediction
+                epoch_loss       += loss.sum().detach()
+                epoch_recon_loss += recon_loss.sum().detach()
+                epoch_acc        += acc
+            timer.count(surf.size(0), surf.size(0) * (surf.size(1)-1))
+            profiler.step()
+        # sums are kept on device, read once per epoch
+        epoch_loss, epoch_recon_loss, epoch_acc, epoch_num_tokens = torch.stack([epoch_loss, epoch_recon_loss, epoch_acc.to(epoch_loss.dtype), epoch_num_tokens.to(epoch_loss.dtype)]).tolist()
         loss = epoch_loss / numwords 
         recon = epoch_recon_loss / numwords 
         acc = epoch_acc / epoch_num_tokens
@@ -126,7 +142,7 @@ def train(data, args):
 
         # VAL
         args.model.eval()
-        with torch.no_grad():
+        with timer.phase('validation'), torch.no_grad():
             loss, recon, acc = test(valbatches, "val", args, epc)
         #tensorboard log
         writer.add_scalar('loss/val', loss, epc)
@@ -138,16 +154,22 @@ def train(data, args):
         if loss < best_loss:
             args.logger.write('update best loss \n')
             best_loss = loss
-            torch.save(args.model.state_dict(), args.save_path)
-            if args.model.encoder.lstm.bidirectional:
-                torch.save(epoch_encoder_fhs_fwd, args.lang+'_fhs_SIGMORPHON2018-train_fwd_d'+str(args.enc_nh)+'.pt')
-                torch.save(epoch_encoder_fhs_bck, args.lang+'_fhs_SIGMORPHON2018-train_bck_d'+str(args.enc_nh)+'.pt')
-                torch.save(epoch_encoder_fhs,     args.lang+'_fhs_SIGMORPHON2018-train_all_d'+str(args.enc_nh*2)+'.pt')
-
+            with timer.phase('checkpoint'):
+                torch.save(args.model.state_dict(), args.save_path)
+                if args.model.encoder.lstm.bidirectional:
+                    torch.save(epoch_encoder_fhs_fwd, args.lang+'_fhs_SIGMORPHON2018-train_fwd_d'+str(args.enc_nh)+'.pt')
+                    torch.save(epoch_encoder_fhs_bck, args.lang+'_fhs_SIGMORPHON2018-train_bck_d'+str(args.enc_nh)+'.pt')
+                    torch.save(epoch_encoder_fhs,     args.lang+'_fhs_SIGMORPHON2018-train_all_d'+str(args.enc_nh*2)+'.pt')
+
+        timer.log(epc, writer, args.logger)
         args.model.train()
+    profiler.stop()
 
 # CONFIG
 parser = argparse.ArgumentParser(description='')
+parser.add_argument('--time_phases', action='store_true', help='log the time of each training phase and the words/tokens per second of every epoch')
+parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
 args = parser.parse_args()
 args.device = 'cuda'
 # training
@@ -6,6 +6,10 @@
 
 from common.vocab import VocabEntry
 from common.utils import *
+from common.decoding import greedy_decode, source_length_cap
+from common.graphs import Graphs, export_graphs
+from common.profiling import StepProfiler
+from common.clusters import read_snapshot
 import argparse, torch, json,  os
 from collections import defaultdict
 
@@ -17,8 +21,11 @@ def reinflect(args, inflected_word, reinflect_tag):
 
 
     if args.model_type == 'bi_kl' or args.model_type == 'bi_kl_sum':
-        # kl version
-        fhs, _, _, mu, logvar, fwd,bck = args.model.encoder(x)
+        # kl version, scripted encoder when exported
+        if hasattr(args.graphs, 'encoder'):
+            fhs, mu, logvar, fwd, bck = args.graphs.encoder(x)
+        else:
+            fhs, _, _, mu, logvar, fwd,bck = args.model.encoder(x)
         _root_fhs = mu.unsqueeze(0)
         #_root_fhs = args.model.reparameterize(mu, logvar)
         _root_fhs = args.model.z_to_dec(_root_fhs)
@@ -82,29 +89,26 @@ def reinflect(args, inflected_word, reinflect_tag):
     c_init = root_z 
     h_init = torch.tanh(c_init)
     decoder_hidden = (h_init, c_init)
-    copied = []; i = 0
-    MAX_LENGTH = 50
-    c=0
-    while c<MAX_LENGTH:
-        c+=1
-        # (1,1,ni)
-        word_embed = args.model.decoder.embed(torch.tensor([input]).unsqueeze(0))
-        word_embed = torch.cat((word_embed, z_), -1)
-        # output: (1,1,dec_nh)
-        output, decoder_hidden = args.model.decoder.lstm(word_embed, decoder_hidden)
-        # (1, vocab_size)
-        output_logits = args.model.decoder.pred_linear(output).squeeze(1)
-        input = torch.argmax(sft(output_logits)) 
-        char = args.vocab.id2word(input.item())
-        copied.append(char)
-        if char == '</s>':
-            return(''.join(copied), (reinflect_tag))
+    # (1,1,ni+incat) inputs, scripted step when exported
+    step = args.graphs.step(z_)
+    # stops at </s>, or at a length cap derived from the source word
+    eosid = args.vocab.word2id['</s>']
+    max_lengths = source_length_cap(torch.tensor([x.size(1)-1])).clamp(max=50)
+    preds, _ = greedy_decode(step, decoder_hidden, torch.tensor([[bosid]]), eosid, max_lengths, padid=eosid)
+    copied = args.vocab.decode_sentence_2(preds[0].tolist())
+    if '</s>' in copied:
+        copied = copied[:copied.index('</s>')+1]
     return(''.join(copied), (reinflect_tag))
 
 
 def config():
     # CONFIG
     parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--export_graphs', action='store_true', help='script the inference graphs of the model and save them next to its checkpoint')
+    parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+    parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='words decoded before profiling, warm-up words and profiled words')
+    parser.add_argument('--suffix_codes', default=None, help='suffix code clusters dumped by the trainer (suffix_codes.jsonl), default: next to the checkpoint')
+    parser.add_argument('--suffix_codes_epoch', type=int, default=None, help='epoch of the clusters, default: the last one in the file')
     args = parser.parse_args()
     args.device = 'cuda'
     #model_id = 'unilstm_4x10_dec100_suffixd512'
@@ -165,6 +169,8 @@ def config():
     model_path, model_vocab  = get_model_info(model_id)
     args.model_path = model_path
     args.model_id = model_id
+    if args.suffix_codes is None:
+        args.suffix_codes = os.path.join(os.path.dirname(model_path), 'suffix_codes.jsonl')
     # logging
     args.logdir = 'model/vqvae/results/reinflection/'+model_id+'/'
     args.logfile = args.logdir + '/'
@@ -184,6 +190,10 @@ def config():
     # load model weights
     args.model.load_state_dict(torch.load(model_path))
     args.model.eval()
+    # scripted inference graphs next to the checkpoint, used when present
+    if args.export_graphs:
+        export_graphs(args.model, model_path)
+    args.graphs = Graphs(args.model, model_path)
     return args
 
 
@@ -225,8 +235,10 @@ with open('data/sigmorphon2016/turkish-task2-dev', 'r') as reader:
 
 c=args.num_dicts
 id_tags = dict()
-with open('/home/mugekural/dev/git/trmor/model/vqvae/results/training/55204_instances/2noloaded_FINAL_bi_kl0.2_2x20_dec256_suffixd300/suffix_codes.json', 'r') as f:
-  modeldata = json.load(f)
+# words of each suffix code, from the val clusters the trainer dumped
+modeldata = read_snapshot(args.suffix_codes, 'val', args.suffix_codes_epoch)
+if modeldata is None:
+  raise ValueError('no val clusters in ' + args.suffix_codes)
 tag_counts=defaultdict(lambda: 0)
 for key,values in modeldata.items():
   for value in values:
@@ -275,6 +287,9 @@ with open(args.logdir+model_id+'_turkish-task3-test_todo_'+str(c), 'w') as write
 
 
 true = 0; false = 0 
+# one profiler step per reinflected word
+profiler = StepProfiler(args.profile, args.logdir+'profile/', 'reinflect', args.profile_steps, args.device)
+profiler.start()
 with torch.no_grad():
     with open(args.logdir+args.model_id+'_turkish-task3-test_reinflected', 'w') as writer:
         with open(args.logdir+args.model_id+'_turkish-task3-test_reinflected_true', 'w') as writer_true:
@@ -299,6 +314,8 @@ with torch.no_grad():
                         else:
                           false+=1
                           writer_false.write(inflected_word +'\t'+gold_reinflection + '\t'+reinflected_word+'\t'+ str(vq_code)+'\n')
+                        profiler.step()
+                profiler.stop()
                 print('true %d, false %d, total %d, accuracy: %.2f' % (true,false, true+false, true/(true+false)))
                 writer_true.write('true %d, false %d, total %d, accuracy: %.2f' % (true,false, true+false, true/(true+false)))
 
@@ -0,0 +1,220 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Shared-task (reinflection) evaluation helpers for trained VQVAE models
+# -----------------------------------------------------------
+
+import torch
+from common.decoding import greedy_decode, source_length_cap
+
+
+def read_shared_task(fname, maxsize=None, lower=False):
+    # returns split lines: (inflected_word, asked_tag, gold_reinflection) for sigmorphon2016,
+    # (lemma, gold_inflection, asked_tag) for sigmorphon2018
+    entries = []
+    with open(fname, 'r') as reader:
+        for line in reader:
+            if maxsize is not None and len(entries) >= maxsize:
+                break
+            line = line.strip()
+            if lower:
+                line = line.lower()
+            entries.append(line.split('\t'))
+    return entries
+
+def encode_words(vocab, words):
+    bosid = vocab.word2id['<s>']; eosid = vocab.word2id['</s>']
+    return [[bosid] + vocab.encode_sentence(word) + [eosid] for word in words]
+
+def length_batches(data, batchsize):
+    # groups indices of equal-length sequences (same as seq_to_no_pad='surface'),
+    # the bidirectional encoder reads its last states so rows must not be padded
+    order = sorted(range(len(data)), key=lambda i: len(data[i]))
+    i = 0
+    while i < len(order):
+        jr = i
+        while jr < min(len(order), i+batchsize) and len(data[order[jr]]) == len(data[order[i]]):
+            jr += 1
+        yield order[i:jr]
+        i = jr
+
+def oracle_codes(model, batches, num_rows, vq_args, graphs=None):
+    # batches: [(inds, x)], x: (B, T) equal-length rows ---> codes: (num_rows, num_dicts) on model device
+    # graphs: common.graphs.Graphs of a trained model, its encoder and quantizer give the codes when it has them
+    num_dicts = len(model.ord_vq_layers)
+    codes = None
+    with torch.no_grad():
+        for inds, x in batches:
+            if codes is None:
+                codes = torch.zeros(num_rows, num_dicts, dtype=torch.long, device=x.device)
+            if graphs is not None and graphs.quantizes:
+                codes[inds] = graphs.codes(x)[2]
+                continue
+            _, _, quantized_inds, _, _, _, _, _ = model.vq_loss(x, *vq_args)
+            # quantized_inds: num_dicts x (1, B) ---> (B, num_dicts)
+            codes[inds] = torch.cat(quantized_inds[-num_dicts:], dim=0).t()
+    return codes
+
+def batch_oracle(model, vocab, words, vq_args=(0, 'tst'), batchsize=512, graphs=None):
+    """Encodes gold words in batches and returns their dictionary codes.
+    Args:
+        vq_args: arguments given to model.vq_loss after x, e.g. (0,'tst') or (None,0,'tst') for tag-supervised models
+        graphs: common.graphs.Graphs of the model, used instead of vq_loss when it has the quantizer
+    Returns:
+        codes: LongTensor (N, num_dicts) on cpu, rows in the order of words
+    """
+    device = next(model.parameters()).device
+    data = encode_words(vocab, words)
+    batches = [(inds, torch.tensor([data[i] for i in inds], dtype=torch.long, device=device)) for inds in length_batches(data, batchsize)]
+    return oracle_codes(model, batches, len(data), vq_args, graphs).cpu()
+
+def format_codes(codes):
+    # (N, num_dicts) ---> ['3-0-5', ...]
+    return ['-'.join(str(c) for c in row) for row in codes.tolist()]
+
+def suffix_vectors(model, codes):
+    # codes: (B, num_dicts) ---> (B, 1, sum of dict dims)
+    return torch.cat([vq_layer.embedding.weight[codes[:, j]] for j, vq_layer in enumerate(model.ord_vq_layers)], dim=-1).unsqueeze(1)
+
+## Decoder initializations, mirror reinflect() of the trainers.
+## Each returns decoder_hidden, z_ (B,1,*) given to every step, and whether z_ is concatenated or added to the char embedding
+def reinflect_init(model, x, codes):
+    # root: z_to_dec(mu), suffix codes concatenated to each decoder input
+    _, _, _, mu, logvar, fwd, bck = model.encoder(x)
+    root_z = model.z_to_dec(mu.unsqueeze(0))
+    return (torch.tanh(root_z), root_z), suffix_vectors(model, codes), 'concat'
+
+def reinflect_init_suffix_encoder(model, x, codes):
+    # root: z_to_dec(mu) + tag_to_dec(suffix), encoded suffix added to each decoder input
+    _, _, _, mu, logvar, fwd, bck = model.encoder(x)
+    suffix_z = suffix_vectors(model, codes)
+    root_z = model.z_to_dec(mu.unsqueeze(0)) + model.tag_to_dec(suffix_z).permute(1,0,2)
+    return (torch.tanh(root_z), root_z), model.decoder.suffix_encoder(suffix_z), 'sum'
+
+def reinflect_init_tag_to_dec(model, x, codes):
+    # root: z_to_dec(mu) + tag_to_dec(suffix), raw root and suffix concatenated to each decoder input
+    _, _, _, mu, logvar, fwd, bck = model.encoder(x)
+    raw_root_z = mu.unsqueeze(1)
+    suffix_z = suffix_vectors(model, codes)
+    root_z = (model.z_to_dec(raw_root_z) + model.tag_to_dec(suffix_z)).permute(1,0,2)
+    return (torch.tanh(root_z), root_z), torch.cat((raw_root_z, suffix_z), dim=2), 'concat'
+
+def greedy_reinflect(model, x, codes, init_fn=reinflect_init, max_length=50, graphs=None):
+    # x: (B, T) equal-length source words, codes: (B, num_dicts) ---> (B, <=max_length) predicted ids, </s> padded
+    # graphs: common.graphs.Graphs of a trained model, its decoder step is used for concatenated latents
+    decoder = model.decoder
+    decoder_hidden, z_, combine = init_fn(model, x, codes)
+    eosid = decoder.vocab.word2id['</s>']
+    input = torch.full((x.size(0), 1), decoder.vocab.word2id['<s>'], dtype=torch.long, device=x.device)
+    def step(input, hidden, rows):
+        # (b,1,ni)
+        word_embed = decoder.embed(input)
+        word_embed = torch.cat((word_embed, z_[rows]), -1) if combine == 'concat' else word_embed + z_[rows]
+        output, hidden = decoder.lstm(word_embed, hidden)
+        return decoder.pred_linear(output), hidden
+    if graphs is not None and combine == 'concat':
+        step = graphs.step(z_)
+    # length cap from the source word (chars + </s>)
+    max_lengths = source_length_cap(torch.full((x.size(0),), x.size(1)-1, dtype=torch.long)).clamp(max=max_length)
+    preds, _ = greedy_decode(step, decoder_hidden, input, eosid, max_lengths, padid=eosid)
+    return preds
+
+
+class SharedTaskEvaluator(object):
+    """Keeps a shared-task test set encoded in memory, so periodic evaluation runs
+    only batched oracle + batched greedy reinflection."""
+    def __init__(self, fname, vocab, maxsize=None, lower=False, sigmorphon2018=False, batchsize=512, device='cuda'):
+        self.vocab = vocab
+        self.entries = read_shared_task(fname, maxsize, lower)
+        if sigmorphon2018:
+            # (lemma, gold_inflection, asked_tag)
+            self.sources = [e[0] for e in self.entries]; self.golds = [e[1] for e in self.entries]
+        else:
+            # (inflected_word, asked_tag, gold_reinflection)
+            self.sources = [e[0] for e in self.entries]; self.golds = [e[2] for e in self.entries]
+        src_data  = encode_words(vocab, self.sources)
+        gold_data = encode_words(vocab, self.golds)
+        self.src_batches  = [(inds, torch.tensor([src_data[i] for i in inds], dtype=torch.long, device=device)) for inds in length_batches(src_data, batchsize)]
+        self.gold_batches = [(inds, torch.tensor([gold_data[i] for i in inds], dtype=torch.long, device=device)) for inds in length_batches(gold_data, batchsize)]
+        self.true_lines = []; self.false_lines = []
+
+    def _subset(self, batches, n):
+        # keeps rows of the first n entries
+        if n >= len(self.entries):
+            return batches
+        subset = []
+        for inds, x in batches:
+            keep = [k for k, i in enumerate(inds) if i < n]
+            if len(keep) > 0:
+                subset.append(([inds[k] for k in keep], x[keep]))
+        return subset
+
+    def run(self, model, vq_args=(0, 'tst'), init_fn=reinflect_init, maxsize=None, graphs=None):
+        n = len(self.entries) if maxsize is None else min(maxsize, len(self.entries))
+        self.numwords = n
+        with torch.no_grad():
+            codes = oracle_codes(model, self._subset(self.gold_batches, n), n, vq_args, graphs)
+            preds = [None] * n
+            for inds, x in self._subset(self.src_batches, n):
+                pred_tokens = greedy_reinflect(model, x, codes[inds], init_fn, graphs=graphs).tolist()
+                for i, pred in zip(inds, pred_tokens):
+                    preds[i] = pred
+        codes = format_codes(codes)
+        eosid = self.vocab.word2id['</s>']
+        self.true_lines = []; self.false_lines = []
+        for i in range(n):
+            pred = preds[i]
+            if eosid in pred:
+                pred = pred[:pred.index(eosid)]
+            reinflected_word = ''.join(self.vocab.decode_sentence_2(pred))
+            line = self.sources[i] +'\t'+ self.golds[i] + '\t'+ reinflected_word +'\t'+ codes[i] +'\n'
+            if reinflected_word == self.golds[i]:
+                self.true_lines.append(line)
+            else:
+                self.false_lines.append(line)
+        return len(self.true_lines) / n
+
+    def write(self, true_file, false_file):
+        with open(true_file, 'w') as writer_true:
+            writer_true.writelines(self.true_lines)
+        with open(false_file, 'w') as writer_false:
+            writer_false.writelines(self.false_lines)
+
+
+class TagReinflectionEvaluator(SharedTaskEvaluator):
+    """Reinflection from the gold tags of the asked form instead of oracle codes, for the tag-supervised
+    models whose dict codes are tag ids. Built once from batches of one entry each, (src (1,T), tags:
+    num_dicts x (1,), tgt (1,T')) e.g. lxtgt_ordered_batches_TST; entries keep the order of the batches
+    and are regrouped by source length, so run only does batched greedy reinflection."""
+    def __init__(self, batches, vocab, batchsize=512):
+        self.vocab = vocab
+        device = batches[0][0].device
+        src_data = [src[0].tolist() for src, _, _ in batches]
+        # (N, num_dicts) codes of each entry, the tag id of each dict
+        self.codes = torch.cat([torch.stack(tags, dim=1) for _, tags, _ in batches], dim=0)
+        self.sources = [''.join(vocab.decode_sentence_2(row[1:-1])) for row in src_data]
+        self.golds = [''.join(vocab.decode_sentence_2(tgt[0, 1:-1].tolist())) for _, _, tgt in batches]
+        self.entries = self.sources
+        self.src_batches = [(inds, torch.tensor([src_data[i] for i in inds], dtype=torch.long, device=device)) for inds in length_batches(src_data, batchsize)]
+        self.true_lines = []; self.false_lines = []
+
+    def run(self, model, init_fn=reinflect_init, maxsize=None, graphs=None):
+        n = len(self.entries) if maxsize is None else min(maxsize, len(self.entries))
+        self.numwords = n
+        eosid = self.vocab.word2id['</s>']
+        preds = [None] * n
+        with torch.no_grad():
+            for inds, x in self._subset(self.src_batches, n):
+                pred_tokens = greedy_reinflect(model, x, self.codes[inds], init_fn, graphs=graphs).tolist()
+                for i, pred in zip(inds, pred_tokens):
+                    preds[i] = pred
+        self.true_lines = []; self.false_lines = []
+        for i in range(n):
+            pred = preds[i]
+            # a form that does not end with </s> within the length cap is wrong
+            reinflected_word = ''.join(self.vocab.decode_sentence_2(pred[:pred.index(eosid)])) if eosid in pred else None
+            line = self.sources[i] +'\t'+ self.golds[i] + '\t'+ (reinflected_word or '') +'\n'
+            if reinflected_word == self.golds[i]:
+                self.true_lines.append(line)
+            else:
+                self.false_lines.append(line)
+        return len(self.true_lines) / n
@@ -0,0 +1,198 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Hyperparameter sweep of the kl_bi VQVAE (vqvae_train_kl_bi): runs a grid of
+#              configurations concurrently in a process pool, the data is built once and shared
+#              with the workers, the final metrics of the runs are written to one table
+# -----------------------------------------------------------
+
+import sys, argparse, random, torch, json, os, copy, itertools, ast, time
+import torch.multiprocessing as mp
+from vqvae_kl_bi import VQVAE
+from vqvae_ae import VQVAE_AE
+from vqvae_trainer import VQVAETrainer, get_kl_weight
+from common.utils import *
+from common.vocab import VocabEntry
+from data.data import build_data
+from torch.utils.tensorboard import SummaryWriter
+
+# settings a grid may change, run ids follow the model_prefix of the trainers
+MODEL_PREFIX = 'batchsize{batchsize}_beta{beta}_bi_kl{kl_max}_{num_dicts}x{orddict_emb_num}_dec{dec_nh}_suffixd{incat}/'
+TABLE_KEYS = ['epoch', 'best_loss', 'trn/loss', 'trn/recon_loss', 'trn/kl_loss', 'trn/vq_loss', 'trn/accuracy', 'trn/suffix_codes',
+              'val/loss', 'val/recon_loss', 'val/accuracy', 'val/suffix_codes', 'val/new_gen_codes', 'minutes']
+
+def expand_grid(grid):
+    # {'kl_max': [0.1, 0.2], 'num_dicts': [2, 4]} ---> list of {'kl_max': 0.1, 'num_dicts': 2}, ...
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+def parse_grid(items):
+    # ['kl_max=0.1,0.2', 'num_dicts=2,4'] ---> {'kl_max': [0.1, 0.2], 'num_dicts': [2, 4]}
+    grid = dict()
+    for item in items:
+        key, values = item.split('=')
+        grid[key] = [ast.literal_eval(v) for v in values.split(',')]
+    return grid
+
+
+## Shared data: set in every worker by init_worker, tensors are in shared memory
+shared = dict()
+
+def load_shared(args, batchsizes):
+    # batches of each batch size of the grid, the pretrained ae and the fhs vectors, read once
+    data = dict()
+    for batchsize in batchsizes:
+        args.batchsize = batchsize
+        rawdata, (trnbatches, valbatches, _), vocab = build_data(args)
+        data[batchsize] = ([b.cpu().share_memory_() for b in trnbatches], [b.cpu().share_memory_() for b in valbatches],
+                           len(rawdata[0]), len(rawdata[1]))
+    _model_path, surf_vocab = get_model_info('ae_'+args.lang)
+    with open(surf_vocab) as f:
+        surf_word2id = json.load(f)
+    ae_state = {k: v.cpu().share_memory_() for k, v in torch.load(_model_path, map_location='cpu').items()}
+    fhs_bck = torch.load('model/vqvae/results/fhs/'+args.lang+'_fhs_datasetV-train_bck_d300.pt', map_location='cpu').share_memory_()
+    return {'data': data, 'vocab': vocab.word2id, 'surf_vocab': surf_word2id, 'ae_state': ae_state, 'fhs_bck': fhs_bck}
+
+def init_worker(shared_data, num_threads):
+    shared.update(shared_data)
+    # runs share the cores of the machine
+    torch.set_num_threads(num_threads)
+
+
+## One run, as vqvae_train_kl_bi with the settings of the grid point
+def build_model(args, vocab):
+    model_init = uniform_initializer(0.01)
+    emb_init = uniform_initializer(0.1)
+    args.model = VQVAE(args, vocab, model_init, emb_init, dict_assemble_type='sum_and_concat', bidirectional=True)
+    for i, vq_layer in enumerate(args.model.ord_vq_layers):
+        vq_layer.embedding.weight.data = shared['fhs_bck'][: args.orddict_emb_num, i*args.model.orddict_emb_dim:(i+1)*args.model.orddict_emb_dim].clone()
+    # pretrained ae: encoder embeddings and lstm
+    ae_args = copy.copy(args)
+    ae_args.num_dicts = 0; ae_args.outcat=0; ae_args.incat = 0; ae_args.dec_nh = args.enc_nh*2; ae_args.bidirectional=True
+    pretrained_model = VQVAE_AE(ae_args, args.surf_vocab, model_init, emb_init, bidirectional=True)
+    pretrained_model.load_state_dict(shared['ae_state'], strict=False)
+    args.model.encoder.embed = pretrained_model.encoder.embed
+    args.model.encoder.lstm  = pretrained_model.encoder.lstm
+    args.model.to(args.device)
+    return args.model
+
+def run(base_args, setting):
+    args = copy.copy(base_args)
+    for key, value in setting.items():
+        setattr(args, key, value)
+    if 'incat' not in setting:
+        args.incat = args.enc_nh
+    args.embedding_dim = args.enc_nh
+    torch.manual_seed(args.seed); random.seed(args.seed)
+    trnbatches, valbatches, trnsize, valsize = shared['data'][args.batchsize]
+    vocab = VocabEntry(shared['vocab'])
+    args.surf_vocab = VocabEntry(shared['surf_vocab'])
+    build_model(args, vocab)
+    args.model_prefix = MODEL_PREFIX.format(**vars(args))
+    args.modelname = args.sweepdir + args.model_prefix
+    os.makedirs(args.modelname, exist_ok=True)
+    args.save_path = args.modelname + str(args.epochs)+'epochs.pt'
+    args.log_path = args.modelname + str(args.epochs)+'epochs.log'
+    args.logger = Logger(args.log_path, 'a' if args.resume else 'w')
+    args.logger.write(args)
+    args.logger.write('\n')
+    writer = SummaryWriter("runs/"+args.lang+'/sweep/'+args.model_prefix)
+    def step(trainer, i, surf, epc, kl_weight):
+        outputs = args.model.loss(surf, kl_weight, epc)
+        return outputs[0].mean(), (surf, outputs)
+    def val_loss(surf, kl_weight, epc):
+        return surf, args.model.loss(surf, kl_weight, epc, mode='val')
+    start = time.time()
+    trainer = VQVAETrainer(args, writer, step, lambda update_ind: get_kl_weight(update_ind, args.kl_max, 150000.0, 3000),
+                           [('val', 'VAL', val_loss)], save_snapshots=False)
+    trainer.train(trnbatches, trnsize, valbatches, valsize)
+    writer.close()
+    trainer.results['minutes'] = (time.time() - start) / 60
+    return setting, trainer.results
+
+def run_safe(base_args, setting):
+    # a failing run is reported in the table, the others go on
+    try:
+        return run(base_args, setting)
+    except Exception as e:
+        return setting, {'error': repr(e)}
+
+def run_job(job):
+    # (base_args, setting) of the pool
+    return run_safe(*job)
+
+
+def write_table(fname, keys, rows):
+    # rows: (setting, results), sorted by best val loss
+    rows = sorted(rows, key=lambda r: r[1].get('best_loss', float('inf')))
+    with open(fname, 'w') as writer:
+        writer.write('\t'.join(keys + TABLE_KEYS + ['error'])+'\n')
+        for setting, results in rows:
+            values = [str(setting[k]) for k in keys]
+            values += ['%.4f' % results[k] if isinstance(results.get(k), float) else str(results.get(k, '')) for k in TABLE_KEYS]
+            writer.write('\t'.join(values + [results.get('error', '')])+'\n')
+
+def config():
+    # CONFIG
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--grid', nargs='+', default=['kl_max=0.1,0.2', 'num_dicts=2,4'],
+                        help="settings and their values, e.g. kl_max=0.1,0.2 beta=0.2,0.5 orddict_emb_num=6,10 dec_nh=128,256")
+    parser.add_argument('--workers', type=int, default=2, help='runs trained at the same time')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads of each run, default: cores / workers')
+    parser.add_argument('--epochs', type=int, default=200)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--resume', action='store_true', help='continue each run from its last checkpoint')
+    parser.add_argument('--sweep_name', type=str, default='sweep')
+    parser.add_argument('--time_phases', action='store_true', help='log the time of each training phase and the words/tokens per second of every epoch')
+    parser.add_argument('--amp', action='store_true', help='mixed precision (autocast and gradient scaling), cuda only, ignored on cpu')
+    parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+    parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
+    args = parser.parse_args()
+    args.grid = parse_grid(args.grid)
+    if args.threads == 0:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+    args.keep_ckpts = 1; args.seed = 0
+    # training, defaults of vqvae_train_kl_bi
+    args.batchsize = 128
+    args.opt= 'Adam'; args.lr = 0.001
+    args.task = 'vqvae'
+    args.seq_to_no_pad = 'surface'
+    args.kl_max = 0.2
+    # data
+    args.lang ='turkish'
+    args.trndata  = 'data/sigmorphon2016/'+args.lang+'_zhou_merged'
+    args.valdata  = 'data/sigmorphon2016/'+args.lang+'-task3-test'
+    args.tstdata = args.valdata
+    args.surface_vocab_file = args.trndata
+    args.maxtrnsize = 60000; args.maxvalsize = 1000; args.maxtstsize = 100000
+    # model
+    args.mname = 'vqvae'
+    args.enc_dropout_in = 0.0; args.enc_dropout_out = 0.0
+    args.dec_dropout_in = 0.5; args.dec_dropout_out = 0.0
+    args.ni = 256; args.enc_nh = 300; args.dec_nh = 256
+    args.beta = 0.2; args.nz = 128
+    args.num_dicts = 2; args.outcat=0; args.orddict_emb_num = 100
+    # logging
+    args.sweepdir = 'model/'+args.mname+'/results/sweep/'+args.lang+'/'+args.sweep_name+'/'
+    args.fsweep = args.sweepdir + 'sweep.tsv'
+    os.makedirs(args.sweepdir, exist_ok=True)
+    return args
+
+def main():
+    args = config()
+    settings = expand_grid(args.grid)
+    batchsizes = sorted(set(s.get('batchsize', args.batchsize) for s in settings))
+    shared_data = load_shared(args, batchsizes)
+    print('%d runs, %d at a time with %d threads each' % (len(settings), args.workers, args.threads))
+    # spawn: workers get the shared-memory tensors instead of copies, and no forked torch thread pools
+    ctx = mp.get_context('spawn')
+    rows = []
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=(shared_data, args.threads)) as pool:
+        for setting, results in pool.imap_unordered(run_job, [(args, s) for s in settings]):
+            rows.append((setting, results))
+            print(setting, 'error: '+results['error'] if 'error' in results else 'best_loss: %.4f' % results['best_loss'])
+            # table so far, a long sweep can be followed
+            write_table(args.fsweep, list(args.grid), rows)
+    print('results: '+args.fsweep)
+
+if __name__=="__main__":
+    main()
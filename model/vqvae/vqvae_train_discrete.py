@@ -15,6 +15,9 @@ from model.vae.vae import VAE
 from model.ae.ae import AE
 from common.utils import *
 from common.vocab import VocabEntry
+from common.clusters import ClusterStore
+from common.timers import PhaseTimer
+from common.profiling import StepProfiler
 from torch import optim
 from data.data import build_data, log_data
 from torch.utils.tensorboard import SummaryWriter
@@ -31,10 +34,8 @@ def test(batches, mode, args, epc, suffix_codes_trn):
     numwords = args.valsize if mode =='val'  else args.tstsize
     numbatches = len(batches)
     indices = list(range(numbatches))
-    epoch_quantized_inds = []; vq_inds = []
-    for i in range(args.num_dicts):
-        epoch_quantized_inds.append(dict())
-        vq_inds.append(0)
+    # code usage of each dict, counted on device and read once per pass (dict 0 is the lemma dict)
+    usage = torch.zeros(args.num_dicts, max(args.lemmadict_emb_num, args.orddict_emb_num), dtype=torch.long, device=args.device)
     vq_codes = defaultdict(lambda: 0)
     suffix_codes = defaultdict(lambda: 0)
     epoch_wrong_predictions = []; epoch_correct_predictions = []
@@ -59,23 +60,19 @@ def test(batches, mode, args, epc, suffix_codes_trn):
             if code not in suffix_codes_trn:
                 val_unique_suffix_code += 1
                 val_unique_suffix_codes.append(''.join(vocab.decode_sentence(surf[j])))
-        for i in range(args.num_dicts):
-            for ind in quantized_inds[i][0]:
-                ind = ind.item()
-                if ind not in epoch_quantized_inds[i]:
-                    epoch_quantized_inds[i][ind] = 1
-                else:
-                    epoch_quantized_inds[i][ind] += 1
+        for d in range(args.num_dicts):
+            usage[d] += torch.bincount(quantized_inds[d][0], minlength=usage.size(1))
         epoch_num_tokens += surf.size(0) * (surf.size(1)-1)  # exclude start token prediction
-        epoch_loss       += loss.sum().item()
-        epoch_recon_loss += recon_loss.sum().item()
-        epoch_vq_loss    += vq_loss.sum().item()
+        epoch_loss       += loss.sum().detach()
+        epoch_recon_loss += recon_loss.sum().detach()
+        epoch_vq_loss    += vq_loss.sum().detach()
         epoch_kl_loss    += kl_loss.sum().item()
         epoch_acc        += acc
     
 
-    for i in range(args.num_dicts):
-        vq_inds[i] = len(epoch_quantized_inds[i])
+    vq_inds = (usage > 0).sum(1).tolist()
+    # sums are kept on device, read once per pass
+    epoch_loss, epoch_recon_loss, epoch_vq_loss, epoch_acc = torch.stack([epoch_loss, epoch_recon_loss, epoch_vq_loss, epoch_acc.to(epoch_loss.dtype)]).tolist()
     loss = epoch_loss / numwords 
     recon = epoch_recon_loss / numwords 
     vq = epoch_vq_loss / numwords 
@@ -101,14 +98,16 @@ def train(data, args):
     trn_vq_values = []; val_vq_values = []; 
     trn_vq_inds = []; val_vq_inds = []
     trn_recon_loss_values = []; val_recon_loss_values = []
+    timer = PhaseTimer(args.time_phases, args.device)
+    profiler = StepProfiler(args.profile, args.modelname+'profile/', 'train', args.profile_steps, args.device)
+    profiler.start()
 
     for epc in range(args.epochs):
-        clusters_list = []; epoch_quantized_inds = []; vq_inds = []
-        for i in range(args.num_dicts):
-            epoch_quantized_inds.append(dict())
-            clusters_list.append(dict())
-            vq_inds.append(0)
-        clusters_list.append(dict())
+        timer.reset()
+        # code usage of each dict, counted on device and read once per epoch (dict 0 is the lemma dict)
+        usage = torch.zeros(args.num_dicts, max(args.lemmadict_emb_num, args.orddict_emb_num), dtype=torch.long, device=args.device)
+        # words of each code of each dict, and of each suffix code
+        clusters = ClusterStore(vocab, [str(i) for i in range(args.num_dicts)] + ['suffix'])
         epoch_encoder_fhs = []
         epoch_loss = 0; epoch_num_tokens = 0; epoch_acc = 0
         epoch_vq_loss = 0; epoch_recon_loss = 0; epoch_kl_loss = 0; epoch_logdet = 0
@@ -122,52 +121,45 @@ def train(data, args):
             surf = trnbatches[idx] 
             # (batchsize)
             #loss, recon_loss, vq_loss, kl_loss, (acc,pred_tokens), quantized_inds, encoder_fhs, vq_codes_list, suffix_code_list, recon_preds, logdet = args.model.loss(surf, epc)
-            loss, recon_loss, vq_loss, (acc,pred_tokens), quantized_inds,  encoder_fhs, vq_codes_list, suffix_code_list, recon_preds, logdet = args.model.loss(surf, epc)
-            kl_loss = torch.tensor(0)
-            wrong_predictions, correct_predictions = recon_preds
-            epoch_wrong_predictions   += wrong_predictions
-            epoch_correct_predictions += correct_predictions
-            for code in vq_codes_list:
-                vq_codes[code] += 1
-            for code in suffix_code_list:
-                suffix_codes[code] += 1
-            epoch_encoder_fhs.append(encoder_fhs)
-            for i in range(args.num_dicts):
-                for ind in quantized_inds[i][0]:
-                    if ind not in epoch_quantized_inds[i]:
-                        ind = ind.item()
-                        epoch_quantized_inds[i][ind] = 1
-                    else:
-                        epoch_quantized_inds[i][ind] += 1
-                _quantized_inds = quantized_inds[i]
-                for s in range(surf.shape[0]):
-                    ind = _quantized_inds.tolist()[0][s]
-                    if ind not in clusters_list[i]:                   
-                        clusters_list[i][ind] = []
-                    if ''.join(vocab.decode_sentence(surf[s])) not in clusters_list[i][ind]:
-                        clusters_list[i][ind].append(''.join(vocab.decode_sentence(surf[s])))
-            
-            for s in range(surf.shape[0]):
-                ind = suffix_code_list[s]
-                if ind not in clusters_list[-1]:                   
-                    clusters_list[-1][ind] = []
-                if ''.join(vocab.decode_sentence(surf[s])) not in clusters_list[-1][ind]:
-                    clusters_list[-1][ind].append(''.join(vocab.decode_sentence(surf[s])))
-
-            batch_loss = loss.mean()
-            batch_loss.backward()
-            opt.step()
-            epoch_num_tokens += surf.size(0) * (surf.size(1)-1) # exclude start token prediction
-            epoch_loss       += loss.sum().item()
-            epoch_recon_loss += recon_loss.sum().item()
-            epoch_vq_loss    += vq_loss.sum().item()
-            epoch_kl_loss    += kl_loss.sum().item()
-
-            epoch_acc        += acc
-            epoch_logdet     += logdet
-        for i in range(args.num_dicts):
-            vq_inds[i] = len(epoch_quantized_inds[i])
-        
+            with timer.phase('forward'):
+                loss, recon_loss, vq_loss, (acc,pred_tokens), quantized_inds,  encoder_fhs, vq_codes_list, suffix_code_list, recon_preds, logdet = args.model.loss(surf, epc)
+            with timer.phase('metrics'):
+                kl_loss = torch.tensor(0)
+                wrong_predictions, correct_predictions = recon_preds
+                epoch_wrong_predictions   += wrong_predictions
+                epoch_correct_predictions += correct_predictions
+                for code in vq_codes_list:
+                    vq_codes[code] += 1
+                for code in suffix_code_list:
+                    suffix_codes[code] += 1
+                epoch_encoder_fhs.append(encoder_fhs)
+                for d in range(args.num_dicts):
+                    usage[d] += torch.bincount(quantized_inds[d][0], minlength=usage.size(1))
+                # codes of all dicts in one transfer
+                dict_codes = torch.stack([quantized_inds[d][0] for d in range(args.num_dicts)]).tolist()
+                codes = {str(d): dict_codes[d] for d in range(args.num_dicts)}
+                codes['suffix'] = suffix_code_list
+                clusters.add(surf, codes)
+
+            with timer.phase('backward'):
+                batch_loss = loss.mean()
+                batch_loss.backward()
+            with timer.phase('optimizer'):
+                opt.step()
+            with timer.phase('metrics'):
+                epoch_num_tokens += surf.size(0) * (surf.size(1)-1) # exclude start token prediction
+                epoch_loss       += loss.sum().detach()
+                epoch_recon_loss += recon_loss.sum().detach()
+                epoch_vq_loss    += vq_loss.sum().detach()
+                epoch_kl_loss    += kl_loss.sum().item()
+
+                epoch_acc        += acc
+                epoch_logdet     += logdet
+            timer.count(surf.size(0), surf.size(0) * (surf.size(1)-1))
+            profiler.step()
+        vq_inds = (usage > 0).sum(1).tolist()
+        # sums are kept on device, read once per epoch
+        epoch_loss, epoch_recon_loss, epoch_vq_loss, epoch_acc = torch.stack([epoch_loss, epoch_recon_loss, epoch_vq_loss, epoch_acc.to(epoch_loss.dtype)]).tolist()
 
         loss = epoch_loss / numwords 
         recon = epoch_recon_loss / numwords 
@@ -211,7 +203,7 @@ def train(data, args):
         #torch.save(args.model.state_dict(), args.save_path)
         # VAL
         args.model.eval()
-        with torch.no_grad():
+        with timer.phase('validation'), torch.no_grad():
             loss, recon, vq, acc, vq_inds = test(valbatches, "val", args, epc, suffix_codes)
         #tensorboard log
         writer.add_scalar('loss/val', loss, epc)
@@ -225,19 +217,18 @@ def train(data, args):
         if loss < best_loss:
             args.logger.write('update best loss \n')
             best_loss = loss
-            torch.save(args.model.state_dict(), args.save_path)
-            for i in range(args.num_dicts +1):
-                with open(args.modelname+str(i)+'_cluster.json', 'w') as json_file:
-                    json_object = json.dumps(clusters_list[i], indent = 4, ensure_ascii=False)
-                    json_file.write(json_object)
-                with open(args.modelname+str(i)+'_cluster_usage.json', 'w') as wr:
-                    for key,val in clusters_list[i].items():
-                        usage = {key: len(val)}
-                        wr.write(str(usage) + '\n')
+            with timer.phase('checkpoint'):
+                torch.save(args.model.state_dict(), args.save_path)
+                clusters.dump(epc, args.modelname+'clusters.jsonl', args.modelname+'clusters_usage.jsonl')
+        timer.log(epc, writer, args.logger)
         args.model.train()
+    profiler.stop()
 
 # CONFIG
 parser = argparse.ArgumentParser(description='')
+parser.add_argument('--time_phases', action='store_true', help='log the time of each training phase and the words/tokens per second of every epoch')
+parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
 args = parser.parse_args()
 args.device = 'cuda'
 # training
@@ -10,6 +10,9 @@ from unicodedata import bidirectional
 import matplotlib.pyplot as plt
 from model.vqvae.vqvae_kl_bi_late_sup import VQVAE
 from vqvae_ae import VQVAE_AE
+from vqvae_shared_task import SharedTaskEvaluator
+from vqvae_trainer import VQVAETrainer, get_kl_weight
+from common.distributed import init_distributed, is_main, QuietLogger
 import torch.nn.functional as F
 
 from model.ae.ae import AE
@@ -29,316 +32,43 @@ torch.autograd.set_detect_anomaly(True)
 from vqvae_tag_analysis import tag_analysis, counter
 
 
-def test(batches, mode, args, epc, suffix_codes_trn, kl_weight):
-    epoch_loss = 0; epoch_num_tokens = 0; epoch_acc = 0
-    epoch_vq_loss = 0; epoch_recon_loss = 0; epoch_kl_loss = 0; 
-    numwords = args.valsize if mode =='val'  else args.tstsize
-    numbatches = len(batches)
-    indices = list(range(numbatches))
-
-    clusters_list = []; epoch_quantized_inds = []; vq_inds = []
-    for i in range(args.num_dicts):
-        epoch_quantized_inds.append(dict())
-        clusters_list.append(dict())
-        vq_inds.append(0)
-    clusters_list.append(dict())
-
-    new_gen_suffix_codes_val = defaultdict(lambda: 0)
-    suffix_codes_val = defaultdict(lambda: 0)
-    freq_new_gen_suffix_codes_used = 0
-    for i, idx in enumerate(indices):
-        # (batchsize, t)
-        surf = batches[idx] 
-        loss, recon_loss, vq_loss, (acc,pred_tokens), quantized_inds,  encoder_fhs, vq_codes_list, suffix_code_list, recon_preds, kl_loss, logdetmaxloss = args.model.loss(surf, kl_weight, epc, mode='val')
-
-       
-        ## DICT USAGE TRACKING
-        # Keep number of unique codes
-        for code in suffix_code_list:
-            suffix_codes_val[code] +1
-            if code not in suffix_codes_trn:
-                new_gen_suffix_codes_val[code] += 1
-                freq_new_gen_suffix_codes_used += 1
-        # Keep per each dict
-        for i in range(args.num_dicts):
-            for ind in quantized_inds[i][0]:
-                ind = ind.item()
-                if ind not in epoch_quantized_inds[i]:
-                    epoch_quantized_inds[i][ind] = 1
-                else:
-                    epoch_quantized_inds[i][ind] += 1
-            if epc % 10 ==0:
-                # put suffix-code into last cluster
-                for s in range(surf.shape[0]):
-                    ind = suffix_code_list[s]
-                    if ind not in clusters_list[-1]:                   
-                        clusters_list[-1][ind] = []
-                    if ''.join(args.surf_vocab.decode_sentence(surf[s])) not in clusters_list[-1][ind]:
-                        clusters_list[-1][ind].append(''.join(args.surf_vocab.decode_sentence(surf[s])))
-             
-
-
-        epoch_num_tokens += surf.size(0) * (surf.size(1)-1)  # exclude start token prediction
-        epoch_loss       += loss.sum().item()
-        epoch_recon_loss += recon_loss.sum().item()
-        epoch_vq_loss    += vq_loss.sum().item()
-        epoch_kl_loss    += kl_loss.sum().item()
-        epoch_acc        += acc
-    
-    for i in range(args.num_dicts +1):
-        if epc % 10 ==0:
-            i = args.num_dicts
-            with open(args.modelname+'suffix_codes.json', 'w') as json_file:
-                d = OrderedDict(sorted(clusters_list[i].items()))
-                json_object = json.dumps(d, indent = 4, ensure_ascii=False)
-                json_file.write(json_object)
-            with open(args.modelname+'suffix_codes_usage.json', 'w') as wr:
-                for key,val in clusters_list[i].items():
-                    usage = {key: len(val)}
-                    wr.write(str(usage) + '\n')
-    for i in range(args.num_dicts):
-        vq_inds[i] = len(epoch_quantized_inds[i])
-    loss = epoch_loss / numwords 
-    recon = epoch_recon_loss / numwords 
-    vq = epoch_vq_loss / numwords 
-    acc = epoch_acc / epoch_num_tokens
-    kl = epoch_kl_loss / numwords 
-    dict_usage_ratio = len(suffix_codes_val) / (args.orddict_emb_num ** args.num_dicts)
-    #tensorboard log
-    writer.add_scalar('val/loss', loss, epc)
-    writer.add_scalar('val/loss/recon_loss', recon, epc)
-    writer.add_scalar('val/loss/kl_loss', kl, epc)
-    writer.add_scalar('val/loss/vq_loss', vq, epc)
-    writer.add_scalar('val/accuracy', acc, epc)
-    writer.add_scalar('val/dict_usage_ratio', dict_usage_ratio, epc)
-    writer.add_scalar('val/suffix_codes_val', len(suffix_codes_val), epc)
-
-
-
-    args.logger.write('\nVAL')
-    args.logger.write('\nloss: %.4f, vq_loss: %.4f, kl_loss: %.4f, recon_loss: %.4f, recon_acc: %.4f' % (loss, vq, kl, recon, acc))
-    args.logger.write('\nvq_inds: %s, unique_suffix_codes: %d, dict_usage_ratio: %.4f, new_gen_codes: %d' % (vq_inds, len(suffix_codes_val), dict_usage_ratio, len(new_gen_suffix_codes_val)))
-    args.logger.write('\nfreq_new_gen_suffix_codes_used: %d over %d words' % (freq_new_gen_suffix_codes_used, args.valsize))
-    return loss, recon, vq, acc, vq_inds
-
 def train(data, args):
     trnbatches, valbatches, tstbatches = data
-    # initialize optimizer
-    opt = optim.Adam(filter(lambda p: p.requires_grad, args.model.parameters()), lr=args.lr,  weight_decay=1e-5)
-    # Log trainable model parameters
-    for name, prm in args.model.named_parameters():
-        args.logger.write('\n'+name+', '+str(prm.shape) + ': '+ str(prm.requires_grad))
-    numbatches = len(trnbatches); indices = list(range(numbatches))
-    numwords = args.trnsize
-    best_loss = 1e4
-    trn_vq_inds = []; val_vq_inds = []
-    update_ind = 0
-    for epc in range(args.epochs):
-        args.logger.write('\n-----------------------------------------------------\n')
-
-        clusters_list = []; epoch_quantized_inds = []; vq_inds = []
-        for i in range(args.num_dicts):
-            epoch_quantized_inds.append(dict())
-            clusters_list.append(dict())
-            vq_inds.append(0)
-        clusters_list.append(dict())
-        epoch_loss = 0; epoch_num_tokens = 0; epoch_acc = 0
-        epoch_vq_loss = 0; epoch_recon_loss = 0; epoch_kl_loss = 0
-        random.shuffle(indices) # this breaks continuity if there is any
-        suffix_codes_trn = defaultdict(lambda: 0)
-        for i, idx in enumerate(indices):
-            kl_weight = get_kl_weight(update_ind, args.kl_max, 150000.0)
-            #vq_weight = get_kl_weight(update_ind, 0.1, 150000.0)
-
-            update_ind += 1
-            args.model.zero_grad()
-            # (batchsize, t)
-            surf = trnbatches[idx] 
-            # (batchsize)
-            loss, recon_loss, vq_loss, (acc,pred_tokens), quantized_inds,  encoder_fhs, vq_codes_list, suffix_code_list, recon_preds, kl_loss, logdetmaxloss = args.model.loss(surf, kl_weight, epc)
-            batch_loss = loss.mean()
-            batch_loss.backward()
-            opt.step()
-       
-            epoch_num_tokens += surf.size(0) * (surf.size(1)-1) # exclude start token prediction
-            epoch_loss       += loss.sum().item()
-            epoch_recon_loss += recon_loss.sum().item()
-            epoch_vq_loss    += vq_loss.sum().item()
-            epoch_kl_loss    += kl_loss.sum().item()
-            epoch_acc        += acc
-
-            ## DICT USAGE TRACKING
-            # Keep number of unique codes
-            for code in suffix_code_list:
-                suffix_codes_trn[code] +=1
-            # Keep per each dict
-            for i in range(args.num_dicts):
-                for ind in quantized_inds[i][0]:
-                    ind = ind.item()
-                    if ind not in epoch_quantized_inds[i]:
-                        epoch_quantized_inds[i][ind] = 1
-                    else:
-                        epoch_quantized_inds[i][ind] += 1
-        for i in range(args.num_dicts):
-            vq_inds[i] = len(epoch_quantized_inds[i])
-       
-        loss = epoch_loss / numwords 
-        recon = epoch_recon_loss / numwords 
-        vq = epoch_vq_loss / numwords 
-        acc = epoch_acc / epoch_num_tokens
-        kl = epoch_kl_loss / numwords 
-
-        dict_usage_ratio = len(suffix_codes_trn) / (args.orddict_emb_num ** args.num_dicts)
-        args.logger.write('\nEpoch: %d, kl_weight: %.3f' % (epc, kl_weight))
-        args.logger.write('\nTRN')
-        args.logger.write('\nloss: %.4f, vq_loss: %.4f, kl_loss: %.4f, recon_loss: %.4f, recon_acc: %.4f' % (loss, vq, kl, recon, acc))
-        args.logger.write('\nvq_inds: %s, unique_suffix_codes: %d, dict_usage_ratio: %.4f' % ( vq_inds, len(suffix_codes_trn), dict_usage_ratio))
-
-        #tensorboard log
-        writer.add_scalar('trn/loss', loss, epc)
-        writer.add_scalar('trn/loss/recon_loss', recon, epc)
-        writer.add_scalar('trn/loss/kl_loss', kl, epc)
-        writer.add_scalar('trn/loss/vq_loss', vq, epc)
-        writer.add_scalar('trn/accuracy', acc, epc)
-        writer.add_scalar('trn/dict_usage_ratio', dict_usage_ratio, epc)
-        writer.add_scalar('trn/suffix_codes_trn', len(suffix_codes_trn), epc)
-
-        # VAL
-        args.model.eval()
-        with torch.no_grad():
-            loss, recon, vq, acc, vq_inds = test(valbatches, "val", args, epc, suffix_codes_trn, kl_weight)
- 
-        if loss < best_loss:
-            args.logger.write('\nupdate best loss\n')
-            best_loss = loss
-            torch.save(args.model.state_dict(), args.save_path)
-        if epc%5==0 or (epc>150 and epc%5==0):
-            shared_acc = shared_task_gen(args)
-            #tag_analysis(args.model_id+'_epc'+str(epc), args.num_dicts, args.orddict_emb_num, args.lang, args.logger, during_training=True, args=args)
-            #counter(args.model_id+'_epc'+str(epc), args.lang, args.logger)
-            torch.save(args.model.state_dict(), args.save_path+'_'+str(epc))
-            writer.add_scalar('shared-task/accuracy', shared_acc, epc)
-
-        args.model.train()
+    def step(trainer, i, surf, epc, kl_weight):
+        # (batchsize)
+        outputs = args.model.loss(surf, kl_weight, epc)
+        return outputs[0].mean(), (surf, outputs)
+    def val_loss(surf, kl_weight, epc):
+        return surf, args.model.loss(surf, kl_weight, epc, mode='val')
+    def shared_task(trainer, epc):
+        shared_acc = shared_task_gen(args)
+        writer.add_scalar('shared-task/accuracy', shared_acc, epc)
+    trainer = VQVAETrainer(args, writer, step, lambda update_ind: get_kl_weight(update_ind, args.kl_max, 150000.0, 3000),
+                           [('val', 'VAL', val_loss)], shared_task, lambda epc: epc%5==0)
+    trainer.train(trnbatches, args.trnsize, valbatches, args.valsize)
 
 
 def shared_task_gen(args):
-    with open('late_sup_'+args.lang+'_beta'+str(args.beta)+'_sharedtask_TRUE.txt_bi_kl'+str(args.kl_max)+'_'+str(args.num_dicts)+'_'+str(args.orddict_emb_num), 'w') as writer_true:
-        with open('late_sup_'+args.lang+'_beta'+str(args.beta)+'_sharedtask_FALSE.txt_bi_kl'+str(args.kl_max)+'_'+str(args.num_dicts)+'_'+str(args.orddict_emb_num), 'w') as writer_false:
-            with open(args.tstdata, 'r') as reader:
-                i=0; true=0; false = 0
-                for line in reader:
-                    if i>2000:
-                        break
-                    i+=1
-                    split_line = line.strip().split('\t')
-                    inflected_word, asked_tag, gold_reinflection  = split_line
-                    oracle_keys = oracle(args, asked_tag, inflected_word, gold_reinflection)
-                    key = [int(n) for n in oracle_keys.split('-')]
-                    reinflected_word, suffix_code =  reinflect(args, inflected_word,key)
-                    reinflected_word = reinflected_word[:-4]
-                    #writer.write(inflected_word +'\t'+ asked_tag+'\t'+reinflected_word + '\n')
-                    if reinflected_word == gold_reinflection:
-                        true +=1
-                        writer_true.write(inflected_word +'\t'+gold_reinflection + '\t'+reinflected_word+'\t'+ '-'.join([str(s) for s in suffix_code])+'\n')
-                    else:
-                        writer_false.write(inflected_word +'\t'+gold_reinflection + '\t'+reinflected_word+'\t'+ '-'.join([str(s) for s in suffix_code])+'\n')
-    acc = true/i
-    args.logger.write('\nShared Task oracle acc: %.2f over %d words\n' % (acc, i))
+    # test set is kept encoded in args.shared_task, only the model runs here
+    acc = args.shared_task.run(args.model, vq_args=(0, 'tst'))
+    args.shared_task.write('late_sup_'+args.lang+'_beta'+str(args.beta)+'_sharedtask_TRUE.txt_bi_kl'+str(args.kl_max)+'_'+str(args.num_dicts)+'_'+str(args.orddict_emb_num),
+                           'late_sup_'+args.lang+'_beta'+str(args.beta)+'_sharedtask_FALSE.txt_bi_kl'+str(args.kl_max)+'_'+str(args.num_dicts)+'_'+str(args.orddict_emb_num))
+    args.logger.write('\nShared Task oracle acc: %.2f over %d words\n' % (acc, args.shared_task.numwords))
     return acc
 
-def oracle(args, asked_tag, inflected_word, reinflected_word, itr=0):
-    x = torch.tensor([args.surf_vocab.word2id['<s>']] + args.surf_vocab.encode_sentence(reinflected_word) + [args.surf_vocab.word2id['</s>']]).unsqueeze(0).to('cuda')
-    quantized_inputs, vq_loss, quantized_inds, encoder_fhs, _,_,_, _ = args.model.vq_loss(x, 0, 'tst')
-    mapped_inds =  '-'.join([str(i[0][0].item()) for i in quantized_inds])
-    return mapped_inds#''.join(inflected_word) +'\t'+ asked_tag +'\t'+ mapped_inds +'\t---> ' + reinflected_word
-
-def reinflect(args, inflected_word, reinflect_tag):
-    x = torch.tensor([args.surf_vocab.word2id['<s>']] + args.surf_vocab.encode_sentence(inflected_word) + [args.surf_vocab.word2id['</s>']]).unsqueeze(0).to('cuda')
-    vq_vectors = []
-  
-    # kl version
-    fhs, _, _, mu, logvar, fwd,bck = args.model.encoder(x)
-    _root_fhs = mu.unsqueeze(0)
-    #_root_fhs = args.model.reparameterize(mu, logvar)
-    _root_fhs = args.model.z_to_dec(_root_fhs)
-
-    vq_vectors.append(_root_fhs)
-
-    bosid = args.surf_vocab.word2id['<s>']
-    input = torch.tensor(bosid).to('cuda')
-    sft = nn.Softmax(dim=1)
-    # Quantized Inputs
-
-    vq_vectors.append(args.model.ord_vq_layers[0].embedding.weight[reinflect_tag[0]].unsqueeze(0).unsqueeze(0))
-    if args.num_dicts >=2:
-        vq_vectors.append(args.model.ord_vq_layers[1].embedding.weight[reinflect_tag[1]].unsqueeze(0).unsqueeze(0))
-    if args.num_dicts >=3:
-        vq_vectors.append(args.model.ord_vq_layers[2].embedding.weight[reinflect_tag[2]].unsqueeze(0).unsqueeze(0))
-    if args.num_dicts >=4:
-        vq_vectors.append(args.model.ord_vq_layers[3].embedding.weight[reinflect_tag[3]].unsqueeze(0).unsqueeze(0))
-    if args.num_dicts >=5:
-        vq_vectors.append(args.model.ord_vq_layers[4].embedding.weight[reinflect_tag[4]].unsqueeze(0).unsqueeze(0))
-    if args.num_dicts >=6:
-        vq_vectors.append(args.model.ord_vq_layers[5].embedding.weight[reinflect_tag[5]].unsqueeze(0).unsqueeze(0))
-
-    if args.num_dicts >=8:
-        vq_vectors.append(args.model.ord_vq_layers[6].embedding.weight[reinflect_tag[6]].unsqueeze(0).unsqueeze(0))
-        vq_vectors.append(args.model.ord_vq_layers[7].embedding.weight[reinflect_tag[7]].unsqueeze(0).unsqueeze(0))
-    if args.num_dicts >=10:
-        vq_vectors.append(args.model.ord_vq_layers[8].embedding.weight[reinflect_tag[8]].unsqueeze(0).unsqueeze(0))
-        vq_vectors.append(args.model.ord_vq_layers[9].embedding.weight[reinflect_tag[9]].unsqueeze(0).unsqueeze(0))
-    if args.num_dicts >=11:
-        vq_vectors.append(args.model.ord_vq_layers[10].embedding.weight[reinflect_tag[10]].unsqueeze(0).unsqueeze(0))
-    if args.num_dicts >=16:
-        vq_vectors.append(args.model.ord_vq_layers[11].embedding.weight[reinflect_tag[11]].unsqueeze(0).unsqueeze(0))
-        vq_vectors.append(args.model.ord_vq_layers[12].embedding.weight[reinflect_tag[12]].unsqueeze(0).unsqueeze(0))
-        vq_vectors.append(args.model.ord_vq_layers[13].embedding.weight[reinflect_tag[13]].unsqueeze(0).unsqueeze(0))
-        vq_vectors.append(args.model.ord_vq_layers[14].embedding.weight[reinflect_tag[14]].unsqueeze(0).unsqueeze(0))
-        vq_vectors.append(args.model.ord_vq_layers[15].embedding.weight[reinflect_tag[15]].unsqueeze(0).unsqueeze(0))
-
-    vq_vectors = (vq_vectors[0], torch.cat(vq_vectors[1:],dim=2))
-    root_z, suffix_z = vq_vectors
-    batch_size, seq_len, _ = fhs.size()
-    z_ = suffix_z.expand(batch_size, seq_len, args.model.decoder.incat)
-
-    c_init = root_z
-    h_init = torch.tanh(c_init)
-    decoder_hidden = (h_init, c_init)
-    copied = []; i = 0
-    MAX_LENGTH = 50
-    c=0
-    while c<MAX_LENGTH:
-        c+=1
-        # (1,1,ni)
-        word_embed = args.model.decoder.embed(torch.tensor([input]).unsqueeze(0).to('cuda'))
-        word_embed = torch.cat((word_embed, z_), -1)
-        # output: (1,1,dec_nh)
-        output, decoder_hidden = args.model.decoder.lstm(word_embed, decoder_hidden)
-        # (1, vocab_size)
-        output_logits = args.model.decoder.pred_linear(output).squeeze(1)
-        input = torch.argmax(sft(output_logits))
-        char = args.surf_vocab.id2word(input.item())
-        copied.append(char)
-        if char == '</s>':
-            return(''.join(copied), (reinflect_tag))
-    return(''.join(copied), (reinflect_tag))
-
-def get_kl_weight(update_ind, thres, rate):
-    upnum = 3000
-    if update_ind <= upnum:
-        return 0.0
-    else:
-        w = (1.0/rate)*(update_ind - upnum)
-        if w < thres:
-            return w
-        else:
-            return thres
-
 # CONFIG
 parser = argparse.ArgumentParser(description='')
+parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint of save_path')
+parser.add_argument('--async_val', action='store_true', help='validate weight snapshots in a worker process while training goes on')
+parser.add_argument('--time_phases', action='store_true', help='log the time of each training phase and the words/tokens per second of every epoch')
+parser.add_argument('--amp', action='store_true', help='mixed precision (autocast and gradient scaling), cuda only, ignored on cpu')
+parser.add_argument('--profile', action='store_true', help='run a window of steps under torch.profiler and export its chrome trace and operator tables')
+parser.add_argument('--profile_steps', type=int, nargs=3, default=[2, 2, 5], metavar=('WAIT', 'WARMUP', 'ACTIVE'), help='steps run before profiling, warm-up steps and profiled steps')
 args = parser.parse_args()
+args.keep_ckpts = 3
 args.device = 'cuda'
+# under torchrun: one cpu process per rank (gloo), see README
+init_distributed(args)
 # training
 args.batchsize = 128; args.epochs = 300
 args.opt= 'Adam'; args.lr = 0.001
@@ -445,7 +175,7 @@ except FileExistsError:
 args.save_path = args.modelname +  str(args.epochs)+'epochs.pt'
 args.log_path =  args.modelname +  str(args.epochs)+'epochs.log'
 args.fig_path =  args.modelname +  str(args.epochs)+'epochs.png'
-args.logger = Logger(args.log_path)
+args.logger = Logger(args.log_path, 'a' if args.resume else 'w') if is_main(args) else QuietLogger()
 
 with open(args.modelname+'/surf_vocab.json', 'w') as f:
     f.write(json.dumps(args.surf_vocab.word2id))
@@ -460,6 +190,8 @@ args.logger.write('\nnumber of params: %d \n' % count_parameters(args.model))
 args.logger.write(args)
 args.logger.write('\n')
 
+# shared-task test set, encoded once for the periodic evaluation
+args.shared_task = SharedTaskEvaluator(args.tstdata, args.surf_vocab, maxsize=2000, device=args.device)
 # RUN
 train(batches, args)
 writer.close()
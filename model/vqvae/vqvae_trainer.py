@@ -0,0 +1,460 @@
+# -----------------------------------------------------------
+# Date:        2026/10/19
+# Description: Training engine shared by the VQVAE trainers, model-specific losses
+#              and supervision schedules are plugged in as hooks
+# -----------------------------------------------------------
+
+import os, random, copy, queue, traceback, torch
+import torch.multiprocessing as mp
+from torch import optim
+from collections import defaultdict, OrderedDict
+from common.clusters import ClusterStore
+from common.timers import PhaseTimer
+from common.profiling import StepProfiler
+from common.checkpoint import CheckpointManager, cpu_copy, get_rng_state, set_rng_state
+from common.distributed import is_distributed, is_main, barrier, broadcast_params, broadcast_order, shard, all_reduce_grads, all_gather_counts
+import torch.distributed as dist
+
+
+def get_kl_weight(update_ind, thres, rate, upnum):
+    # 0 for the first upnum updates, then grows linearly with 1/rate per update up to thres
+    if update_ind <= upnum:
+        return 0.0
+    else:
+        w = (1.0/rate)*(update_ind - upnum)
+        if w < thres:
+            return w
+        else:
+            return thres
+
+def to_device(batch, device):
+    # tensor or (nested) tuple/list of tensors
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(to_device(b, device) for b in batch)
+    return batch
+
+def prefetch(batches, indices, device):
+    # yields batches in the order of indices, the copy of the next batch is issued
+    # before the current one is used, so host-to-device transfers overlap the step
+    if len(indices) == 0:
+        return
+    nxt = to_device(batches[indices[0]], device)
+    for k in range(len(indices)):
+        cur = nxt
+        if k+1 < len(indices):
+            nxt = to_device(batches[indices[k+1]], device)
+        yield cur
+
+
+class EpochStats(object):
+    """Loss sums, token counts and dictionary usage of one epoch for outputs of model.loss:
+    (loss, recon_loss, vq_loss, (acc, pred_tokens), quantized_inds, encoder_fhs, vq_codes_list,
+     suffix_code_list, recon_preds, kl_loss, ...)"""
+    def __init__(self, model):
+        self.sums = None
+        self.num_tokens = 0
+        # number of times each code of each dict is chosen
+        self.code_counts = [torch.zeros(vq_layer.embedding.weight.size(0), dtype=torch.long, device=vq_layer.embedding.weight.device)
+                            for vq_layer in model.ord_vq_layers]
+        self.suffix_codes = defaultdict(lambda: 0)
+
+    def add(self, x, outputs, code_outputs=None):
+        # code_outputs: model.loss outputs whose codes are tracked, if not those of x
+        loss, recon_loss, vq_loss, (acc, _) = outputs[:4]
+        code_outputs = outputs if code_outputs is None else code_outputs
+        quantized_inds = code_outputs[4]
+        kl_loss = outputs[9] if len(outputs) > 10 else torch.zeros_like(loss)
+        # [loss, recon, vq, kl, acc] summed over the batch, kept on device
+        sums = torch.stack([loss.sum(), recon_loss.sum(), vq_loss.sum(), kl_loss.sum(), torch.as_tensor(acc, dtype=loss.dtype, device=loss.device)]).detach()
+        self.sums = sums if self.sums is None else self.sums + sums
+        # exclude start token prediction
+        self.num_tokens = self.num_tokens + (x[:, 1:] != 0).sum()
+        for i, counts in enumerate(self.code_counts):
+            counts += torch.bincount(quantized_inds[i][0], minlength=counts.size(0))
+        for code in code_outputs[7]:
+            self.suffix_codes[code] += 1
+
+    def all_reduce(self, args):
+        # sums of all ranks, on every rank
+        if not is_distributed(args):
+            return
+        dist.all_reduce(self.sums)
+        self.num_tokens = torch.as_tensor(self.num_tokens)
+        dist.all_reduce(self.num_tokens)
+        for counts in self.code_counts:
+            dist.all_reduce(counts)
+        self.suffix_codes = all_gather_counts(self.suffix_codes, args)
+
+    def vq_inds(self):
+        # number of distinct codes used in each dict
+        return [int(c) for c in torch.stack([(counts > 0).sum() for counts in self.code_counts]).tolist()] if len(self.code_counts) > 0 else []
+
+    def summary(self, numwords):
+        # ---> loss, recon, vq, kl, acc (one host transfer per epoch)
+        loss, recon, vq, kl, acc = self.sums.tolist()
+        return loss / numwords, recon / numwords, vq / numwords, kl / numwords, acc / int(self.num_tokens)
+
+
+class VQVAETrainer(object):
+    """Epoch loop of the VQVAE trainers in one place: optimizer, shuffling, prefetching,
+    mixed precision, metrics, validation and checkpointing.
+    Every epoch ends with a full checkpoint (last args.keep_ckpts kept, default 3, plus the best),
+    args.resume restarts from the last one.
+    Under torchrun (common.distributed.init_distributed) each rank trains on its shard of the batches
+    and gradients are averaged over the ranks; rank 0 logs, validates and saves.
+    Hooks:
+        step_fn(trainer, i, batch, epc, kl_weight) ---> (batch_loss, (x, outputs[, code_outputs])): loss of one update,
+            x and model.loss outputs of the stream logged as TRN, and optionally the outputs of the stream whose
+            dict usage is tracked
+        kl_weight_fn(update_ind) ---> kl weight of the update
+        val_runs: (tensorboard prefix, log title, val_loss_fn) of each validation pass, e.g. ('val', 'VAL', fn),
+            val_loss_fn(batch, kl_weight, epc) ---> (x, outputs): model.loss in val mode on a val batch;
+            the first pass gives the loss of the best checkpoint
+        periodic_fn(trainer, epc): e.g. shared-task evaluation, run when periodic_epoch(epc)
+    With args.async_val the val runs go to a worker process forked at the start of training, which
+    validates a cpu copy of the model on the weight snapshot of each epoch while training goes on.
+    Its results are logged by the training process to the same logger and tensorboard run when they
+    arrive, and the best checkpoint is picked retroactively from the snapshot of that epoch.
+    Each checkpoint lists the epochs whose results were not back when it was saved; args.resume
+    validates them again from their own checkpoints before training goes on, so they can still be the best.
+    periodic_fn stays in the training process (it may use the training device and its own writer).
+    val_loss_fns must reach the model through args.model, which is the validation copy in the worker.
+    With args.time_phases the time of each phase of an epoch and the words/tokens per second are
+    written to the logger and to tensorboard (time/*), see common.timers.PhaseTimer.
+    With args.profile a window of updates (args.profile_steps: wait, warmup, active) is run under
+    torch.profiler, its trace and operator tables go to args.modelname+'profile/'.
+    """
+    def __init__(self, args, writer, step_fn, kl_weight_fn, val_runs, periodic_fn=None, periodic_epoch=lambda epc: False,
+                 trn_prefix='', save_best=True, save_snapshots=True):
+        self.args = args
+        self.writer = writer
+        self.step_fn = step_fn
+        self.val_runs = val_runs
+        self.kl_weight_fn = kl_weight_fn
+        self.periodic_fn = periodic_fn
+        self.periodic_epoch = periodic_epoch
+        self.trn_prefix = trn_prefix
+        self.save_best = save_best
+        self.save_snapshots = save_snapshots
+        self.model = args.model
+        self.device = next(self.model.parameters()).device
+        self.opt = optim.Adam(filter(lambda p: p.requires_grad, self.model.parameters()), lr=args.lr,  weight_decay=1e-5)
+        # mixed precision, cuda only
+        self.amp = getattr(args, 'amp', False) and self.device.type == 'cuda'
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp)
+        self.update_ind = 0
+        self.best_loss = 1e4
+        self.start_epoch = 0
+        self.indices = None
+        # metrics of the last epoch, e.g. for sweep tables
+        self.results = dict()
+        # asynchronous validation: full states of the epochs whose val results are not back yet
+        self.async_val = getattr(args, 'async_val', False)
+        self.max_pending = getattr(args, 'max_pending_val', 2)
+        self.pending = OrderedDict()
+        # epochs of the resumed checkpoint saved before their asynchronous validation came back
+        self.unvalidated = []
+        self.timer = PhaseTimer(getattr(args, 'time_phases', False), self.device)
+        self.profiler = StepProfiler(getattr(args, 'profile', False), args.modelname+'profile/', 'train_rank%d' % getattr(args, 'rank', 0),
+                                     getattr(args, 'profile_steps', (2, 2, 5)), self.device)
+        self.ckpt = CheckpointManager(args.save_path, getattr(args, 'keep_ckpts', 3))
+        if getattr(args, 'resume', False):
+            self.resume()
+        broadcast_params(self.model, args)
+
+    def state(self, epc):
+        return {'model': self.model.state_dict(), 'opt': self.opt.state_dict(), 'scaler': self.scaler.state_dict(),
+                'epoch': epc, 'update_ind': self.update_ind, 'best_loss': self.best_loss,
+                'indices': list(self.indices), 'rng': get_rng_state()}
+
+    def resume(self):
+        if self.ckpt.latest() is None:
+            self.args.logger.write('\nno checkpoint to resume from, starting from scratch\n')
+            return
+        state = self.ckpt.load(map_location=self.device)
+        self.model.load_state_dict(state['model'])
+        self.opt.load_state_dict(state['opt'])
+        self.scaler.load_state_dict(state['scaler'])
+        self.update_ind = state['update_ind']
+        self.best_loss = state['best_loss']
+        self.indices = state['indices']
+        self.start_epoch = state['epoch'] + 1
+        self.unvalidated = state.get('unvalidated', [])
+        set_rng_state(state['rng'])
+        self.args.logger.write('\nresumed from epoch %d, update %d\n' % (state['epoch'], self.update_ind))
+
+    def update(self, i, batch, epc, kl_weight):
+        timer = self.timer
+        self.model.zero_grad()
+        with timer.phase('forward'), torch.autocast(device_type=self.device.type, enabled=self.amp):
+            batch_loss, logged = self.step_fn(self, i, batch, epc, kl_weight)
+        with timer.phase('backward'):
+            self.scaler.scale(batch_loss).backward()
+        with timer.phase('all_reduce'):
+            all_reduce_grads(self.model, self.args)
+        with timer.phase('optimizer'):
+            self.scaler.step(self.opt)
+            self.scaler.update()
+        return logged
+
+    def train(self, batches, numwords, val_batches, numvalwords):
+        # batches: batches of the stream that drives the epoch (one update per batch)
+        args = self.args
+        # Log trainable model parameters
+        for name, prm in self.model.named_parameters():
+            args.logger.write('\n'+name+', '+str(prm.shape) + ': '+ str(prm.requires_grad))
+        if self.indices is None:
+            self.indices = list(range(len(batches)))
+        self.val_worker = None
+        if self.async_val and is_main(args):
+            self.start_val_worker(val_batches, numvalwords)
+        if len(self.unvalidated) > 0 and is_main(args):
+            self.revalidate(val_batches, numvalwords)
+        self.profiler.start()
+        for epc in range(self.start_epoch, args.epochs):
+            args.logger.write('\n-----------------------------------------------------\n')
+            random.shuffle(self.indices) # this breaks continuity if there is any
+            self.indices = broadcast_order(self.indices, args)
+            stats = EpochStats(self.model)
+            timer = self.timer
+            timer.reset()
+            for i, batch in enumerate(timer.iterate(prefetch(batches, shard(self.indices, args), self.device))):
+                kl_weight = self.kl_weight_fn(self.update_ind)
+                self.update_ind += 1
+                logged = self.update(i, batch, epc, kl_weight)
+                with timer.phase('metrics'):
+                    stats.add(*logged)
+                x = logged[0]
+                timer.count(x.size(0), x.size(0) * (x.size(1)-1))
+                self.profiler.step()
+            with timer.phase('metrics'):
+                stats.all_reduce(args)
+            if not is_main(args):
+                # rank 0 validates and saves meanwhile
+                barrier(args)
+                continue
+            with timer.phase('metrics'):
+                self.log_epoch(stats, numwords, epc, kl_weight)
+            if self.async_val:
+                self.submit_val(epc, stats.suffix_codes, kl_weight)
+                timer.log(epc, self.writer, args.logger)
+                barrier(args)
+                continue
+
+            # VAL
+            self.model.eval()
+            with timer.phase('validation'), torch.no_grad():
+                losses = [self.evaluate(val_batches, numvalwords, epc, stats.suffix_codes, kl_weight, loss_fn, prefix, title)[0] for prefix, title, loss_fn in self.val_runs]
+                is_best = losses[0] < self.best_loss
+                if is_best:
+                    args.logger.write('\nupdate best loss\n')
+                    self.best_loss = losses[0]
+                self.results['best_loss'] = self.best_loss
+                self.run_periodic(epc)
+            # written in the background, the next epoch starts right away
+            with timer.phase('checkpoint'):
+                self.ckpt.save(self.state(epc), epc, is_best=is_best and self.save_best)
+            timer.log(epc, self.writer, args.logger)
+            self.model.train()
+            barrier(args)
+        self.profiler.stop()
+        if self.async_val and is_main(args):
+            self.stop_val_worker()
+        self.ckpt.close()
+
+    def run_periodic(self, epc):
+        if self.periodic_epoch(epc):
+            if self.periodic_fn is not None:
+                self.periodic_fn(self, epc)
+            if self.save_snapshots:
+                self.ckpt.save_model(self.model.state_dict(), self.args.save_path+'_'+str(epc))
+
+    ## Asynchronous validation
+    def start_val_worker(self, val_batches, numvalwords):
+        # forked, so the val_loss_fn closures of the trainers come along; the worker only touches
+        # cpu copies made here, never the training device
+        val_model = copy.deepcopy(self.model).to('cpu').eval()
+        val_batches = [to_device(batch, 'cpu') for batch in val_batches]
+        ctx = mp.get_context('fork')
+        self.val_jobs = ctx.Queue(); self.val_results = ctx.Queue()
+        self.val_worker = ctx.Process(target=self._val_worker, args=(val_model, val_batches, numvalwords), daemon=True)
+        self.val_worker.start()
+
+    def _val_worker(self, val_model, val_batches, numvalwords):
+        # in the worker: val_loss_fns read args.model, the validation copy from now on
+        self.args.model = self.model = val_model
+        self.device = torch.device('cpu')
+        torch.set_num_threads(getattr(self.args, 'val_threads', 1))
+        while True:
+            job = self.val_jobs.get()
+            if job is None:
+                return
+            epc, model_state, suffix_codes_trn, kl_weight = job
+            try:
+                val_model.load_state_dict(model_state)
+                with torch.no_grad():
+                    out = [(prefix, title, self.validate(val_batches, numvalwords, epc, suffix_codes_trn, kl_weight, loss_fn, prefix))
+                           for prefix, title, loss_fn in self.val_runs]
+            except Exception:
+                out = traceback.format_exc()
+            self.val_results.put((epc, out))
+
+    def submit_val(self, epc, suffix_codes_trn, kl_weight):
+        # snapshot of the epoch: validated by the worker, kept until its results are back
+        if self.val_worker is None:
+            raise RuntimeError('validation worker is not running')
+        with self.timer.phase('checkpoint'):
+            state = cpu_copy(self.state(epc))
+        self.pending[epc] = state
+        # validated again on resume if the run stops before their results are back
+        state['val_args'] = (dict(suffix_codes_trn), kl_weight)
+        state['unvalidated'] = list(self.pending)
+        self.val_jobs.put((epc, state['model'], dict(suffix_codes_trn), kl_weight))
+        self.model.eval()
+        with self.timer.phase('validation'), torch.no_grad():
+            self.run_periodic(epc)
+        self.model.train()
+        with self.timer.phase('checkpoint'):
+            self.ckpt.save(state, epc)
+        # waits only if the worker falls more than max_pending epochs behind
+        with self.timer.phase('validation'):
+            self.collect_val(self.max_pending)
+
+    def _next_val_result(self, block):
+        while True:
+            try:
+                return self.val_results.get(block=block, timeout=10 if block else None)
+            except queue.Empty:
+                if not block:
+                    return None
+                if not self.val_worker.is_alive():
+                    raise RuntimeError('validation worker exited with code %s' % self.val_worker.exitcode)
+
+    def collect_val(self, max_pending=0):
+        # logs the results that are back, in epoch order; blocks while more than max_pending are out
+        while len(self.pending) > 0:
+            result = self._next_val_result(block=len(self.pending) > max_pending)
+            if result is None:
+                return
+            epc, out = result
+            state = self.pending.pop(epc)
+            if isinstance(out, str):
+                raise RuntimeError('validation of epoch %d failed in the worker:\n%s' % (epc, out))
+            self.args.logger.write('\n-----------------------------------------------------\nEpoch: %d (validated asynchronously)' % epc)
+            for prefix, title, metrics in out:
+                self.log_val(metrics, epc, prefix, title)
+            self.update_best(out[0][2]['loss'], state)
+
+    def update_best(self, loss, state):
+        # state: full state of the validated epoch, saved as the best one if its loss is lower
+        if loss < self.best_loss:
+            self.args.logger.write('\nupdate best loss\n')
+            self.best_loss = loss
+            if self.save_best:
+                state['best_loss'] = loss
+                self.ckpt.save_best(state)
+        self.results['best_loss'] = self.best_loss
+
+    def revalidate(self, val_batches, numvalwords):
+        # epochs of the resumed run whose asynchronous results were lost, from their own checkpoints:
+        # queued to the worker, or validated here without args.async_val
+        for epc in self.unvalidated:
+            path = self.ckpt.ckpt_path(epc)
+            if not os.path.exists(path):
+                self.args.logger.write('\ncheckpoint of epoch %d is gone, it is not validated\n' % epc)
+                continue
+            state = self.ckpt.load(path)
+            suffix_codes_trn, kl_weight = state['val_args']
+            if self.async_val:
+                self.pending[epc] = state
+                self.val_jobs.put((epc, state['model'], suffix_codes_trn, kl_weight))
+                continue
+            current = cpu_copy(self.model.state_dict())
+            self.model.load_state_dict(state['model'])
+            self.model.eval()
+            with torch.no_grad():
+                losses = [self.evaluate(val_batches, numvalwords, epc, suffix_codes_trn, kl_weight, loss_fn, prefix, title)[0] for prefix, title, loss_fn in self.val_runs]
+            self.model.load_state_dict(current)
+            self.model.train()
+            self.update_best(losses[0], state)
+        self.unvalidated = []
+
+    def stop_val_worker(self):
+        self.collect_val(0)
+        self.val_jobs.put(None)
+        self.val_worker.join()
+        self.val_worker = None
+
+    def log_epoch(self, stats, numwords, epc, kl_weight):
+        args = self.args; p = self.trn_prefix
+        loss, recon, vq, kl, acc = stats.summary(numwords)
+        vq_inds = stats.vq_inds()
+        dict_usage_ratio = len(stats.suffix_codes) / (args.orddict_emb_num ** args.num_dicts)
+        args.logger.write('\nEpoch: %d, kl_weight: %.3f' % (epc, kl_weight))
+        args.logger.write('\nTRN')
+        args.logger.write(('\n'+p+'loss: %.4f, '+p+'vq_loss: %.4f, '+p+'kl_loss: %.4f, '+p+'recon_loss: %.4f, '+p+'recon_acc: %.4f') % (loss, vq, kl, recon, acc))
+        args.logger.write('\nvq_inds: %s, unique_suffix_codes: %d, dict_usage_ratio: %.4f' % ( vq_inds, len(stats.suffix_codes), dict_usage_ratio))
+        self.results.update({'epoch': epc, 'kl_weight': kl_weight, 'trn/loss': loss, 'trn/recon_loss': recon, 'trn/kl_loss': kl, 'trn/vq_loss': vq,
+                             'trn/accuracy': acc, 'trn/suffix_codes': len(stats.suffix_codes), 'trn/dict_usage_ratio': dict_usage_ratio})
+        #tensorboard log
+        self.writer.add_scalar('trn/loss', loss, epc)
+        self.writer.add_scalar('trn/loss/recon_loss', recon, epc)
+        self.writer.add_scalar('trn/loss/kl_loss', kl, epc)
+        self.writer.add_scalar('trn/loss/vq_loss', vq, epc)
+        self.writer.add_scalar('trn/accuracy', acc, epc)
+        self.writer.add_scalar('trn/dict_usage_ratio', dict_usage_ratio, epc)
+        self.writer.add_scalar('trn/suffix_codes_trn', len(stats.suffix_codes), epc)
+
+    def evaluate(self, batches, numwords, epc, suffix_codes_trn, kl_weight, val_loss_fn, prefix='val', title='VAL'):
+        metrics = self.validate(batches, numwords, epc, suffix_codes_trn, kl_weight, val_loss_fn, prefix)
+        self.log_val(metrics, epc, prefix, title)
+        return metrics['loss'], metrics['recon'], metrics['vq'], metrics['acc'], metrics['vq_inds']
+
+    def validate(self, batches, numwords, epc, suffix_codes_trn, kl_weight, val_loss_fn, prefix='val'):
+        # metrics of one val run (and the periodic cluster dumps, under prefix), no logging: also run by the async worker
+        args = self.args
+        stats = EpochStats(self.model)
+        new_gen_suffix_codes_val = defaultdict(lambda: 0)
+        freq_new_gen_suffix_codes_used = 0
+        dump_clusters = epc % 10 ==0 and args.num_dicts > 0
+        if dump_clusters:
+            clusters = ClusterStore(args.surf_vocab, [prefix])
+        for batch in prefetch(batches, list(range(len(batches))), self.device):
+            x, outputs = val_loss_fn(batch, kl_weight, epc)
+            stats.add(x, outputs)
+            suffix_code_list = outputs[7]
+            ## DICT USAGE TRACKING
+            for code in suffix_code_list:
+                if code not in suffix_codes_trn:
+                    new_gen_suffix_codes_val[code] += 1
+                    freq_new_gen_suffix_codes_used += 1
+            if dump_clusters:
+                # put words into the cluster of their suffix-code
+                clusters.add(x, {prefix: suffix_code_list})
+        if dump_clusters:
+            clusters.dump(epc, args.modelname+'suffix_codes.jsonl', args.modelname+'suffix_codes_usage.jsonl')
+        loss, recon, vq, kl, acc = stats.summary(numwords)
+        suffix_codes_val = stats.suffix_codes
+        return {'loss': loss, 'recon': recon, 'vq': vq, 'kl': kl, 'acc': acc, 'vq_inds': stats.vq_inds(),
+                'suffix_codes': len(suffix_codes_val), 'dict_usage_ratio': len(suffix_codes_val) / (args.orddict_emb_num ** args.num_dicts),
+                'new_gen_codes': len(new_gen_suffix_codes_val), 'freq_new_gen_codes': freq_new_gen_suffix_codes_used, 'numwords': numwords}
+
+    def log_val(self, metrics, epc, prefix='val', title='VAL'):
+        args = self.args; m = metrics
+        #tensorboard log
+        self.writer.add_scalar(prefix+'/loss', m['loss'], epc)
+        self.writer.add_scalar(prefix+'/loss/recon_loss', m['recon'], epc)
+        self.writer.add_scalar(prefix+'/loss/kl_loss', m['kl'], epc)
+        self.writer.add_scalar(prefix+'/loss/vq_loss', m['vq'], epc)
+        self.writer.add_scalar(prefix+'/accuracy', m['acc'], epc)
+        self.writer.add_scalar(prefix+'/dict_usage_ratio', m['dict_usage_ratio'], epc)
+        self.writer.add_scalar(prefix+'/suffix_codes_val', m['suffix_codes'], epc)
+
+        args.logger.write('\n'+title)
+        args.logger.write('\nloss: %.4f, vq_loss: %.4f, kl_loss: %.4f, recon_loss: %.4f, recon_acc: %.4f' % (m['loss'], m['vq'], m['kl'], m['recon'], m['acc']))
+        args.logger.write('\nvq_inds: %s, unique_suffix_codes: %d, dict_usage_ratio: %.4f, new_gen_codes: %d' % (m['vq_inds'], m['suffix_codes'], m['dict_usage_ratio'], m['new_gen_codes']))
+        args.logger.write('\nfreq_new_gen_suffix_codes_used: %d over %d words' % (m['freq_new_gen_codes'], m['numwords']))
+        self.results.update({prefix+'/loss': m['loss'], prefix+'/recon_loss': m['recon'], prefix+'/kl_loss': m['kl'], prefix+'/vq_loss': m['vq'],
+                             prefix+'/accuracy': m['acc'], prefix+'/suffix_codes': m['suffix_codes'], prefix+'/new_gen_codes': m['new_gen_codes']})